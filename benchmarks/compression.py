@@ -0,0 +1,79 @@
+"""
+Compares the compression codecs available to superfastmatch.tools.backup
+on the documents of an existing backup archive, reporting the compression
+ratio and the compression and decompression speeds of each codec.
+
+    python benchmarks/compression.py [--members N] [--codecs CODEC,...] ARCHIVE
+
+Codecs the interpreter does not support are skipped.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+from contextlib import closing
+from superfastmatch.zipfile27 import ZipFile, get_compressor, get_decompressor
+from superfastmatch.tools.archive import parse_codec, read_metadata
+
+
+DEFAULT_CODECS = 'stored,deflate:1,deflate:6,deflate:9,bzip2:1,bzip2:9,lzma:0,lzma:6'
+
+
+def sample_members(inpath, members):
+    """Returns the uncompressed contents of the first `members` docsN members."""
+    with closing(ZipFile(inpath, 'r')) as infile:
+        metadata = read_metadata(infile)
+        return [infile.read(chunk['name']) for chunk in metadata['chunks'][:members]]
+
+
+def measure(compress_type, compresslevel, samples):
+    compressed = []
+    started = time.time()
+    for data in samples:
+        compressor = get_compressor(compress_type, compresslevel)
+        compressed.append(data if compressor is None else compressor.compress(data) + compressor.flush())
+    compress_seconds = time.time() - started
+
+    started = time.time()
+    for (data, packed) in zip(samples, compressed):
+        decompressor = get_decompressor(compress_type)
+        unpacked = packed if decompressor is None else decompressor.decompress(packed)
+        assert unpacked == data
+    decompress_seconds = time.time() - started
+
+    return (sum(len(packed) for packed in compressed), compress_seconds, decompress_seconds)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--members', metavar='N', type=int, default=5,
+                        help='The number of docsN members to sample. (default: 5)')
+    parser.add_argument('--codecs', metavar='CODEC,...', default=DEFAULT_CODECS,
+                        help='Comma-separated codec strings to compare. (default: {0})'.format(DEFAULT_CODECS))
+    parser.add_argument('inpath', metavar='ARCHIVE',
+                        help='Backup archive whose documents are compressed.')
+    args = parser.parse_args()
+
+    samples = sample_members(args.inpath, args.members)
+    total = sum(len(data) for data in samples)
+    if total == 0:
+        print >>sys.stderr, "{0} holds no documents.".format(args.inpath)
+        sys.exit(1)
+    print "Compressing {0:.1f} MB from {1} members of {2}".format(total / 1e6, len(samples), args.inpath)
+
+    print "{0: <12} {1: >8} {2: >14} {3: >16}".format('codec', 'ratio', 'compress MB/s', 'decompress MB/s')
+    for codec in args.codecs.split(','):
+        try:
+            (compress_type, compresslevel) = parse_codec(codec)
+        except Exception as e:
+            print "{0: <12} skipped: {1}".format(codec, e)
+            continue
+        (size, compress_seconds, decompress_seconds) = measure(compress_type, compresslevel, samples)
+        print "{0: <12} {1: >8.2f} {2: >14.1f} {3: >16.1f}".format(
+            codec, total / float(max(size, 1)),
+            total / 1e6 / max(compress_seconds, 1e-9),
+            total / 1e6 / max(decompress_seconds, 1e-9))
+
+
+if __name__ == "__main__":
+    main()
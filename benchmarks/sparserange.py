@@ -0,0 +1,120 @@
+"""
+Compares superfastmatch.util.SparseRange with the linear-scan implementation
+it replaced, for docid range strings with many pieces.
+
+    python benchmarks/sparserange.py [--pieces N] [--lookups N]
+"""
+
+import random
+import timeit
+from copy import deepcopy
+from argparse import ArgumentParser
+from superfastmatch.util import SparseRange
+
+
+def legacy_eliminate_overlap(ranges):
+    def merged(a, b):
+        (t, u) = a
+        (v, w) = b
+        return (min(t, v), max(u, w))
+
+    def compare_bounds(a, b):
+        (t, u) = a
+        (v, w) = b
+        if t == v:
+            return w - u
+        else:
+            return t - v
+
+    def subsumes(a, b):
+        (t, u) = a
+        (v, w) = b
+        return t <= v and w <= u
+
+    def overlaps(a, b):
+        (t, u) = a
+        (v, w) = b
+        return t <= v < u
+
+    old_ranges = deepcopy(ranges)
+    old_ranges.sort(cmp=compare_bounds)
+    new_ranges = []
+
+    while len(old_ranges) > 0:
+        a = old_ranges.pop(0)
+        if len(old_ranges) == 0:
+            new_ranges.append(a)
+        else:
+            while len(old_ranges) > 0:
+                b = old_ranges.pop(0)
+
+                if subsumes(a, b):
+                    pass # ignore b
+                elif subsumes(b, a):
+                    a = deepcopy(b)
+                elif overlaps(a, b):
+                    a = merged(a, b)
+                else:
+                    old_ranges = [b] + old_ranges
+                    break
+            new_ranges.append(a)
+    return new_ranges
+
+
+class LegacySparseRange(object):
+    def __init__(self, ranges):
+        self.ranges = legacy_eliminate_overlap(ranges)
+
+    def __contains__(self, x):
+        for (a, b) in self.ranges:
+            if a <= x <= b:
+                return True
+        return False
+
+
+def random_ranges(pieces, span=50):
+    ranges = []
+    start = 0
+    for _ in range(pieces):
+        start += random.randint(1, span)
+        end = start + random.randint(0, span)
+        ranges.append((start, end))
+        start = end
+    random.shuffle(ranges)
+    return ranges
+
+
+def report(label, legacy, current):
+    print "{0: <24} {1: >10.4f}s {2: >10.4f}s {3: >8.1f}x".format(label, legacy, current, legacy / max(current, 1e-9))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--pieces', metavar='N', type=int, default=5000,
+                        help='The number of ranges in the range string. (default: 5000)')
+    parser.add_argument('--lookups', metavar='N', type=int, default=10000,
+                        help='The number of membership tests to time. (default: 10000)')
+    args = parser.parse_args()
+
+    ranges = random_ranges(args.pieces)
+    upper = max(b for (a, b) in ranges)
+    values = [random.randint(0, upper) for _ in range(args.lookups)]
+
+    print "{0: <24} {1: >11} {2: >11} {3: >9}".format('', 'legacy', 'current', 'speedup')
+    report('construction',
+           min(timeit.repeat(lambda: LegacySparseRange(ranges), number=1, repeat=3)),
+           min(timeit.repeat(lambda: SparseRange(ranges), number=1, repeat=3)))
+
+    legacy = LegacySparseRange(ranges)
+    current = SparseRange(ranges)
+    assert [x in legacy for x in values] == current.contains_many(values)
+    report('__contains__',
+           min(timeit.repeat(lambda: [x in legacy for x in values], number=1, repeat=3)),
+           min(timeit.repeat(lambda: [x in current for x in values], number=1, repeat=3)))
+    report('contains_many',
+           min(timeit.repeat(lambda: [x in legacy for x in values], number=1, repeat=3)),
+           min(timeit.repeat(lambda: current.contains_many(values), number=1, repeat=3)))
+
+
+if __name__ == "__main__":
+    main()
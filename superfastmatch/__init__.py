@@ -1,9 +1,9 @@
 from .client import Client
-from .federated import FederatedClient
+from .federated import FederatedClient, ShardedClient
 from .client import SuperFastMatchError
 try:
     from .djangoclient import from_django_conf, Client as DjangoClient
 except ImportError:
     pass
 from .iterators import DocumentIterator
-from .util import parse_doctype_range
+from .util import parse_doctype_range, DoctypeRange
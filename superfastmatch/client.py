@@ -11,7 +11,7 @@ import urlparse
 import httplib
 import requests
 import json
-from .util import parse_doctype_range
+from .util import DoctypeRange
 
 
 __all__ = ['SuperFastMatchError', 'Client']
@@ -141,11 +141,11 @@ class Client(object):
         url = 'associations/'
         if doctype:
             if not skip_validation:
-                parse_doctype_range(doctype)
+                DoctypeRange.parse(doctype)
             url = '%s%s/' % (url, doctype)
         if doctype2:
             if not skip_validation:
-                parse_doctype_range(doctype2)
+                DoctypeRange.parse(doctype2)
             url = '%s%s/' % (url, doctype2)
         return self._apicall('POST', url, httplib.ACCEPTED)
 
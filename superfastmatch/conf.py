@@ -0,0 +1,89 @@
+"""
+Builds superfastmatch clients from configuration structures like the one
+in `django.conf.settings.SUPERFASTMATCH`, without requiring Django.
+"""
+
+import json
+import superfastmatch.client
+import superfastmatch.federated
+import superfastmatch.loadbalanced
+
+__all__ = ['from_conf', 'load_conf']
+
+
+def _shard_url(shard):
+    return shard['url'] if isinstance(shard, dict) else shard
+
+
+def _shard_client(shard, subconf):
+    if isinstance(shard, dict):
+        return superfastmatch.client.Client(shard['url'],
+                                            parse_response=shard.get('parse_response', subconf.get('parse_response', True)))
+    return superfastmatch.client.Client(shard, parse_response=subconf.get('parse_response', True))
+
+
+def _basic_client(conf):
+    params = dict((key, conf[key]) for key in ('url', 'username', 'password', 'parse_response', 'timeout')
+                  if key in conf)
+    return superfastmatch.client.Client(**params)
+
+
+def _load_balanced_client(replicas):
+    return superfastmatch.loadbalanced.LoadBalancedClient([_basic_client(params) for params in replicas])
+
+
+def from_conf(conf):
+    """
+    Instantiates a superfastmatch client object based on the structure of `conf`.
+
+    A dict yields a basic client, configured by its 'url', 'username',
+    'password', 'parse_response' and 'timeout' keys, or a load balanced client
+    if it has a 'replicas' key listing such dicts. A list of dicts returns a
+    federated client, as described by superfastmatch.djangoclient.from_django_conf;
+    its entries may also have a 'replicas' key in place of 'url'. A tuple of
+    dicts yields a load balanced client.
+    """
+    if isinstance(conf, dict):
+        if 'replicas' in conf:
+            return _load_balanced_client(conf['replicas'])
+        return _basic_client(conf)
+    elif isinstance(conf, list):
+        clients_by_url = dict()
+        clients = dict()
+        for subconf in conf:
+            for doctype in subconf['doctypes']:
+                if 'shards' in subconf:
+                    urlkey = tuple(_shard_url(shard) for shard in subconf['shards'])
+                elif 'replicas' in subconf:
+                    urlkey = ('replicas',) + tuple(params['url'] for params in subconf['replicas'])
+                else:
+                    urlkey = subconf['url']
+                c = clients_by_url.get(urlkey)
+                if c is None:
+                    if 'shards' in subconf:
+                        c = superfastmatch.federated.ShardedClient([_shard_client(shard, subconf)
+                                                                    for shard in subconf['shards']])
+                    elif 'replicas' in subconf:
+                        c = _load_balanced_client(subconf['replicas'])
+                    else:
+                        c = superfastmatch.client.Client(subconf['url'],
+                                                         parse_response=subconf.get('parse_response', True))
+                    clients_by_url[urlkey] = c
+                clients[doctype] = c
+
+        if not clients:
+            raise Exception('Configuration for federated client contained no valid configurations.')
+        return superfastmatch.federated.FederatedClient(clients)
+    elif isinstance(conf, tuple):
+        return _load_balanced_client(conf)
+    raise Exception('Unrecognized client configuration: {0!r}'.format(conf))
+
+
+def load_conf(path):
+    """
+    Instantiates a client from a JSON file holding a configuration structure.
+    Since JSON has no tuples, use a dict with a 'replicas' key for a load
+    balanced client.
+    """
+    with open(path, 'rb') as conffile:
+        return from_conf(json.load(conffile))
@@ -1,6 +1,5 @@
 import superfastmatch.client
-import superfastmatch.federated
-import superfastmatch.loadbalanced
+import superfastmatch.conf
 from django.conf import settings
 
 __all__ = ['Client', 'from_django_conf']
@@ -32,31 +31,19 @@ def from_django_conf(confkey='default'):
     If the value is a dict, a basic client is returned. A list of dicts
     returns a federated client. In this case each dict is expected to
     have a key 'doctypes' that maps to a list of doctypes on that server.
-    Finally, a tuple of dicts will yield a load balanced client. In 
-    this case the servers are expected to contain exactly the same content.
+    A dict with a 'shards' key (a list of URLs or dicts with a 'url' key)
+    in place of 'url' spreads those doctypes across the listed servers
+    by docid, using a sharded client. Never reorder the shards of a
+    populated doctype; the order determines where each document lives.
+    Finally, a tuple of dicts, or a dict with a 'replicas' key listing
+    them, will yield a load balanced client. In this case the servers are
+    expected to contain exactly the same content.
     """
 
     conf = settings.SUPERFASTMATCH[confkey]
-    if isinstance(conf, dict):
+    if isinstance(conf, dict) and 'replicas' not in conf:
         return Client(confkey)
-    elif isinstance(conf, list):
-        clients_by_url = dict()
-        clients = dict()
-        for subconf in conf:
-            for doctype in subconf['doctypes']:
-                c = clients_by_url.get(subconf['url'])
-                if c is None:
-                    c = superfastmatch.client.Client(subconf['url'],
-                                                     parse_response=subconf.get('parse_response', True))
-                    clients_by_url[subconf['url']] = c
-                clients[doctype] = c
-
-        if not clients:
-            raise Exception('Django config for federated client {confkey} contained no valid configurations.'.format(confkey=confkey))
-        return superfastmatch.federated.FederatedClient(clients)
-    elif isinstance(conf, tuple):
-        clients = [superfastmatch.Client(url=params.get('url'), parse_response=params.get('parse_response')) for params in conf]
-        return superfastmatch.loadbalanced.LoadBalancedClient(clients)
+    return superfastmatch.conf.from_conf(conf)
 
 if __name__ == "__main__":
     client = Client()
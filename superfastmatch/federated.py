@@ -5,8 +5,87 @@ import gevent
 import gevent.pool
 from copy import deepcopy
 from .client import SuperFastMatchError
-from .iterators import FederatedDocumentIterator
-from .util import merge_doctype_mappings
+from .iterators import FederatedDocumentIterator, ShardedDocumentIterator
+from .util import merge_doctype_mappings, stable_hash, DoctypeRange
+
+def page_documents(dociter, order_by, limit):
+    """
+    Builds a `GET /document/` style response from the first `limit` documents
+    of `dociter`. Only the 'next' cursor is provided.
+    """
+    results = {
+        'success': True,
+        'cursors': { 'current': '', 'first': '', 'last': '', 'previous': '', 'next': '' },
+        'rows': []
+    }
+    for doc in dociter:
+        results['rows'].append(doc)
+        if len(results['rows']) >= (limit or 10):
+            break
+
+    try:
+        nextdoc = dociter.next()
+        results['cursors']['next'] = ('{%s}:{doctype}:{docid}' % ((order_by or '').lstrip('-') or 'doctype')).format(**nextdoc)
+    except StopIteration:
+        # Leave 'next' cursor as ''
+        pass
+    return results
+
+
+def merge_search_responses(responses):
+    """
+    Combines the responses of searches dispatched to several servers into a
+    single response. Failed responses (None or success == False) are skipped
+    unless all of them failed, in which case a SuperFastMatchError is raised.
+    """
+    empty_documents_map = {
+        'documents': {
+            'metaData': {
+                'fields': []
+            },
+            'rows': []
+        }
+    }
+    combined_response = {}
+    successes = []
+
+    for response in responses:
+        if response is None or response.get('success') == False:
+            logging.warn("Constituent search failed.")
+            continue
+
+        successes.append(response['success'])
+        if response['success'] == True:
+            if not combined_response:
+                combined_response.update(empty_documents_map)
+
+            if 'uuid' in response and 'uuid' not in combined_response:
+                combined_response['uuid'] = response['uuid']
+            if 'text' in response and 'text' not in combined_response:
+                combined_response['text'] = response['text']
+            if 'url' in response and 'url' not in combined_response:
+                combined_response['url'] = response['url']
+
+            combined_documents = combined_response['documents']
+
+            combined_fields = combined_documents['metaData']['fields']
+            fields = response['documents']['metaData']['fields']
+            for field in fields:
+                if field not in combined_fields:
+                    combined_fields.append(field)
+
+            combined_rows = combined_documents['rows']
+            rows = response['documents']['rows']
+            combined_rows.extend(rows)
+
+    if any(successes):
+        combined_response['success'] = True
+    else:
+        raise SuperFastMatchError("All dispatched search requests failed.",
+                                  None, None, None)
+
+    return combined_response
+
 
 class FederatedClient(object):
     """
@@ -26,6 +105,7 @@ class FederatedClient(object):
         self.client_mapping = client_mapping
         """ `search_mapping`: maps doctype range strings (e.g. 1:2:7) to client objects."""
         self.search_mapping = dict(merge_doctype_mappings(client_mapping))
+        self.range_mapping = {}
         self.pool = gevent.pool.Pool(len(self.search_mapping))
 
     def clients(self):
@@ -39,10 +119,23 @@ class FederatedClient(object):
                                                                                                                 doctypes=self.client_mapping.keys()))
             return self.client_mapping[doctype]
         except ValueError:
-            if doctype not in self.search_mapping:
-                raise Exception('No server mapped to doctype range {range!r}. Mapped ranged: {ranges!r}'.format(range=doctype,
+            return self.range_client(doctype)
+
+    def range_client(self, rangestr):
+        """
+        Returns the client for a doctype range string. Every doctype in the
+        range must be mapped to the same client.
+        """
+        doctypes = DoctypeRange.parse(rangestr)
+        client = self.range_mapping.get(doctypes)
+        if client is None:
+            clients = set(self.client_mapping.get(doctype) for doctype in doctypes)
+            if len(clients) != 1 or None in clients:
+                raise Exception('No server mapped to doctype range {range!r}. Mapped ranged: {ranges!r}'.format(range=rangestr,
                                                                                                                 ranges=self.search_mapping.keys()))
-            return self.search_mapping[doctype]
+            client = clients.pop()
+            self.range_mapping[doctypes] = client
+        return client
 
     def new(self, doctype, text, defer=False, **kwargs):
         return self.client(doctype).new(doctype, text, defer, **kwargs)
@@ -71,86 +164,113 @@ class FederatedClient(object):
                 order_by=order_by,
                 start_at=page)
             
-            results = {
-                'success': True,
-                'cursors': { 'current': '', 'first': '', 'last': '', 'previous': '', 'next': '' },
-                'rows': []
-            }
-            for doc in dociter:
-                results['rows'].append(doc)
-                if len(results['rows']) >= (limit or 10):
-                    break
-
-            try:
-                nextdoc = dociter.next()
-                results['cursors']['next'] = ('{%s}:{doctype}:{docid}' % (order_by.lstrip('-') or 'doctype')).format(**nextdoc)
-            except StopIteration:
-                # Leave 'next' cursor as ''
-                pass
-            return results
+            return page_documents(dociter, order_by, limit)
 
     def search(self, text, doctype=None, **kwargs):
         if doctype:
             return self.client(doctype).search(text, doctype, **kwargs)
         else:
-            empty_documents_map = {
-                'documents': {
-                    'metaData': {
-                        'fields': []
-                    },
-                    'rows': []
-                }
-            }
-            combined_response = {}
-            successes = []
             procs = []
-
             for (doctype_rangestr, client) in self.search_mapping.iteritems():
                 procs.append(self.pool.spawn(self._request, client, doctype_rangestr, text, **kwargs))
-            
-            gevent.joinall(procs)
 
-            for response in (p.value for p in procs):
-                if response is None or response.get('success') == False:
-                    logging.warn("Constituent search failed.")
-                    continue
-
-                successes.append(response['success'])
-                if response['success'] == True:
-                    if not combined_response:
-                        combined_response.update(empty_documents_map)
-
-                    if 'uuid' in response and 'uuid' not in combined_response:
-                        combined_response['uuid'] = response['uuid']
-                    if 'text' in response and 'text' not in combined_response:
-                        combined_response['text'] = response['text']
-                    if 'url' in response and 'url' not in combined_response:
-                        combined_response['url'] = response['url']
-
-                    combined_documents = combined_response['documents']
-                    
-                    combined_fields = combined_documents['metaData']['fields']
-                    fields = response['documents']['metaData']['fields']
-                    for field in fields:
-                        if field not in combined_fields:
-                            combined_fields.append(field)
-                    
-                    combined_rows = combined_documents['rows']
-                    rows = response['documents']['rows']
-                    combined_rows.extend(rows)
-
-            if any(successes):
-                combined_response['success'] = True
-            else:
-                raise SuperFastMatchError("All dispatched search requests failed.",
-                                          None, None, None)
-
-            return combined_response
+            gevent.joinall(procs)
+            return merge_search_responses([p.value for p in procs])
 
     def _request(self, client, doctype_rangestr, text, **kwargs):
         return client.search(text, doctype_rangestr, **kwargs)
 
 
+class ShardedClient(object):
+    """
+    Spreads the documents of one or more doctypes across several servers. Each
+    document lives on exactly one shard, chosen by a stable hash of its docid,
+    so writes and single-document lookups go to one server while searches and
+    listings are dispatched to every shard and the results merged.
+
+    A ShardedClient can be used on its own or as the client for a doctype in a
+    FederatedClient mapping. The order of `clients` determines document
+    placement and must not change once documents have been added.
+
+    Documents on different shards are never associated with each other, since
+    each server only knows about its own documents.
+    """
+
+    def __init__(self, clients):
+        """
+        `clients`: A list of Client objects, one per shard.
+        """
+        if not clients:
+            raise Exception('ShardedClient requires at least one client.')
+        self.shards = list(clients)
+        self.pool = gevent.pool.Pool(len(self.shards))
+
+    def __repr__(self):
+        return u"<ShardedClient(numshards={0})>".format(len(self.shards))
+
+    def shard(self, docid):
+        """
+        Returns the client that owns the document with the given docid.
+
+        >>> sharded = ShardedClient(['a', 'b', 'c'])
+        >>> (sharded.shard(12345), sharded.shard('12345'))
+        ('a', 'a')
+        >>> sorted(set(sharded.shard(docid) for docid in range(100)))
+        ['a', 'b', 'c']
+        """
+        return self.shards[stable_hash(int(docid)) % len(self.shards)]
+
+    def _scatter(self, f):
+        procs = [self.pool.spawn(f, client) for client in self.shards]
+        gevent.joinall(procs)
+        return procs
+
+    def new(self, doctype, text, defer=False, **kwargs):
+        raise SuperFastMatchError("Sharded doctypes require a docid; use add() instead of new().",
+                                  None, None, None)
+
+    def add(self, doctype, docid, text, defer=False, **kwargs):
+        return self.shard(docid).add(doctype, docid, text, defer, **kwargs)
+
+    def delete(self, doctype, docid):
+        return self.shard(docid).delete(doctype, docid)
+
+    def get(self, doctype, docid):
+        return self.shard(docid).get(doctype, docid)
+
+    def document(self, doctype, docid):
+        return self.shard(docid).document(doctype, docid)
+
+    def documents(self, doctype=None, page=None, order_by=None, limit=None):
+        """
+        Mimics the `GET /document/` document listing by merging the listings of
+        every shard. Like FederatedClient.documents() only the 'next' cursor is
+        provided.
+        """
+        order_by = order_by or 'docid'
+        dociter = ShardedDocumentIterator(
+            clients=self.shards,
+            doctype=doctype,
+            order_by=order_by,
+            chunksize=(limit or 10) + 1,
+            start_at=page)
+        return page_documents(dociter, order_by, limit)
+
+    def search(self, text, doctype=None, **kwargs):
+        def _search(client):
+            return client.search(text, doctype, **dict(kwargs))
+        return merge_search_responses([p.value for p in self._scatter(_search)])
+
+    def update_associations(self, doctype=None, doctype2=None, skip_validation=False):
+        def _update(client):
+            return client.update_associations(doctype, doctype2, skip_validation)
+        responses = [p.value for p in self._scatter(_update)]
+        for response in responses:
+            if response is None or response.get('success', False) == False:
+                return response
+        return responses[0]
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
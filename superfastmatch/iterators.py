@@ -3,7 +3,8 @@ from copy import deepcopy
 from .util import merge_doctype_mappings
 from .client import SuperFastMatchError
 
-__all__ = ['DocumentIterator', 'FederatedDocumentIterator', 'FaultTolerantDocumentIterator']
+__all__ = ['DocumentIterator', 'FederatedDocumentIterator', 'FaultTolerantDocumentIterator',
+           'MergedDocumentIterator', 'ShardedDocumentIterator']
 
 log = logging.getLogger(__name__)
 
@@ -180,16 +181,15 @@ class FaultTolerantDocumentIterator(DocumentIterator):
                     self.in_fault = True
 
 
-class FederatedDocumentIterator(object):
-    def __init__(self, client_mapping, order_by, doctype=None, chunksize=100, start_at=None):
+class MergedDocumentIterator(object):
+    """
+    Merges several document iterators into a single iteration. Each of the
+    iterators must already be ordered by `order_by`.
+    """
+    def __init__(self, iterators, order_by):
         self.reverse_order = order_by.startswith('-')
         self.order_by = order_by.lstrip('-')
-
-        self.client_mapping = client_mapping
-        self.search_mapping = dict(merge_doctype_mappings(client_mapping))
-
-        self.iterators = [PeekableIterator(DocumentIterator(client, order_by, doctype or cldoctype, chunksize, start_at))
-                          for (cldoctype, client) in self.search_mapping.iteritems()]
+        self.iterators = [PeekableIterator(it) for it in iterators]
         self.current = None
 
     def __iter__(self):
@@ -222,6 +222,29 @@ class FederatedDocumentIterator(object):
         return it.next()
 
 
+class FederatedDocumentIterator(MergedDocumentIterator):
+    def __init__(self, client_mapping, order_by, doctype=None, chunksize=100, start_at=None):
+        self.client_mapping = client_mapping
+        self.search_mapping = dict(merge_doctype_mappings(client_mapping))
+
+        iterators = [DocumentIterator(client, order_by, doctype or cldoctype, chunksize, start_at)
+                     for (cldoctype, client) in self.search_mapping.iteritems()]
+        super(FederatedDocumentIterator, self).__init__(iterators, order_by)
+
+
+class ShardedDocumentIterator(MergedDocumentIterator):
+    """
+    Iterates over the documents of a doctype range that is spread across
+    several servers, e.g. the shards of a superfastmatch.federated.ShardedClient.
+    """
+    def __init__(self, clients, order_by, doctype=None, chunksize=100, start_at=None):
+        self.clients = clients
+
+        iterators = [DocumentIterator(client, order_by, doctype, chunksize, start_at)
+                     for client in self.clients]
+        super(ShardedDocumentIterator, self).__init__(iterators, order_by)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
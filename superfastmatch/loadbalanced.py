@@ -1,19 +1,207 @@
-import datetime
+import math
+import time
 import logging
 import random
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import gevent
+import gevent.lock
+import gevent.queue
+from .client import SuperFastMatchError
+from .util import queue_depth, ConsistentHashRing, DoctypeRange
+
+
+WRITE_QUORUMS = ('one', 'majority', 'all')
+
+
+class ReplicaState(object):
+    """
+    Latency and load bookkeeping for one of the clients of a LoadBalancedClient.
+    `latency` is an exponentially weighted moving average of call durations in
+    seconds and `outstanding` is the number of calls currently in progress.
+    The most recent durations are also kept in `samples` to estimate latency
+    percentiles.
+    """
+
+    def __init__(self, client, sample_size=100):
+        self.client = client
+        self.latency = None
+        self.outstanding = 0
+        self.last_update = None
+        self.samples = deque(maxlen=sample_size)
+        self.ejected_until = None
+        self.ejections = 0
+        self.last_probe = None
+
+    def ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+    def weight(self, recovery_time, now):
+        """
+        The fraction of calls a replica should receive. It is zero while the
+        replica is ejected and ramps linearly from 10% back up to 100% over
+        `recovery_time` seconds afterwards.
+
+        >>> r = ReplicaState(None)
+        >>> r.weight(60.0, now=100.0)
+        1.0
+        >>> r.ejected_until = 130.0
+        >>> [r.weight(60.0, now) for now in (100.0, 131.0, 160.0, 250.0)]
+        [0.0, 0.1, 0.5, 1.0]
+        """
+        if self.ejected_until is None:
+            return 1.0
+        if now < self.ejected_until:
+            return 0.0
+        if recovery_time <= 0:
+            return 1.0
+        return min(1.0, max(0.1, (now - self.ejected_until) / recovery_time))
+
+    def observe(self, duration, smoothing, now):
+        """
+        Folds a call duration into the moving average, giving it a weight of
+        `smoothing`.
+
+        >>> r = ReplicaState(None)
+        >>> r.observe(1.0, 0.5, now=0.0)
+        >>> r.observe(3.0, 0.5, now=1.0)
+        >>> (r.latency, r.last_update, list(r.samples))
+        (2.0, 1.0, [1.0, 3.0])
+        """
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency = smoothing * duration + (1 - smoothing) * self.latency
+        self.last_update = now
+        self.samples.append(duration)
+
+    def percentile(self, p):
+        """
+        >>> r = ReplicaState(None)
+        >>> for n in range(1, 101): r.samples.append(n)
+        >>> r.percentile(95)
+        95
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+    def decayed_latency(self, decay_time, now):
+        """
+        The latency estimate decays towards zero while the replica is idle so
+        that a replica which was slow once is eventually tried again.
+
+        >>> r = ReplicaState(None)
+        >>> r.observe(2.0, 0.3, now=100.0)
+        >>> [round(r.decayed_latency(10.0, now), 3) for now in (100.0, 110.0, 130.0, 200.0)]
+        [2.0, 0.736, 0.1, 0.0]
+        """
+        if self.latency is None:
+            return 0.0
+        idle = max(now - self.last_update, 0.0)
+        return self.latency * math.exp(-idle / decay_time)
+
+    def score(self, decay_time, now):
+        """
+        >>> r = ReplicaState(None)
+        >>> r.observe(0.5, 0.3, now=0.0)
+        >>> r.outstanding = 3
+        >>> r.score(30.0, now=0.0)
+        2.0
+        """
+        return self.decayed_latency(decay_time, now) * (self.outstanding + 1)
+
 
 class LoadBalancedClient(object):
     """
     Dispatches calls to one of a list of superfastmatch.Client objects
     based on response times from previous calls.
+
+    Each replica's latency is tracked as an exponentially weighted moving
+    average (`smoothing` is the weight given to the newest observation) and
+    multiplied by the number of calls outstanding on it. Each call picks two
+    replicas at random and uses the one with the lower score. While a replica
+    is idle its latency estimate decays with a time constant of `decay_time`
+    seconds so it gets probed again.
+
+    Writes (add and delete) are sent to every replica concurrently and return
+    once `write_quorum` replicas have acknowledged them: 'one', 'majority' or
+    'all'. A write that fails on a replica is remembered in that replica's
+    repair queue and sent again by replay_repairs(). Only the most recent
+    failed write for each document is kept, and a later write to the same
+    document cancels it. Writes to the same document on the same replica,
+    replayed or new, are sent one at a time, so replaying never overwrites
+    newer data. A write the replica rejects (success == False) would be
+    rejected again, so it is not queued for repair but logged and kept in
+    `dead_letters`.
+
+    If `hedge_percentile` is set, reads (get, document, documents and search)
+    are hedged: when the chosen replica has not answered within that
+    percentile of its recent latencies, the request is also sent to a second
+    replica and whichever answers first is used. The slower request is killed.
+    Hedging starts once a replica has `hedge_min_samples` observations. How
+    often hedges fire and win is reported by stats().
+
+    If `health_check_interval` is set, a background greenlet probes every
+    replica that often with a `GET /queue/` (see start_health_checks()). A
+    replica whose probe fails, takes longer than `max_latency` seconds, or
+    reports more than `max_queue_depth` unprocessed commands is ejected for
+    `ejection_time` seconds and then gradually given traffic again over
+    `recovery_time` seconds. Calls are spread over all replicas if every one
+    of them is ejected. A healthy probe also replays the replica's repair
+    queue. Ejections are reported by stats().
+
+    With `affinity` enabled, reads for a doctype (or doctype range string) are
+    routed to the replica that owns it on a consistent hash ring, so each
+    replica keeps a smaller working set in memory. If that replica is ejected
+    the next replica on the ring is used. If it has `affinity_max_outstanding`
+    calls in progress, or its latency is more than `affinity_latency_factor`
+    times that of the fastest other replica, the call is balanced by latency
+    instead. Reads without a doctype are always balanced by latency.
+
+    The bookkeeping is guarded by a lock so a single instance can be shared
+    between threads or greenlets.
     """
 
 
-    def __init__(self, clients):
+    def __init__(self, clients, smoothing=0.3, decay_time=30.0, write_quorum='all',
+                 hedge_percentile=None, hedge_min_samples=20,
+                 health_check_interval=None, max_latency=None, max_queue_depth=None,
+                 ejection_time=30.0, recovery_time=60.0,
+                 affinity=False, affinity_max_outstanding=8, affinity_latency_factor=3.0):
+        if write_quorum not in WRITE_QUORUMS:
+            raise ValueError('write_quorum must be one of {0!r}, not {1!r}'.format(WRITE_QUORUMS, write_quorum))
         self.clients = clients
-        self.first_request = True
-        self.search_times = [0] * len(self.clients)
+        self.smoothing = smoothing
+        self.decay_time = decay_time
+        self.write_quorum = write_quorum
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.health_check_interval = health_check_interval
+        self.max_latency = max_latency
+        self.max_queue_depth = max_queue_depth
+        self.ejection_time = ejection_time
+        self.recovery_time = recovery_time
+        self.ejection_log = deque(maxlen=100)
+        self.affinity = affinity
+        self.affinity_max_outstanding = affinity_max_outstanding
+        self.affinity_latency_factor = affinity_latency_factor
+        self.affinity_hits = 0
+        self.affinity_fallbacks = 0
+        self.ring = ConsistentHashRing(range(len(clients))) if affinity else None
+        self.health_checker = None
+        self.replicas = [ReplicaState(client) for client in self.clients]
+        self.repairs = [OrderedDict() for client in self.clients]
+        self.dead_letters = deque(maxlen=100)
+        self.write_locks = {}
+        self.lock = threading.Lock()
         self.last_client = None
+        if self.health_check_interval is not None:
+            self.start_health_checks()
 
     def __repr__(self):
         return u"<LoadBalancedClient(numclients={0})>".format(len(self.clients))
@@ -24,25 +212,15 @@ class LoadBalancedClient(object):
         return self._balanced(_new)
 
     def add(self, doctype, docid, text, defer=False, *args, **kwargs):
-        results = [client.add(doctype, docid, text, defer, *args, **kwargs)
-                   for client in self.clients]
-        for result in results:
-            if result.get('success', False) == False:
-                return result
-        return results[0]
+        return self._replicated('add', (doctype, docid, text, defer) + args, kwargs)
 
     def delete(self, doctype, docid, *args, **kwargs):
-        results = [client.delete(doctype, docid, *args, **kwargs)
-                   for client in self.clients]
-        for result in results:
-            if result.get('success', False) == False:
-                return result
-        return results[0]
+        return self._replicated('delete', (doctype, docid) + args, kwargs)
 
     def get(self, doctype, docid):
         def _get(client):
             return client.get(doctype, docid)
-        return self._balanced(_get)
+        return self._balanced(_get, hedge=True, affinity_key=doctype)
 
     def document(self, doctype, docid):
         return self.get(doctype, docid)
@@ -50,12 +228,12 @@ class LoadBalancedClient(object):
     def documents(self, doctype=None, page=None, order_by=None, limit=None):
         def _documents(client):
             return client.documents(doctype, page, order_by, limit)
-        return self._balanced(_documents)
+        return self._balanced(_documents, hedge=True, affinity_key=doctype)
 
     def search(self, text, doctype=None, **kwargs):
         def _search(client):
-            return client.search(text, doctype, **kwargs)
-        return self._balanced(_search)
+            return client.search(text, doctype, **dict(kwargs))
+        return self._balanced(_search, hedge=True, affinity_key=doctype)
 
     def queue(self):
         """
@@ -67,20 +245,461 @@ class LoadBalancedClient(object):
         approach you need to query each individual server.
         """
         return self.clients[-1].queue()
-    
-    def _balanced(self, f):
-        if self.first_request:
-            client_index = random.randint(0, len(self.clients) - 1)
-            self.first_request = False
+
+    def least_loaded(self):
+        """
+        Probes every replica and returns the client with the fewest unprocessed
+        commands in its queue, breaking ties by latency. Replicas that fail the
+        probe are ejected as by check_health() and only chosen if every replica
+        is ejected. Long sequential reads, such as a backup, can use the result
+        directly to stay off the busier replicas.
+        """
+        self.check_health()
+        now = time.time()
+        with self.lock:
+            candidates = ([index for (index, replica) in enumerate(self.replicas) if not replica.ejected(now)]
+                          or range(len(self.replicas)))
+            def load(index):
+                replica = self.replicas[index]
+                probe = replica.last_probe or {}
+                depth = probe.get('queue_depth')
+                return (depth if depth is not None else float('inf'),
+                        replica.score(self.decay_time, now))
+            return self.clients[min(candidates, key=load)]
+
+    def stats(self):
+        """
+        Returns a dict describing the state of the load balancer and each of its
+        replicas. `ejection_log` lists the most recent ejection decisions and
+        `dead_letters` the most recent writes rejected by a replica.
+        """
+        now = time.time()
+        with self.lock:
+            return {
+                'hedges_fired': self.hedges_fired,
+                'hedges_won': self.hedges_won,
+                'affinity_hits': self.affinity_hits,
+                'affinity_fallbacks': self.affinity_fallbacks,
+                'ejection_log': list(self.ejection_log),
+                'dead_letters': list(self.dead_letters),
+                'replicas': [{
+                    'client': repr(replica.client),
+                    'latency': replica.latency,
+                    'outstanding': replica.outstanding,
+                    'pending_repairs': len(self.repairs[client_index]),
+                    'ejected': replica.ejected(now),
+                    'ejected_until': replica.ejected_until,
+                    'ejections': replica.ejections,
+                    'weight': replica.weight(self.recovery_time, now),
+                    'last_probe': replica.last_probe
+                } for (client_index, replica) in enumerate(self.replicas)]
+            }
+
+    def start_health_checks(self, interval=None):
+        """
+        Starts probing the replicas in a background greenlet every `interval`
+        seconds (default: `health_check_interval`).
+        """
+        interval = interval or self.health_check_interval
+        if interval is None:
+            raise ValueError('A health check interval is required.')
+        if self.health_checker is None:
+            self.health_checker = gevent.spawn(self._health_check_loop, interval)
+
+    def stop_health_checks(self):
+        if self.health_checker is not None:
+            self.health_checker.kill(block=False)
+            self.health_checker = None
+
+    def check_health(self):
+        """
+        Probes every replica once, ejecting the unhealthy ones.
+
+        >>> class Replica(object):
+        ...     def __init__(self, depth): self.depth = depth
+        ...     def queue(self): return {'rows': [{'status': 'Queued'}] * self.depth}
+        >>> lb = LoadBalancedClient([Replica(0), Replica(50)], max_queue_depth=10)
+        >>> lb.check_health()
+        >>> [(replica['ejected'], replica['last_probe']['queue_depth']) for replica in lb.stats()['replicas']]
+        [(False, 0), (True, 50)]
+        >>> lb.least_loaded() is lb.clients[0]
+        True
+        """
+        gevent.joinall([gevent.spawn(self._probe, client_index)
+                        for client_index in range(len(self.clients))])
+
+    def _health_check_loop(self, interval):
+        while True:
+            self.check_health()
+            gevent.sleep(interval)
+
+    def _probe(self, client_index):
+        replica = self.replicas[client_index]
+        probe = {'time': time.time(), 'latency': None, 'queue_depth': None, 'error': None}
+        reason = None
+        try:
+            # Called directly rather than through _call(): a GET /queue/ is much
+            # cheaper than the calls being balanced, so its timing is kept out
+            # of the latency estimate and the hedging samples.
+            response = replica.client.queue()
+            probe['latency'] = time.time() - probe['time']
+            probe['queue_depth'] = queue_depth(response)
+            if self.max_latency is not None and probe['latency'] > self.max_latency:
+                reason = 'latency {0:.3f}s exceeds {1}s'.format(probe['latency'], self.max_latency)
+            elif self.max_queue_depth is not None and probe['queue_depth'] > self.max_queue_depth:
+                reason = 'queue depth {0} exceeds {1}'.format(probe['queue_depth'], self.max_queue_depth)
+        except Exception as e:
+            probe['error'] = str(e)
+            reason = 'probe failed: {0}'.format(e)
+
+        now = time.time()
+        with self.lock:
+            replica.last_probe = probe
+            if reason is not None:
+                if not replica.ejected(now):
+                    replica.ejections += 1
+                    self.ejection_log.append({'time': now, 'client': repr(replica.client), 'reason': reason})
+                replica.ejected_until = now + self.ejection_time
+        if reason is not None:
+            logging.warn('Ejecting client {0} for {1}s: {2}'.format(client_index, self.ejection_time, reason))
+        elif self.repairs[client_index]:
+            self.replay_repairs(client_index)
+
+    def pending_repairs(self):
+        """Returns the number of failed writes waiting to be replayed on each replica."""
+        with self.lock:
+            return [len(repairs) for repairs in self.repairs]
+
+    def replay_repairs(self, client_index=None):
+        """
+        Sends the writes in each replica's repair queue (or only that of the
+        given replica) again, oldest first. A write is skipped if a newer write
+        to the same document has been sent in the meantime. A replica's replay
+        stops at the first write that fails outright, since the replica is most
+        likely still unavailable; a write the replica rejects is dead-lettered
+        and the replay carries on. Returns the number of writes repaired.
+
+        >>> class Replica(object):
+        ...     def __init__(self): (self.up, self.texts) = (False, {})
+        ...     def add(self, doctype, docid, text, defer):
+        ...         if not self.up: raise IOError('down')
+        ...         if not text: return {'success': False, 'error': 'empty'}
+        ...         self.texts[docid] = text
+        ...         return {'success': True}
+        >>> lb = LoadBalancedClient([Replica(), Replica()], write_quorum='one')
+        >>> lb.clients[0].up = True
+        >>> [lb.add(1, docid, text)['success'] for (docid, text) in [(1, ''), (2, 'old'), (3, 'text')]]
+        [False, True, True]
+        >>> lb.pending_repairs()
+        [0, 3]
+        >>> lb.clients[1].up = True
+        >>> lb.add(1, 2, 'new')['success']
+        True
+        >>> lb.replay_repairs(), lb.pending_repairs(), lb.clients[1].texts
+        (1, [0, 0], {2: 'new', 3: 'text'})
+        >>> [(letter['client'], letter['key'], letter['error']) for letter in lb.stats()['dead_letters']]
+        [(0, (1, 1), 'empty'), (1, (1, 1), 'empty')]
+        """
+        repaired = 0
+        for (index, repairs) in enumerate(self.repairs):
+            if client_index is not None and index != client_index:
+                continue
+            with self.lock:
+                pending = list(repairs.items())
+            for (key, write) in pending:
+                with self._ordered(index, key):
+                    with self.lock:
+                        if repairs.get(key) is not write:
+                            # Superseded by a newer write while waiting.
+                            continue
+                    (method, args, kwargs) = write
+                    (succeeded, result) = self._write(index, method, args, kwargs)
+                    if isinstance(result, Exception):
+                        break
+                    with self.lock:
+                        del repairs[key]
+                        if not succeeded:
+                            self._dead_letter(index, key, write, result)
+                if succeeded:
+                    repaired += 1
+        return repaired
+
+    @contextmanager
+    def _ordered(self, client_index, key):
+        """
+        Holds the lock for writes to document `key` on one replica, so that a
+        replayed write cannot cross a newer one on the wire.
+        """
+        with self.lock:
+            entry = self.write_locks.setdefault((client_index, key), [gevent.lock.Semaphore(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.write_locks[(client_index, key)]
+
+    def _dead_letter(self, client_index, key, write, response):
+        """Records a write rejected by a replica. Called with the lock held."""
+        (method, args, kwargs) = write
+        self.dead_letters.append({'time': time.time(), 'client': client_index, 'key': key,
+                                  'method': method, 'error': response.get('error')})
+        logging.warn('Client {0} rejected {1} of {2!r}: {3}'.format(client_index, method, key,
+                                                                   response.get('error')))
+
+    def _required_acks(self):
+        n = len(self.clients)
+        return {'one': 1, 'majority': n // 2 + 1, 'all': n}[self.write_quorum]
+
+    def _write(self, client_index, method, args, kwargs):
+        """
+        Sends a single write to one replica, returning a (succeeded, result) pair.
+        The result is the exception raised if the call failed outright.
+        """
+        def _method(client):
+            return getattr(client, method)(*args, **kwargs)
+        _method.__name__ = method
+        try:
+            result = self._call(client_index, _method)
+        except Exception as e:
+            logging.warn('Write {0} to client {1} failed: {2}'.format(method, client_index, e))
+            return (False, e)
+        return (result.get('success', False) != False, result)
+
+    def _replicated(self, method, args, kwargs):
+        """
+        Sends a write to every replica and returns once the write quorum is met.
+
+        >>> class Replica(object):
+        ...     def __init__(self, up): self.up = up
+        ...     def add(self, doctype, docid, text, defer):
+        ...         if not self.up: raise IOError('down')
+        ...         return {'success': True}
+        >>> replicas = [Replica(True), Replica(True), Replica(False)]
+        >>> lb = LoadBalancedClient(replicas, write_quorum='majority')
+        >>> lb.add(1, 1, 'text')
+        {'success': True}
+        >>> lb.pending_repairs()
+        [0, 0, 1]
+        >>> lb.write_quorum = 'all'
+        >>> lb.add(1, 2, 'text')
+        Traceback (most recent call last):
+        ...
+        SuperFastMatchError: Write quorum (all) not met for add of (1, 2): down
+        >>> replicas[2].up = True
+        >>> lb.replay_repairs(), lb.pending_repairs()
+        (2, [0, 0, 0])
+        """
+        key = (args[0], args[1])
+        write = (method, args, kwargs)
+        acknowledgements = gevent.queue.Queue()
+
+        def _replicate(client_index):
+            with self._ordered(client_index, key):
+                (succeeded, result) = self._write(client_index, method, args, kwargs)
+                with self.lock:
+                    repairs = self.repairs[client_index]
+                    repairs.pop(key, None)
+                    if isinstance(result, Exception):
+                        repairs[key] = write
+                    elif not succeeded:
+                        self._dead_letter(client_index, key, write, result)
+            acknowledgements.put((succeeded, result))
+
+        for client_index in range(len(self.clients)):
+            gevent.spawn(_replicate, client_index)
+
+        required = self._required_acks()
+        successes = []
+        failures = []
+        while len(successes) + len(failures) < len(self.clients):
+            (succeeded, result) = acknowledgements.get()
+            if succeeded:
+                successes.append(result)
+                if len(successes) >= required:
+                    return successes[0]
+            else:
+                failures.append(result)
+                if len(self.clients) - len(failures) < required:
+                    break
+
+        for result in failures:
+            if not isinstance(result, Exception):
+                return result
+        raise SuperFastMatchError('Write quorum ({0}) not met for {1} of {2!r}: {3}'.format(
+                                      self.write_quorum, method, key, failures[-1]),
+                                  None, None, None)
+
+    def _candidates(self, exclude, now):
+        """
+        Returns the replicas eligible for a call. Ejected replicas are left out
+        and recovering replicas are included in proportion to their weight.
+        """
+        candidates = [index for index in range(len(self.replicas)) if index not in exclude]
+        with self.lock:
+            weights = dict((index, self.replicas[index].weight(self.recovery_time, now))
+                           for index in candidates)
+        healthy = [index for index in candidates if weights[index] > 0]
+        admitted = [index for index in healthy if random.random() < weights[index]]
+        return admitted or healthy or candidates
+
+    def _preferred(self, affinity_key, candidates):
+        """
+        Returns the first eligible replica on the hash ring for `affinity_key`, or
+        None if that replica is too busy to take the call.
+        """
+        for client_index in self.ring.preference(affinity_key):
+            if client_index in candidates:
+                break
         else:
-            lowest = min(self.search_times)
-            client_index = self.search_times.index(lowest)
-        client = self.clients[client_index]
-        t1 = datetime.datetime.now()
-        result = f(client)
-        self.last_client = client
-        t2 = datetime.datetime.now()
-        dur = t2 - t1
-        self.search_times[client_index] = dur.total_seconds()
-        logging.debug('Dispatched to {func} on client {clnt} which took {tm}'.format(func=f.__name__, clnt=client_index, tm=self.search_times[client_index]))
-        return result
+            return None
+
+        with self.lock:
+            replica = self.replicas[client_index]
+            overloaded = replica.outstanding >= self.affinity_max_outstanding
+            latencies = [self.replicas[index].latency for index in candidates
+                         if index != client_index and self.replicas[index].latency is not None]
+            if replica.latency is not None and latencies:
+                overloaded = overloaded or replica.latency > self.affinity_latency_factor * min(latencies)
+            if overloaded:
+                self.affinity_fallbacks += 1
+                return None
+            self.affinity_hits += 1
+        return client_index
+
+    def _choose(self, exclude=(), affinity_key=None):
+        """
+        Picks the replica for a call: the lower scoring of two candidates drawn
+        at random. A slow replica never wins against a fast one, until it has
+        been idle long enough for its latency estimate to decay.
+
+        >>> lb = LoadBalancedClient(['slow', 'fast', 'fast'], decay_time=30.0)
+        >>> now = time.time()
+        >>> lb.replicas[0].observe(2.0, 0.3, now)
+        >>> lb.replicas[1].observe(0.01, 0.3, now)
+        >>> lb.replicas[2].observe(0.01, 0.3, now)
+        >>> sorted(set(lb._choose() for i in range(50)))
+        [1, 2]
+        >>> lb._choose(exclude=[2])
+        1
+        >>> lb.replicas[0].last_update = now - 300.0
+        >>> lb._choose(exclude=[2])
+        0
+        """
+        now = time.time()
+        candidates = self._candidates(exclude, now)
+        if self.ring is not None and affinity_key is not None:
+            try:
+                # Equivalent range strings such as 1:2 and 1-2 share a replica.
+                affinity_key = str(DoctypeRange.parse(affinity_key))
+            except Exception:
+                affinity_key = str(affinity_key)
+            preferred = self._preferred(affinity_key, candidates)
+            if preferred is not None:
+                return preferred
+        if len(candidates) == 1:
+            return candidates[0]
+        (a, b) = random.sample(candidates, 2)
+        with self.lock:
+            score_a = self.replicas[a].score(self.decay_time, now)
+            score_b = self.replicas[b].score(self.decay_time, now)
+        return a if score_a <= score_b else b
+
+    def _call(self, client_index, f):
+        replica = self.replicas[client_index]
+        with self.lock:
+            replica.outstanding += 1
+        t1 = time.time()
+        failed = False
+        cancelled = False
+        try:
+            return f(replica.client)
+        except gevent.GreenletExit:
+            # Killed because a hedged request won. The call did not finish, so
+            # its duration says nothing about the replica's latency.
+            cancelled = True
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            t2 = time.time()
+            dur = t2 - t1
+            with self.lock:
+                replica.outstanding -= 1
+                if failed:
+                    # Errors often return quickly; don't let them attract traffic.
+                    dur = max(dur, 2 * (replica.latency or dur))
+                if not cancelled:
+                    replica.observe(dur, self.smoothing, t2)
+            logging.debug('Dispatched to {func} on client {clnt} which took {tm}'.format(func=f.__name__, clnt=client_index, tm=dur))
+
+    def _hedge_delay(self, client_index):
+        if self.hedge_percentile is None or len(self.clients) < 2:
+            return None
+        with self.lock:
+            replica = self.replicas[client_index]
+            if len(replica.samples) < self.hedge_min_samples:
+                return None
+            return replica.percentile(self.hedge_percentile)
+
+    def _balanced(self, f, hedge=False, affinity_key=None):
+        """
+        Calls `f` with the client of the chosen replica, hedging it on a second
+        replica if `hedge` is set and the first is slow to answer.
+
+        >>> class Replica(object):
+        ...     def __init__(self, name, delay): (self.name, self.delay) = (name, delay)
+        ...     def get(self, doctype, docid):
+        ...         gevent.sleep(self.delay)
+        ...         return self.name
+        >>> lb = LoadBalancedClient([Replica('slow', 1.0), Replica('fast', 0)], hedge_percentile=90)
+        >>> lb._hedge_delay(0) is None
+        True
+        >>> for n in range(20): lb.replicas[0].observe(0.01, lb.smoothing, time.time())
+        >>> lb.replicas[1].observe(0.1, lb.smoothing, time.time())
+        >>> lb._hedge_delay(0)
+        0.01
+        >>> lb.get(1, 1)
+        'fast'
+        >>> (lb.hedges_fired, lb.hedges_won, len(lb.replicas[0].samples))
+        (1, 1, 20)
+        """
+        client_index = self._choose(affinity_key=affinity_key)
+        delay = self._hedge_delay(client_index) if hedge else None
+        if delay is None:
+            result = self._call(client_index, f)
+            self.last_client = self.clients[client_index]
+            return result
+
+        primary = gevent.spawn(self._call, client_index, f)
+        primary.join(timeout=delay)
+        if primary.ready():
+            self.last_client = self.clients[client_index]
+            return primary.get()
+
+        hedge_index = self._choose(exclude=(client_index, ))
+        with self.lock:
+            self.hedges_fired += 1
+        logging.debug('Hedging {func} on client {clnt} after {tm}'.format(func=f.__name__, clnt=hedge_index, tm=delay))
+        secondary = gevent.spawn(self._call, hedge_index, f)
+
+        pending = [primary, secondary]
+        while pending:
+            finished = gevent.wait(pending, count=1)[0]
+            pending.remove(finished)
+            if finished.successful():
+                for proc in pending:
+                    proc.kill(block=False)
+                if finished is secondary:
+                    with self.lock:
+                        self.hedges_won += 1
+                    self.last_client = self.clients[hedge_index]
+                else:
+                    self.last_client = self.clients[client_index]
+                return finished.value
+        # Both requests failed; report the error from the first choice.
+        return primary.get()
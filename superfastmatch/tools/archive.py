@@ -0,0 +1,723 @@
+"""
+The backup archive format shared by the backup, restore and
+inspection tools.
+
+An archive is a ZIP file holding a series of `docsN` members, each a
+stream of pickled documents, and a pickled `meta` member. Since version
+2 the metadata includes a manifest of the `docsN` members under the
+'chunks' key, recording for each member its doctypes, docid bounds,
+document count, uncompressed size and SHA-1 checksum. Readers use the
+manifest to skip members that cannot contain the documents they want.
+Archives written before the manifest existed are read as version 1,
+with the bounds of every member unknown.
+
+Since version 3 each archive is identified by a random 'snapshot' id and
+holds a `digests` member recording a digest of every document listed on
+the server at backup time. An incremental archive is taken against the
+digests of an earlier one, whose snapshot id it records as
+'base_snapshot'. It stores only the documents that are new or changed
+since then, and its `changes` member lists the keys it stores and the
+tombstones of the documents deleted since then. The header of the digests
+records whether they cover each document's text ('content') or only the
+attributes it is listed with ('metadata'); digests written before the
+header recorded this are metadata digests.
+
+The `docsN` members are compressed with the codec named by the 'codec'
+key of the metadata, such as 'deflate:9' or 'bzip2'. The other members
+are always deflated so any reader can describe the archive.
+
+Newer archives also hold an `index` member giving the member and offset
+of every stored document, sorted by docid and doctype. It is stored
+uncompressed so BackupReader can search it in place. For archives
+without one, BackupReader builds the same index into a sidecar file.
+
+Members that are stored uncompressed, such as the `docsN` members of
+archives using the 'stored' codec, are read through a memory map of the
+archive rather than copied through read buffers.
+"""
+
+import os
+import json
+import time
+import zlib
+import heapq
+import struct
+import mmap
+import hashlib
+import itertools
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from contextlib import closing
+from collections import OrderedDict
+from tempfile import TemporaryFile
+from ..zipfile27 import (ZipFile, is_zipfile, get_compressor, compression_supported,
+                         ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA)
+from ..util import UnpicklerIterator, DoctypeRange, DocidBitmap
+
+
+ARCHIVE_VERSION = 3
+
+DEFAULT_CODEC = 'deflate'
+
+CODECS = {
+    'stored': ZIP_STORED,
+    'deflate': ZIP_DEFLATED,
+    'bzip2': ZIP_BZIP2,
+    'lzma': ZIP_LZMA
+}
+
+CODEC_LEVELS = {
+    'deflate': range(0, 10),
+    'bzip2': range(1, 10),
+    'lzma': range(0, 10)
+}
+
+INDEX_MAGIC = 'SFMINDEX'
+
+# Magic, snapshot id (or for a sidecar, see sidecar_stamp()) and record count.
+INDEX_HEADER = struct.Struct('>8s32sQ')
+
+# Docid, doctype, member number, offset and length of the pickled document.
+# Packed big-endian so that sorting the records sorts them by docid and doctype.
+INDEX_RECORD = struct.Struct('>IIIQI')
+
+
+def chunk_name(file_number):
+    return 'docs{num}'.format(num=file_number)
+
+
+class ChunkManifest(object):
+    """
+    Accumulates the manifest entry of a `docsN` member as the pickled
+    documents are written to it. `shard` names the server the documents
+    were read from, when a backup spans several servers. `offsets` lists
+    the (docid, doctype, offset, length) of each document for the index.
+    """
+    def __init__(self, name, shard=None):
+        self.name = name
+        self.shard = shard
+        self.offsets = []
+        self.doctypes = set()
+        self.docid_min = None
+        self.docid_max = None
+        self.doc_count = 0
+        self.bytes = 0
+        self.digest = hashlib.sha1()
+
+    def add(self, doc, data):
+        """Records `doc`, whose pickled form `data` was written to the member."""
+        self.offsets.append((doc['docid'], doc['doctype'], self.bytes, len(data)))
+        self.doctypes.add(doc['doctype'])
+        if self.docid_min is None or doc['docid'] < self.docid_min:
+            self.docid_min = doc['docid']
+        if self.docid_max is None or doc['docid'] > self.docid_max:
+            self.docid_max = doc['docid']
+        self.doc_count += 1
+        self.bytes += len(data)
+        self.digest.update(data)
+
+    def entry(self):
+        return {
+            'name': self.name,
+            'doctypes': sorted(self.doctypes),
+            'docid_min': self.docid_min,
+            'docid_max': self.docid_max,
+            'doc_count': self.doc_count,
+            'bytes': self.bytes,
+            'checksum': self.digest.hexdigest(),
+            'shard': self.shard
+        }
+
+
+def parse_codec(codecstr):
+    """
+    Parses a codec string of a codec name optionally followed by a level,
+    e.g. 'stored', 'deflate:9', 'bzip2' or 'lzma:6', into the compression
+    type and level for zipfile27. The level is None if not given.
+
+    >>> parse_codec('stored') == (ZIP_STORED, None)
+    True
+    >>> parse_codec('deflate:9') == (ZIP_DEFLATED, 9)
+    True
+    >>> parse_codec('bzip2:0')
+    Traceback (most recent call last):
+    ...
+    Exception: Invalid level for the bzip2 codec: '0'
+    >>> parse_codec('stored:1')
+    Traceback (most recent call last):
+    ...
+    Exception: Invalid level for the stored codec: '1'
+    """
+    (name, _, level) = codecstr.partition(':')
+    if name not in CODECS:
+        raise Exception('Unknown codec {0!r}. Choose from {1}.'.format(name, ', '.join(sorted(CODECS))))
+    if not compression_supported(CODECS[name]):
+        raise Exception('The {0} codec is not supported by this interpreter.'.format(name))
+    if level == '':
+        return (CODECS[name], None)
+    if not level.isdigit() or int(level) not in CODEC_LEVELS.get(name, []):
+        raise Exception('Invalid level for the {0} codec: {1!r}'.format(name, level))
+    return (CODECS[name], int(level))
+
+
+def compress_chunk(data, compress_type=ZIP_DEFLATED, compresslevel=None):
+    """
+    Compresses the contents of a `docsN` member for ZipFile.writestr_compressed().
+    Returns the compressed data, the CRC-32 of `data` and the seconds spent.
+    This runs in the worker processes of a parallel backup.
+    """
+    started = time.time()
+    compressor = get_compressor(compress_type, compresslevel)
+    if compressor is None:
+        compressed = data
+    else:
+        compressed = compressor.compress(data) + compressor.flush()
+    crc = zlib.crc32(data) & 0xffffffff
+    return (compressed, crc, time.time() - started)
+
+
+def read_metadata(infile):
+    """
+    Reads the `meta` member of an open archive. Version 1 metadata is given
+    a 'chunks' manifest whose bounds are all None.
+    """
+    with closing(infile.open('meta', 'r')) as metafile:
+        metadata = pickle.load(metafile)
+    if 'version' not in metadata:
+        metadata['version'] = 1
+        metadata['chunks'] = [{
+            'name': chunk_name(file_number),
+            'doctypes': None,
+            'docid_min': None,
+            'docid_max': None,
+            'doc_count': None,
+            'bytes': None,
+            'checksum': None
+        } for file_number in range(0, metadata['file_count'])]
+    for chunk in metadata['chunks']:
+        chunk.setdefault('shard', None)
+    metadata.setdefault('codec', DEFAULT_CODEC)
+    metadata.setdefault('snapshot', None)
+    metadata.setdefault('base_snapshot', None)
+    return metadata
+
+
+def chunk_may_match(chunk, docids=None, doctypes=None):
+    """
+    Returns False if the manifest entry `chunk` shows that the member cannot
+    hold any of the given docids (a SparseRange or DocidBitmap) or doctypes
+    (a doctype range string or DoctypeRange).
+
+    >>> from superfastmatch.util import SparseRange
+    >>> chunk = {'doctypes': [1, 3], 'docid_min': 100, 'docid_max': 200}
+    >>> chunk_may_match(chunk, docids=SparseRange([(150, 300)]), doctypes='3-5')
+    True
+    >>> chunk_may_match(chunk, docids=SparseRange([(1, 99), (201, 300)]))
+    False
+    >>> chunk_may_match(chunk, doctypes='2:4-5')
+    False
+    >>> chunk_may_match({'doctypes': None, 'docid_min': None, 'docid_max': None}, SparseRange([(1, 2)]), '9')
+    True
+    """
+    if docids is not None and chunk['docid_min'] is not None:
+        if not docids.intersects(chunk['docid_min'], chunk['docid_max']):
+            return False
+    if doctypes is not None and chunk['doctypes'] is not None:
+        doctypes = DoctypeRange.parse(doctypes)
+        if not any(doctype in doctypes for doctype in chunk['doctypes']):
+            return False
+    return True
+
+
+def matching_chunks(metadata, docids=None, doctypes=None):
+    return [chunk for chunk in metadata['chunks']
+            if chunk_may_match(chunk, docids, doctypes)]
+
+
+def open_member(infile, name):
+    """
+    Opens a member of an open archive for reading. A stored member is read
+    straight from a memory map of the archive.
+    """
+    if infile.getinfo(name).compress_type == ZIP_STORED:
+        return StringIO(infile.mapped(name))
+    return infile.open(name, 'r')
+
+
+def iter_chunk(infile, chunk):
+    """Yields each document stored in one `docsN` member."""
+    with closing(open_member(infile, chunk['name'])) as docsfile:
+        for doc in UnpicklerIterator(pickle.Unpickler(docsfile)):
+            yield doc
+
+
+def iter_archive(infile, metadata, docids=None, doctypes=None):
+    """
+    Yields each document stored in an open archive, skipping the members that
+    cannot hold the given docids or doctypes. Documents in the members that
+    are read are not filtered.
+    """
+    for chunk in matching_chunks(metadata, docids, doctypes):
+        for doc in iter_chunk(infile, chunk):
+            yield doc
+
+
+def chunk_checksum(infile, chunk, blocksize=1 << 20):
+    """Computes the SHA-1 checksum of the uncompressed contents of a member."""
+    digest = hashlib.sha1()
+    with closing(open_member(infile, chunk['name'])) as docsfile:
+        while True:
+            data = docsfile.read(blocksize)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def document_digest(docmeta, text=None):
+    """
+    Digests the attributes a document is listed with by the server, which
+    include its length in characters but not its text. The server-assigned
+    'id' is left out. Given the document's `text`, the digest covers it as
+    well; otherwise edits that change neither the length nor any other
+    attribute of a document are not detected.
+
+    >>> doc = {'doctype': 1, 'docid': 2, 'characters': 5, 'id': 7}
+    >>> document_digest(doc) == document_digest(dict(doc, id=8, text=u'hello'))
+    True
+    >>> document_digest(doc, u'hello') == document_digest(doc, u'jello')
+    False
+    """
+    attrs = dict((k, v) for (k, v) in docmeta.iteritems() if k not in ('id', 'text'))
+    if text is not None:
+        attrs['text'] = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return hashlib.sha1(json.dumps(attrs, sort_keys=True)).hexdigest()
+
+
+def write_digests_header(outfile, snapshot, doctype_rangestr, kind='content'):
+    outfile.write(pickle.dumps({'snapshot': snapshot, 'doctypes': doctype_rangestr, 'digests': kind},
+                               pickle.HIGHEST_PROTOCOL))
+
+
+def write_digest(outfile, doc, digest):
+    outfile.write(pickle.dumps((doc['doctype'], doc['docid'], digest),
+                               pickle.HIGHEST_PROTOCOL))
+
+
+def load_digests(path):
+    """
+    Reads the document digests recorded by a backup, either from the archive
+    itself or from a digests file written alongside it. Returns the header,
+    holding the snapshot id and the doctype range string of the backup and
+    the kind of digests ('content' or 'metadata'), and a dict mapping
+    (doctype, docid) to digest.
+    """
+    if is_zipfile(path):
+        with closing(ZipFile(path, 'r')) as infile:
+            if 'digests' not in infile.namelist():
+                raise Exception('{0} holds no document digests. It was written before incremental backups were supported.'.format(path))
+            with closing(infile.open('digests', 'r')) as digestfile:
+                return _read_digests(digestfile)
+    with open(path, 'rb') as digestfile:
+        return _read_digests(digestfile)
+
+
+def _read_digests(infile):
+    entries = UnpicklerIterator(pickle.Unpickler(infile))
+    header = entries.next()
+    header.setdefault('digests', 'metadata')
+    return (header, dict(((doctype, docid), digest) for (doctype, docid, digest) in entries))
+
+
+def read_changes(infile, metadata):
+    """
+    Returns the `changes` member of an incremental archive as a dict holding
+    the 'stored' and 'tombstones' lists of (doctype, docid) keys, or None for
+    a full archive.
+    """
+    if metadata['base_snapshot'] is None:
+        return None
+    with closing(infile.open('changes', 'r')) as changesfile:
+        return pickle.load(changesfile)
+
+
+def check_chain(paths, metadatas):
+    """
+    Ensures that each archive after the first is an incremental backup taken
+    against the one before it.
+
+    >>> full = {'snapshot': 'a', 'base_snapshot': None}
+    >>> incremental = {'snapshot': 'b', 'base_snapshot': 'a'}
+    >>> check_chain(['full', 'incr'], [full, incremental])
+    >>> check_chain(['full', 'incr', 'incr2'], [full, incremental, incremental])
+    Traceback (most recent call last):
+    ...
+    Exception: incr2 was not taken against incr.
+    >>> check_chain(['full', 'full2'], [full, full])
+    Traceback (most recent call last):
+    ...
+    Exception: full2 is a full backup. Only the first archive of a chain may be.
+    """
+    for (index, metadata) in enumerate(metadatas[1:], 1):
+        if metadata['base_snapshot'] is None:
+            raise Exception('{0} is a full backup. Only the first archive of a chain may be.'.format(paths[index]))
+        if metadata['base_snapshot'] != metadatas[index - 1]['snapshot']:
+            raise Exception('{0} was not taken against {1}.'.format(paths[index], paths[index - 1]))
+
+
+class DocumentIndexWriter(object):
+    """
+    Collects the index records of an archive's documents and writes them out
+    sorted by docid and doctype. Records are sorted in runs of `run_size`
+    held in temporary files, which are merged when the index is written.
+
+    >>> index = DocumentIndexWriter(run_size=2)
+    >>> for (docid, doctype) in [(5, 1), (2, 2), (9, 1), (2, 1), (7, 3)]:
+    ...     index.add(docid, doctype, 0, 0, 0)
+    >>> outfile = StringIO()
+    >>> index.write(outfile, 'x' * 32)
+    >>> records = buffer(outfile.getvalue(), INDEX_HEADER.size)
+    >>> [INDEX_RECORD.unpack_from(records, n * INDEX_RECORD.size)[:2] for n in range(index.count)]
+    [(2, 1), (2, 2), (5, 1), (7, 3), (9, 1)]
+    """
+    def __init__(self, run_size=1000000):
+        self.run_size = run_size
+        self.records = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, docid, doctype, member, offset, length):
+        self.records.append(INDEX_RECORD.pack(docid, doctype, member, offset, length))
+        self.count += 1
+        if len(self.records) >= self.run_size:
+            self._flush()
+
+    def add_chunk(self, member, manifest):
+        """Records the documents of the `member`th `docsN` member."""
+        for (docid, doctype, offset, length) in manifest.offsets:
+            self.add(docid, doctype, member, offset, length)
+
+    def _flush(self):
+        self.records.sort()
+        run = TemporaryFile()
+        run.write(''.join(self.records))
+        run.seek(0)
+        self.runs.append(run)
+        self.records = []
+
+    def write(self, outfile, snapshot):
+        """Writes the index of an archive with the given snapshot id to `outfile`."""
+        outfile.write(INDEX_HEADER.pack(INDEX_MAGIC, snapshot or '', self.count))
+        self.records.sort()
+        if not self.runs:
+            outfile.write(''.join(self.records))
+            return
+        try:
+            runs = [_iter_records(run) for run in self.runs] + [iter(self.records)]
+            buf = []
+            for record in heapq.merge(*runs):
+                buf.append(record)
+                if len(buf) >= 4096:
+                    outfile.write(''.join(buf))
+                    buf = []
+            outfile.write(''.join(buf))
+        finally:
+            for run in self.runs:
+                run.close()
+
+
+def _iter_records(infile, blocksize=4096):
+    while True:
+        block = infile.read(INDEX_RECORD.size * blocksize)
+        if not block:
+            return
+        for start in xrange(0, len(block), INDEX_RECORD.size):
+            yield block[start:start + INDEX_RECORD.size]
+
+
+class _CountingReader(object):
+    """Wraps a file, counting the bytes read from it so far in `pos`."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        data = self.fileobj.readline()
+        self.pos += len(data)
+        return data
+
+
+def sidecar_stamp(infile, metadata):
+    """
+    Identifies the archive a sidecar index is built from: by its snapshot id,
+    or for archives written before snapshot ids were added, by a digest of the
+    archive's size and modification time and the checksum of its metadata.
+    """
+    if metadata['snapshot']:
+        return metadata['snapshot']
+    stat = os.fstat(infile.fp.fileno())
+    return hashlib.sha1('{0}:{1!r}:{2}'.format(stat.st_size, stat.st_mtime,
+                                               infile.getinfo('meta').CRC)).hexdigest()[:32]
+
+
+def build_index(infile, metadata, outpath):
+    """
+    Reads every document of an open archive to build its document index,
+    writing it to the sidecar file `outpath`.
+    """
+    index = DocumentIndexWriter()
+    for (member, chunk) in enumerate(metadata['chunks']):
+        with closing(open_member(infile, chunk['name'])) as docsfile:
+            counter = _CountingReader(docsfile)
+            unpickler = pickle.Unpickler(counter)
+            while True:
+                offset = counter.pos
+                try:
+                    doc = unpickler.load()
+                except EOFError:
+                    break
+                index.add(doc['docid'], doc['doctype'], member, offset, counter.pos - offset)
+
+    tmppath = outpath + '.tmp'
+    with open(tmppath, 'wb') as outfile:
+        index.write(outfile, sidecar_stamp(infile, metadata))
+    os.rename(tmppath, outpath)
+
+
+class BackupReader(object):
+    """
+    Random access to the documents of a backup archive through its document
+    index. The index is read from the archive's `index` member, or else from
+    the sidecar file `index_path` (by default the archive path followed by
+    '.index'), which is built by reading the whole archive if it is missing
+    or describes another archive.
+
+    The index is memory mapped and binary searched in place. Documents in
+    stored members are unpickled straight from a memory map of the archive.
+    Other members are decompressed into memory; the `cache_members` most
+    recently used are kept, so further lookups in them are cheap.
+
+    >>> import shutil, tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmpdir, 'backup.zip')
+    >>> docs = [{'doctype': doctype, 'docid': docid, 'text': 'doc {0}'.format(docid)}
+    ...         for (doctype, docid) in [(1, 3), (2, 1), (1, 2)]]
+    >>> with ZipFile(path, 'w') as outfile:
+    ...     outfile.writestr('docs0', ''.join(pickle.dumps(doc) for doc in docs))
+    ...     outfile.writestr('meta', pickle.dumps({'file_count': 1, 'doc_count': 3}))
+    >>> reader = BackupReader(path)
+    >>> (reader.get(1, 2)['text'], reader.get(2, 2))
+    ('doc 2', None)
+    >>> [(doc['doctype'], doc['docid']) for doc in reader.iter_by_docid()]
+    [(2, 1), (1, 2), (1, 3)]
+    >>> (reader.count(doctypes='1'), sorted(reader.docids(doctypes='2')))
+    (2, [1])
+    >>> (reader.index_path == path + '.index', os.path.exists(reader.index_path))
+    (True, True)
+    >>> reader.close()
+
+    The sidecar index is rebuilt when the archive is replaced:
+
+    >>> docs[0]['text'] = 'rewritten'
+    >>> with ZipFile(path, 'w') as outfile:
+    ...     outfile.writestr('docs0', ''.join(pickle.dumps(doc) for doc in docs))
+    ...     outfile.writestr('meta', pickle.dumps({'file_count': 1, 'doc_count': 3}))
+    >>> reader = BackupReader(path)
+    >>> [doc['text'] for doc in reader.iter_by_docid()]
+    ['doc 1', 'doc 2', 'rewritten']
+    >>> reader.close()
+    >>> shutil.rmtree(tmpdir)
+    """
+    def __init__(self, path, index_path=None, cache_members=1):
+        self.path = path
+        self.infile = ZipFile(path, 'r')
+        self.metadata = read_metadata(self.infile)
+        self.mapped_members = {}
+        self.cache_members = cache_members
+        self.cached_members = OrderedDict()
+
+        if 'index' in self.infile.namelist():
+            if self.infile.getinfo('index').compress_type != ZIP_STORED:
+                raise Exception('The index of {0} is compressed.'.format(path))
+            self.index_path = None
+            index = self.infile.mapped('index')
+        else:
+            self.index_path = index_path or path + '.index'
+            if not self._sidecar_is_current():
+                build_index(self.infile, self.metadata, self.index_path)
+            with open(self.index_path, 'rb') as indexfile:
+                index = buffer(mmap.mmap(indexfile.fileno(), 0, access=mmap.ACCESS_READ))
+
+        (magic, snapshot, self.index_count) = INDEX_HEADER.unpack_from(index)
+        if magic != INDEX_MAGIC:
+            raise Exception('{0} is not a document index.'.format(self.index_path or path))
+        self.index = buffer(index, INDEX_HEADER.size)
+
+    def _sidecar_is_current(self):
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, 'rb') as indexfile:
+            header = indexfile.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return False
+        (magic, snapshot, count) = INDEX_HEADER.unpack(header)
+        return (magic == INDEX_MAGIC
+                and snapshot.rstrip('\0') == sidecar_stamp(self.infile, self.metadata)
+                and count == self.metadata['doc_count'])
+
+    def close(self):
+        self.infile.close()
+        self.index = None
+        self.mapped_members = {}
+        self.cached_members.clear()
+
+    def _record(self, position):
+        return INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)
+
+    def _records(self, start=0):
+        """Yields the index records from the `start`th onwards."""
+        for position in xrange(start, self.index_count):
+            yield INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)
+
+    def _bisect(self, docid, doctype=0):
+        """Returns the position of the first record at or after (docid, doctype)."""
+        (lo, hi) = (0, self.index_count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[:2] < (docid, doctype):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matching_records(self, docids=None, doctypes=None):
+        if doctypes is not None:
+            doctypes = DoctypeRange.parse(doctypes)
+        start = self._bisect(docids.min) if docids is not None and docids.min is not None else 0
+        for record in self._records(start):
+            if docids is not None:
+                if docids.max is None or record[0] > docids.max:
+                    return
+                if record[0] not in docids:
+                    continue
+            if doctypes is not None and record[1] not in doctypes:
+                continue
+            yield record
+
+    def _member_name(self, member):
+        return self.metadata['chunks'][member]['name']
+
+    def _load(self, member, offset, length):
+        """Unpickles the document at `offset` in the `member`th `docsN` member."""
+        name = self._member_name(member)
+        if self.infile.getinfo(name).compress_type == ZIP_STORED:
+            if name not in self.mapped_members:
+                self.mapped_members[name] = self.infile.mapped(name)
+            return pickle.load(StringIO(buffer(self.mapped_members[name], offset, length)))
+        data = self.cached_members.pop(name, None)
+        if data is None:
+            # Release the least recently used member before decompressing the next.
+            while len(self.cached_members) >= self.cache_members:
+                self.cached_members.popitem(last=False)
+            data = self.infile.read(name)
+        self.cached_members[name] = data
+        return pickle.load(StringIO(buffer(data, offset, length)))
+
+    def get(self, doctype, docid):
+        """Returns the stored document, or None if the archive does not hold it."""
+        (doctype, docid) = (int(doctype), int(docid))
+        position = self._bisect(docid, doctype)
+        if position == self.index_count:
+            return None
+        (rdocid, rdoctype, member, offset, length) = self._record(position)
+        if (rdocid, rdoctype) != (docid, doctype):
+            return None
+        return self._load(member, offset, length)
+
+    def iter(self, docids=None, doctypes=None):
+        """
+        Yields the stored documents with the given docids (a SparseRange or
+        DocidBitmap) and doctypes (a range string or DoctypeRange). They
+        are read member by member, in the order they are stored.
+        """
+        records = sorted((member, offset, length) for (docid, doctype, member, offset, length)
+                         in self._matching_records(docids, doctypes))
+        for (member, group) in itertools.groupby(records, key=lambda record: record[0]):
+            name = self._member_name(member)
+            if self.infile.getinfo(name).compress_type == ZIP_STORED:
+                for (member, offset, length) in group:
+                    yield self._load(member, offset, length)
+                continue
+            with closing(self.infile.open(name, 'r')) as docsfile:
+                position = 0
+                for (member, offset, length) in group:
+                    _skip(docsfile, offset - position)
+                    yield pickle.loads(docsfile.read(length))
+                    position = offset + length
+
+    def iter_by_docid(self, docids=None, doctypes=None):
+        """
+        Yields the stored documents with the given docids and doctypes in
+        order of docid, then doctype. Each member is written in docid order,
+        so this reads the members of a backup of one server in turn. A backup
+        of several servers interleaves the members of each, and needs a
+        `cache_members` of at least the number of servers to read each member
+        once.
+        """
+        for (docid, doctype, member, offset, length) in self._matching_records(docids, doctypes):
+            yield self._load(member, offset, length)
+
+    def count(self, docids=None, doctypes=None):
+        """Counts the stored documents with the given docids and doctypes."""
+        if docids is None and doctypes is None:
+            return self.index_count
+        return sum(1 for record in self._matching_records(docids, doctypes))
+
+    def docids(self, doctypes=None):
+        """
+        Returns a DocidBitmap of the docids in the index, limited to those
+        stored under `doctypes`. No documents are read.
+        """
+        return DocidBitmap(record[0] for record in self._matching_records(doctypes=doctypes))
+
+    def stats(self):
+        """Describes the archive and its index as a dict."""
+        doctypes = {}
+        for (docid, doctype, member, offset, length) in self._records():
+            doctypes[doctype] = doctypes.get(doctype, 0) + 1
+        docs_members = [self.infile.getinfo(chunk['name']) for chunk in self.metadata['chunks']]
+        return {
+            'path': self.path,
+            'version': self.metadata['version'],
+            'snapshot': self.metadata['snapshot'],
+            'base_snapshot': self.metadata['base_snapshot'],
+            'codec': self.metadata['codec'],
+            'members': len(docs_members),
+            'doc_count': self.index_count,
+            'doctypes': doctypes,
+            'docid_min': self._record(0)[0] if self.index_count else None,
+            'docid_max': self._record(self.index_count - 1)[0] if self.index_count else None,
+            'bytes': sum(zinfo.file_size for zinfo in docs_members),
+            'compressed_bytes': sum(zinfo.compress_size for zinfo in docs_members),
+            'index': self.index_path or 'archive',
+            'index_bytes': INDEX_HEADER.size + self.index_count * INDEX_RECORD.size
+        }
+
+
+def _skip(fileobj, count, blocksize=1 << 20):
+    while count > 0:
+        data = fileobj.read(min(count, blocksize))
+        if not data:
+            break
+        count -= len(data)
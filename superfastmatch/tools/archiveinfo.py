@@ -0,0 +1,65 @@
+"""
+Describes the contents of a backup archive using its manifest.
+With --docids or --doctypes only the archive members that may hold
+matching documents are listed. --verify recomputes the checksum of
+each listed member.
+"""
+
+import sys
+import os
+from argparse import ArgumentParser
+from contextlib import closing
+from superfastmatch.zipfile27 import ZipFile
+from superfastmatch.tools.archive import read_metadata, matching_chunks, chunk_checksum
+from superfastmatch.tools.routines import parse_docid_filter
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--docids', metavar='DOCID_RANGE', action='store',
+                        help='Only list members that may hold these docids, e.g. 1-10,20. May also be the path of a docid bitmap file.')
+    parser.add_argument('--doctypes', metavar='RANGE_STRING', action='store',
+                        help='Only list members that may hold these doctypes, e.g. 1:4-7:10')
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='Recompute the checksum of each listed member.')
+    parser.add_argument('inpath', metavar='INPATH', action='store',
+                        help='Backup file to read.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.inpath) == False:
+        print >>sys.stderr, "Unable to find {inpath}.".format(**vars(args))
+        sys.exit(1)
+
+    docids = parse_docid_filter(args.docids) if args.docids else None
+    failures = 0
+    with closing(ZipFile(args.inpath, 'r')) as infile:
+        metadata = read_metadata(infile)
+        print "Archive version {version}: {doc_count} documents in {file_count} members spanning doctypes {doctypes}".format(**metadata)
+        if metadata['version'] < 2:
+            print "This archive has no manifest; member contents are unknown."
+        if metadata['base_snapshot'] is not None:
+            print "Snapshot {snapshot}, incremental against snapshot {base_snapshot}".format(**metadata)
+        elif metadata['snapshot'] is not None:
+            print "Snapshot {snapshot}".format(**metadata)
+
+        rowfmt = "{0: <10} {1: >10} {2: >12} {3: >12} {4: >12}  {5}"
+        print rowfmt.format("Member", "Documents", "Bytes", "First docid", "Last docid", "Doctypes")
+        for chunk in matching_chunks(metadata, docids, args.doctypes):
+            doctypes = ','.join(str(d) for d in chunk['doctypes']) if chunk['doctypes'] is not None else '?'
+            print rowfmt.format(chunk['name'],
+                                chunk['doc_count'] if chunk['doc_count'] is not None else '?',
+                                chunk['bytes'] if chunk['bytes'] is not None else '?',
+                                chunk['docid_min'] if chunk['docid_min'] is not None else '?',
+                                chunk['docid_max'] if chunk['docid_max'] is not None else '?',
+                                doctypes + ('  ({0})'.format(chunk['shard']) if chunk['shard'] is not None else ''))
+            if args.verify and chunk['checksum'] is not None:
+                if chunk_checksum(infile, chunk) != chunk['checksum']:
+                    print >>sys.stderr, "Checksum mismatch in {0}".format(chunk['name'])
+                    failures += 1
+
+    if failures > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
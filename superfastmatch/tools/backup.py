@@ -1,39 +1,94 @@
 """
 This command is the complement of the restore command. It 
-iterates over documents on the server, pickles them, then dumps
-them into a series of approximately fixed-sized files and then
-zips those files up with a small metadata file containing the 
+iterates over documents on the server, pickles them and streams
+them into a series of approximately fixed-sized compressed members
+of a zip archive, along with a small metadata file containing the
 number of documents, etc.
+
+Federated, sharded and load balanced deployments can be backed up with
+--conf or --django-conf, in which case all of the servers are read at once.
 """
 
+# Threads are left unpatched. A single server's chunks are compressed by a
+# multiprocessing pool, whose helper threads must be real threads, and the
+# chunks of several servers by a gevent thread pool of real threads.
+from gevent import monkey
+monkey.patch_all(thread=False)
+
 import sys
 import os
 from argparse import ArgumentParser
 from superfastmatch.client import Client
+from superfastmatch.conf import load_conf
 from superfastmatch.tools.routines import backup
+from superfastmatch.tools.telemetry import Telemetry, open_stats
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('--url', metavar='URL', type=str,
-                        default='http://127.0.0.1:8080', action='store',
-                        help='URL of the Superfastmatch server.')
+    servers = parser.add_mutually_exclusive_group()
+    servers.add_argument('--url', metavar='URL', type=str,
+                         default='http://127.0.0.1:8080', action='store',
+                         help='URL of the Superfastmatch server.')
+    servers.add_argument('--conf', metavar='PATH', action='store',
+                         help=('JSON file describing the servers to back up, in the form of '
+                               + 'settings.SUPERFASTMATCH. All of the servers are backed up at once.'))
+    servers.add_argument('--django-conf', dest='django_conf', metavar='CONFKEY', action='store',
+                         help=('Back up the servers configured by this key of settings.SUPERFASTMATCH. '
+                               + 'Requires DJANGO_SETTINGS_MODULE.'))
     parser.add_argument('--overwrite', default=False, action='store_true',
                         help='Overwrite OUTFILE if it already exists.')
     parser.add_argument('--chunksize', metavar='BYTES', action='store', type=int, default=10000000,
-                        help=('The approximate number of bytes (uncompressed) to store in each chunk. ' 
-                              + 'Lower numbers trade performance for less memory usage. (default: 10M)'))
+                        help=('The approximate number of bytes (uncompressed) to store in each chunk. '
+                              + 'Smaller chunks let restores skip more of the archive. (default: 10M)'))
+    parser.add_argument('--jobs', metavar='N', action='store', type=int, default=1,
+                        help=('Compress N chunks at a time while the next chunk is fetched, in separate '
+                              + 'processes for one server or in threads for several. Holds N+1 chunks in '
+                              + 'memory. (default: 1)'))
+    parser.add_argument('--codec', metavar='CODEC', action='store', default='deflate',
+                        help=('Compression of the stored documents: stored, deflate, bzip2 or lzma, '
+                              + 'optionally followed by a level, e.g. deflate:1 or bzip2:9. (default: deflate)'))
+    parser.add_argument('--base', metavar='PATH', action='store',
+                        help=('Take an incremental backup against this earlier backup, or its digests file, '
+                              + 'storing only the documents that changed since it was taken. Every text is '
+                              + 'still read to be digested.'))
+    parser.add_argument('--digests-file', dest='digests_file', metavar='PATH', action='store',
+                        help='Also write the document digests to PATH, for use as --base by later backups.')
+    parser.add_argument('--metadata-digests', dest='metadata_digests', action='store_true',
+                        help=('Digest only the attributes documents are listed with, so incremental backups '
+                              + 'fetch just the documents whose attributes changed. Edits that keep a '
+                              + "document's length are missed, and restoring the chain may bring back stale "
+                              + 'texts. The base must use the same kind of digests.'))
+    parser.add_argument('--stats', metavar='PATH', action='store',
+                        help=('Append throughput statistics to PATH as JSON lines, ending with a summary line. '
+                              + '- writes them to standard error.'))
+    parser.add_argument('--stats-interval', dest='stats_interval', metavar='SECONDS', action='store',
+                        type=float, default=10.0,
+                        help='The number of seconds between lines of statistics. (default: 10)')
     parser.add_argument('doctypes', metavar='RANGE_STRING', action='store',
                         help='Range string of doctypes to backup, e.g. 1:4-7:10')
     parser.add_argument('outpath', metavar='OUTPATH', action='store',
                         help='File to write to.')
     args = parser.parse_args()
 
+    if args.base is not None and os.path.exists(args.base) == False:
+        print >>sys.stderr, "Unable to find {base}.".format(**vars(args))
+        sys.exit(1)
+
     if os.path.exists(args.outpath) and args.overwrite == False:
         print >>sys.stderr, "{outpath} already exists.".format(**vars(args))
         sys.exit(1)
 
-    sfm = Client(args.url, parse_response=True)
-    backup(sfm, args.outpath, args.doctypes, chunksize=args.chunksize)
+    if args.conf is not None:
+        sfm = load_conf(args.conf)
+    elif args.django_conf is not None:
+        from superfastmatch.djangoclient import from_django_conf
+        sfm = from_django_conf(args.django_conf)
+    else:
+        sfm = Client(args.url, parse_response=True)
+    backup(sfm, args.outpath, args.doctypes, chunksize=args.chunksize, jobs=args.jobs,
+           base_path=args.base, digests_path=args.digests_file, codec=args.codec,
+           telemetry=Telemetry('backup', open_stats(args.stats), args.stats_interval),
+           metadata_digests=args.metadata_digests)
 
 if __name__ == "__main__":
     main()
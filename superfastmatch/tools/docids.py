@@ -0,0 +1,73 @@
+"""
+Builds a compressed set of docids and optionally combines it with
+others. Each SOURCE may be the URL of a Superfastmatch server, a
+backup archive, a docid bitmap file written by this command, or a
+docid range string. The result can be saved with --output and
+passed to the restore command's --docids option.
+
+For example, to find the documents on one server but not another:
+
+    python -m superfastmatch.tools.docids --doctypes 1-3 \\
+        http://a:8080 --andnot http://b:8080 --output missing.bitmap
+"""
+
+import os
+import sys
+from argparse import ArgumentParser
+from zipfile import is_zipfile
+from superfastmatch.client import Client
+from superfastmatch.iterators import DocumentIterator
+from superfastmatch.util import DocidBitmap
+from superfastmatch.tools.routines import archive_docids, parse_docid_filter
+
+
+def load_source(source, doctypes):
+    if source.startswith('http://') or source.startswith('https://'):
+        docs = DocumentIterator(Client(source, parse_response=True),
+                                order_by='docid', doctype=doctypes, chunksize=1000)
+        return DocidBitmap.from_documents(docs)
+    if os.path.isfile(source) and is_zipfile(source):
+        return archive_docids(source, doctypes)
+    docids = parse_docid_filter(source)
+    if isinstance(docids, DocidBitmap):
+        return docids
+    return DocidBitmap.from_ranges(docids.ranges)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--doctypes', metavar='RANGE_STRING', action='store',
+                        help='Range string of doctypes to read from server and archive sources, e.g. 1:4-7:10')
+    parser.add_argument('--and', dest='operations', metavar='SOURCE', action='append', default=[],
+                        type=lambda source: ('and', source),
+                        help='Keep only docids also found in SOURCE.')
+    parser.add_argument('--or', dest='operations', metavar='SOURCE', action='append',
+                        type=lambda source: ('or', source),
+                        help='Add the docids found in SOURCE.')
+    parser.add_argument('--andnot', dest='operations', metavar='SOURCE', action='append',
+                        type=lambda source: ('andnot', source),
+                        help='Remove the docids found in SOURCE.')
+    parser.add_argument('--output', metavar='PATH', action='store',
+                        help='File to write the resulting docid bitmap to.')
+    parser.add_argument('source', metavar='SOURCE', action='store',
+                        help='Server URL, backup archive, docid bitmap file or docid range string.')
+    args = parser.parse_args()
+
+    docids = load_source(args.source, args.doctypes)
+    for (operation, source) in args.operations:
+        other = load_source(source, args.doctypes)
+        if operation == 'and':
+            docids = docids & other
+        elif operation == 'or':
+            docids = docids | other
+        else:
+            docids = docids - other
+
+    print >>sys.stderr, "{0} docids".format(len(docids))
+    if args.output:
+        with open(args.output, 'wb') as outfile:
+            docids.dump(outfile)
+
+
+if __name__ == "__main__":
+    main()
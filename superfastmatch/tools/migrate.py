@@ -0,0 +1,53 @@
+"""
+Copies a range of doctypes directly from one Superfastmatch
+server to another, optionally deleting them from the source
+once the copy has been verified. Unlike a backup followed by
+a restore, documents stream from server to server without
+being written to disk.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from argparse import ArgumentParser
+from superfastmatch.client import Client
+from superfastmatch.tools.routines import migrate
+from superfastmatch.tools.throttle import add_throttle_arguments, throttle_from_args
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--concurrency', metavar='N', action='store', type=int, default=10,
+                        help='The number of simultaneous requests to make to each server. (default: 10)')
+    parser.add_argument('--checkpoint', metavar='PATH', action='store',
+                        help='File used to record progress. If it exists the migration resumes where it left off.')
+    parser.add_argument('--delete-source', dest='delete_source', default=False, action='store_true',
+                        help='Delete the documents from the source server once the copy has been verified.')
+    add_throttle_arguments(parser)
+    parser.add_argument('--dryrun', default=False, action='store_true',
+                        help='Don\'t actually copy the documents. Just read them from the source server.')
+    parser.add_argument('doctypes', metavar='RANGE_STRING', action='store',
+                        help='Range string of doctypes to migrate, e.g. 1:4-7:10')
+    parser.add_argument('source', metavar='SOURCE_URL', action='store',
+                        help='URL of the Superfastmatch server to copy documents from.')
+    parser.add_argument('destination', metavar='DESTINATION_URL', action='store',
+                        help='URL of the Superfastmatch server to copy documents to.')
+    args = parser.parse_args()
+
+    throttle = throttle_from_args(parser, args)
+
+    src = Client(args.source, parse_response=True)
+    dst = Client(args.destination, parse_response=True)
+    results = migrate(src, dst, args.doctypes,
+                      concurrency=args.concurrency,
+                      checkpoint_path=args.checkpoint,
+                      delete_source=args.delete_source,
+                      dryrun=args.dryrun,
+                      throttle=throttle)
+    if results['failed'] > 0 or results.get('verified') == False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
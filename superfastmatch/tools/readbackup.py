@@ -0,0 +1,67 @@
+"""
+Reads individual documents from a backup archive without restoring it,
+using the archive's document index. Archives written before the index
+was added get a sidecar index file, built on first use.
+
+    get DOCTYPE DOCID   prints a document as JSON
+    list                prints the matching documents, one JSON object per line
+    count               prints the number of matching documents
+    stats               describes the archive and its index
+"""
+
+import sys
+import os
+import json
+from argparse import ArgumentParser
+from contextlib import closing
+from superfastmatch.tools.archive import BackupReader
+from superfastmatch.tools.routines import parse_docid_filter
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--index', metavar='PATH', action='store',
+                        help='Sidecar index file for archives without an index. (default: INPATH.index)')
+    parser.add_argument('inpath', metavar='INPATH', action='store',
+                        help='Backup file to read.')
+    commands = parser.add_subparsers(dest='command')
+
+    get = commands.add_parser('get', help='Print a document as JSON.')
+    get.add_argument('doctype', metavar='DOCTYPE', type=int, action='store')
+    get.add_argument('docid', metavar='DOCID', type=int, action='store')
+
+    for (name, help) in [('list', 'Print the matching documents as JSON, one per line.'),
+                         ('count', 'Print the number of matching documents.')]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument('--docids', metavar='DOCID_RANGE', action='store',
+                             help='Only include these docids, e.g. 1-10,20. May also be the path of a docid bitmap file.')
+        command.add_argument('--doctypes', metavar='RANGE_STRING', action='store',
+                             help='Only include these doctypes, e.g. 1:4-7:10')
+
+    commands.add_parser('stats', help='Describe the archive and its index.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.inpath) == False:
+        print >>sys.stderr, "Unable to find {inpath}.".format(**vars(args))
+        sys.exit(1)
+
+    with closing(BackupReader(args.inpath, args.index)) as reader:
+        if args.command == 'get':
+            doc = reader.get(args.doctype, args.docid)
+            if doc is None:
+                print >>sys.stderr, "Document ({doctype}, {docid}) is not in the archive.".format(**vars(args))
+                sys.exit(1)
+            print json.dumps(doc, sort_keys=True)
+        elif args.command == 'stats':
+            print json.dumps(reader.stats(), sort_keys=True, indent=2)
+        else:
+            docids = parse_docid_filter(args.docids) if args.docids else None
+            if args.command == 'count':
+                print reader.count(docids, args.doctypes)
+            else:
+                for doc in reader.iter(docids, args.doctypes):
+                    print json.dumps(doc, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
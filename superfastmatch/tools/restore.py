@@ -5,12 +5,16 @@ Superfastmatch server, possibly translating doctypes
 in the process.
 """
 
+from gevent import monkey
+monkey.patch_all()
 
 import sys
 import os
 from argparse import ArgumentParser
 from superfastmatch.client import Client
 from superfastmatch.tools.routines import restore
+from superfastmatch.tools.telemetry import Telemetry, open_stats
+from superfastmatch.tools.throttle import add_throttle_arguments, throttle_from_args
 
 
 def main():
@@ -20,20 +24,57 @@ def main():
     parser.add_argument('--doctypes', metavar='MAPPING', action='store',
                         help='A string describing how to translate doctypes during the restore process.')
     parser.add_argument('--docids', metavar='DOCID_RANGE', action='store',
-                        help='A string describing which docids to restore. E.g. 1-10,20,30-31 would restore 13 documents.')
+                        help=('A string describing which docids to restore. E.g. 1-10,20,30-31 would restore 13 documents. '
+                              + 'May also be the path of a docid bitmap file.'))
+    parser.add_argument('--doctype-filter', dest='doctype_filter', metavar='RANGE_STRING', action='store',
+                        help='Range string of the stored doctypes to restore, e.g. 1:4-7:10')
+    parser.add_argument('--concurrency', metavar='N', action='store', type=int, default=1,
+                        help='The number of documents to post to the server at once. (default: 1)')
+    parser.add_argument('--window', metavar='N', action='store', type=int,
+                        help='The maximum number of documents to read ahead of the requests in progress. (default: 4 * concurrency)')
+    parser.add_argument('--read-ahead', dest='read_ahead', metavar='N', action='store', type=int, default=2,
+                        help=('The number of archive members to decompress ahead of the documents being restored, '
+                              + 'in a background thread. Holds N+1 members in memory. 0 disables it. (default: 2)'))
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N', action='store', type=int, default=1,
+                        help='The number of documents handed to a posting greenlet at once. (default: 1)')
+    parser.add_argument('--batch-bytes', dest='batch_bytes', metavar='CHARACTERS', action='store', type=int,
+                        help='Limit each batch to about CHARACTERS characters of text. (default: no limit)')
+    parser.add_argument('--batch-latency', dest='batch_latency', metavar='SECONDS', action='store', type=float,
+                        default=1.0,
+                        help=('Hand a batch over at most SECONDS after its first document was read, even if '
+                              + 'it is not full. (default: 1)'))
+    parser.add_argument('--retry-file', dest='retry_file', metavar='PATH', action='store',
+                        help='Backup file to write documents that fail to restore to.')
+    add_throttle_arguments(parser)
+    parser.add_argument('--stats', metavar='PATH', action='store',
+                        help=('Append throughput statistics to PATH as JSON lines, ending with a summary line. '
+                              + '- writes them to standard error.'))
+    parser.add_argument('--stats-interval', dest='stats_interval', metavar='SECONDS', action='store',
+                        type=float, default=10.0,
+                        help='The number of seconds between lines of statistics. (default: 10)')
     parser.add_argument('--url', metavar='URL', type=str,
                         default='http://127.0.0.1:8080', action='store',
                         help='URL of the Superfastmatch server.')
-    parser.add_argument('inpath', metavar='INPATH', action='store',
-                        help='Backup file to read.')
+    parser.add_argument('inpaths', metavar='INPATH', action='store', nargs='+',
+                        help='Backup file to read, optionally followed by incremental backups taken against it, in order.')
     args = parser.parse_args()
 
-    if os.path.exists(args.inpath) == False:
-        print >>sys.stderr, "Unable to find {inpath}.".format(**vars(args))
-        sys.exit(1)
+    for inpath in args.inpaths:
+        if os.path.exists(inpath) == False:
+            print >>sys.stderr, "Unable to find {0}.".format(inpath)
+            sys.exit(1)
+
+    throttle = throttle_from_args(parser, args)
 
     sfm = Client(args.url, parse_response=True)
-    restore(sfm, args.inpath, docid_rangestr=args.docids, doctype_mappingstr=args.doctypes, dryrun=args.dryrun)
+    counts = restore(sfm, args.inpaths, docid_rangestr=args.docids, doctype_mappingstr=args.doctypes, dryrun=args.dryrun,
+                     concurrency=args.concurrency, window=args.window, retry_path=args.retry_file,
+                     doctype_rangestr=args.doctype_filter, read_ahead=args.read_ahead,
+                     telemetry=Telemetry('restore', open_stats(args.stats), args.stats_interval),
+                     throttle=throttle, batch_size=args.batch_size, batch_bytes=args.batch_bytes,
+                     batch_latency=args.batch_latency)
+    if counts['failed'] > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
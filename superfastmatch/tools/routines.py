@@ -8,17 +8,37 @@ for relative imports.
 
 import os
 import sys
+import json
+import time
+import uuid
+import hashlib
+import itertools
+import shutil
+import multiprocessing
+from collections import deque
+import gevent
+import gevent.pool
+import gevent.queue
+import gevent.threadpool
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
-from tempfile import NamedTemporaryFile
-from ..zipfile27 import ZipFile, ZIP_DEFLATED
+from ..zipfile27 import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT
+from tempfile import TemporaryFile
 from contextlib import closing
 from copy import deepcopy
 import progressbar
-from ..util import ChunkedIterator, UnpicklerIterator, parse_doctype_range, parse_docid_range, SparseRange
-from ..iterators import DocumentIterator
+from ..util import BatchingIterator, DoctypeRange, parse_docid_range, DocidBitmap
+from ..iterators import DocumentIterator, MergedDocumentIterator
+from ..federated import FederatedClient, ShardedClient
+from ..loadbalanced import LoadBalancedClient
+from .telemetry import Telemetry
+from .archive import (ARCHIVE_VERSION, DEFAULT_CODEC, ChunkManifest, chunk_name,
+                      parse_codec, compress_chunk, read_metadata, matching_chunks,
+                      iter_chunk, iter_archive, document_digest, write_digests_header,
+                      write_digest, load_digests, read_changes, check_chain, DocumentIndexWriter,
+                      BackupReader)
 
 
 def prune_document(docmeta):
@@ -33,81 +53,554 @@ def prune_document(docmeta):
     return doc
 
 
-def backup(sfm, outpath, doctype_rangestr=None, chunksize=10000000):
+def _pickled_documents(docs):
+    """Yields (document, pickled document) pairs for the documents to back up."""
+    for docmeta in docs:
+        if not docmeta:
+            print >>sys.stderr, "Dropped empty document."
+            continue
+        try:
+            doc = prune_document(docmeta)
+            yield (doc, pickle.dumps(doc, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            print >>sys.stderr, str(e)
+
+
+def _chunked_documents(documents, chunksize):
     """
-    Reusable routine for a backup tool.
+    Groups (document, pickled document) pairs into lists holding about
+    `chunksize` bytes of pickled documents, one for each `docsN` member.
+    """
+    return BatchingIterator(documents, max_bytes=chunksize, key=lambda (doc, data): len(data))
+
+
+def _record_chunk(outfile, metadata, manifest, index, telemetry):
+    index.add_chunk(metadata['file_count'], manifest)
+    telemetry.count('chunks')
+    telemetry.count('documents', manifest.doc_count)
+    telemetry.count('bytes', manifest.bytes)
+    telemetry.count('compressed_bytes', outfile.getinfo(manifest.name).compress_size)
+    metadata['doctypes'].update(manifest.doctypes)
+    metadata['doc_count'] += manifest.doc_count
+    metadata['chunks'].append(manifest.entry())
+    metadata['file_count'] += 1
+
 
-    The term `chunksize` is used to refer to two different types of chunks. I'm sorry.
-    One usage refers to the number of documents to retrieve from the server at once.
-    The other usage refers to the size of the files stored insize the ZIP archive.
+def _stream_chunks(outfile, documents, chunksize, metadata, index, telemetry, shard=None):
     """
+    Streams the pickled documents straight into compressed `docsN` members,
+    starting a new member once `chunksize` bytes have been written to one.
+    """
+    # A member is closed after the document that takes it past chunksize,
+    # so leave room for that document before the ZIP64 limit is reached.
+    force_zip64 = chunksize * 1.05 > ZIP64_LIMIT
 
-    if doctype_rangestr is not None:
-        # Just ensure that it's valid.
-        parse_doctype_range(doctype_rangestr)
+    docsfile = None
+    for (doc, data) in documents:
+        if docsfile is None:
+            manifest = ChunkManifest(chunk_name(metadata['file_count']), shard)
+            docsfile = outfile.open(manifest.name, 'w', force_zip64=force_zip64)
+        with telemetry.timer('write'):
+            docsfile.write(data)
+        manifest.add(doc, data)
+
+        if manifest.bytes >= chunksize:
+            with telemetry.timer('write'):
+                docsfile.close()
+            docsfile = None
+            print "Wrote backup chunk #{num} containing {count} documents.".format(
+                num=metadata['file_count'], count=manifest.doc_count)
+            _record_chunk(outfile, metadata, manifest, index, telemetry)
 
+    if docsfile is not None:
+        with telemetry.timer('write'):
+            docsfile.close()
+        print "Wrote backup chunk #{num} containing {count} documents.".format(
+            num=metadata['file_count'], count=manifest.doc_count)
+        _record_chunk(outfile, metadata, manifest, index, telemetry)
+
+
+def _compress_chunks(outfile, documents, chunksize, metadata, index, telemetry, jobs, shard=None):
+    """
+    Collects the pickled documents into chunks of about `chunksize` bytes and
+    compresses up to `jobs` chunks at a time in a pool of processes while the
+    next chunk is fetched. The chunks are written to the archive in order.
+    """
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+    totals = {'bytes': 0, 'compressed': 0}
+    started = time.time()
+
+    def write_oldest():
+        (manifest, result) = pending.popleft()
+        with telemetry.timer('compress_wait'):
+            (compressed, crc, seconds) = result.get()
+        telemetry.add_time('compress', seconds)
+        with telemetry.timer('write'):
+            outfile.writestr_compressed(manifest.name, compressed, manifest.bytes, crc)
+        totals['bytes'] += manifest.bytes
+        totals['compressed'] += len(compressed)
+        print "Wrote backup chunk #{num} containing {count} documents, compressed at {rate:.1f} MB/s.".format(
+            num=metadata['file_count'], count=manifest.doc_count,
+            rate=manifest.bytes / 1e6 / max(seconds, 1e-6))
+        _record_chunk(outfile, metadata, manifest, index, telemetry)
+
+    def submit(manifest, buf):
+        if len(pending) >= jobs:
+            write_oldest()
+        pending.append((manifest, pool.apply_async(compress_chunk, (''.join(buf), outfile.compression,
+                                                                    outfile.compresslevel))))
+
+    try:
+        for batch in _chunked_documents(documents, chunksize):
+            manifest = ChunkManifest(chunk_name(metadata['file_count'] + len(pending)), shard)
+            for (doc, data) in batch:
+                manifest.add(doc, data)
+            submit(manifest, [data for (doc, data) in batch])
+        while pending:
+            write_oldest()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - started
+    print "Compressed {mb:.1f} MB to {cmb:.1f} MB at {rate:.1f} MB/s using {jobs} processes.".format(
+        mb=totals['bytes'] / 1e6, cmb=totals['compressed'] / 1e6,
+        rate=totals['bytes'] / 1e6 / max(elapsed, 1e-6), jobs=jobs)
+
+
+def _listed_documents(sfm, doctype_rangestr, digestfile, base_digests, stored,
+                      metadata_digests=False):
+    """
+    Yields the documents to back up, writing the digest of each document listed
+    by the server to `digestfile`. Without `base_digests` every document is
+    yielded. Otherwise only the documents whose digests differ from those in
+    `base_digests` are yielded, and their keys appended to `stored`. Keys are
+    removed from `base_digests` as they are listed, leaving the keys of the
+    documents deleted since the base backup.
+
+    The digests cover the text of every document, which is therefore fetched
+    even when it is not stored. With `metadata_digests` they cover only the
+    listed attributes, and only the texts of the documents stored are fetched.
+    """
     docs = DocumentIterator(sfm,
                             order_by='docid',
                             doctype=doctype_rangestr,
                             chunksize=1000,
-                            fetch_text=True)
+                            fetch_text=base_digests is None or not metadata_digests)
+    for doc in docs:
+        if not doc:
+            yield doc
+            continue
+        digest = document_digest(doc, None if metadata_digests else doc['text'])
+        if base_digests is not None:
+            key = (doc['doctype'], doc['docid'])
+            if base_digests.pop(key, None) == digest:
+                write_digest(digestfile, doc, digest)
+                continue
+            if 'text' not in doc:
+                response = sfm.document(doc['doctype'], doc['docid'])
+                if response['success'] == False:
+                    # Leaving the digest out makes the next incremental backup try again.
+                    print >>sys.stderr, "Unable to fetch document ({doctype}, {docid}).".format(**doc)
+                    continue
+                doc = dict(doc, text=response['text'])
+            stored.append(key)
+        write_digest(digestfile, doc, digest)
+        yield doc
+
+
+def _compress_sources(outfile, sources, chunksize, metadata, index, telemetry, jobs,
+                      digestfile, base_digests, stored, metadata_digests):
+    """
+    Backs up several servers at once, reading each (shard, client, doctype range)
+    source in its own greenlet. Each greenlet collects its documents into chunks
+    of about `chunksize` bytes and compresses them in a pool of `jobs` threads.
+    A single greenlet writes the compressed chunks to the archive as they are
+    ready, recording the shard each came from in the manifest.
+    """
+    threads = gevent.threadpool.ThreadPool(jobs)
+    finished = gevent.queue.Queue(maxsize=len(sources))
+
+    def back_up(shard, client, doctype_rangestr):
+        def flush(manifest, buf):
+            (compressed, crc, seconds) = threads.apply(compress_chunk, (''.join(buf), outfile.compression,
+                                                                        outfile.compresslevel))
+            telemetry.add_time('compress', seconds)
+            with telemetry.timer('write_wait'):
+                finished.put((manifest, compressed, crc))
+
+        listed = _listed_documents(client, doctype_rangestr, digestfile, base_digests, stored,
+                                   metadata_digests)
+        for batch in _chunked_documents(_pickled_documents(telemetry.timed('fetch', listed)), chunksize):
+            # Members are named as they are written.
+            manifest = ChunkManifest(None, shard)
+            for (doc, data) in batch:
+                manifest.add(doc, data)
+            flush(manifest, [data for (doc, data) in batch])
+
+    def write_chunks():
+        while True:
+            item = finished.get()
+            if item is None:
+                return
+            (manifest, compressed, crc) = item
+            manifest.name = chunk_name(metadata['file_count'])
+            with telemetry.timer('write'):
+                outfile.writestr_compressed(manifest.name, compressed, manifest.bytes, crc)
+            print "Wrote backup chunk #{num} from {shard} containing {count} documents.".format(
+                num=metadata['file_count'], shard=manifest.shard, count=manifest.doc_count)
+            _record_chunk(outfile, metadata, manifest, index, telemetry)
+
+    writer = gevent.spawn(write_chunks)
+    readers = [gevent.spawn(back_up, *source) for source in sources]
+    try:
+        gevent.joinall(readers + [writer], count=len(readers), raise_error=True)
+        finished.put(None)
+        writer.get()
+    finally:
+        gevent.killall(readers + [writer])
+        threads.kill()
+
+
+def backup_sources(sfm, doctype_rangestr=None):
+    """
+    Splits a client into the servers that hold its documents, returning a list
+    of (shard, client, doctype range string) tuples. Each doctype range of a
+    FederatedClient and each shard of a ShardedClient is a separate source,
+    limited to `doctype_rangestr`. A LoadBalancedClient is read through its
+    least loaded replica. `shard` is the URL of the server.
+    """
+    if isinstance(sfm, FederatedClient):
+        sources = []
+        for (rangestr, client) in sorted(sfm.search_mapping.iteritems()):
+            doctypes = DoctypeRange.parse(rangestr)
+            if doctype_rangestr is not None:
+                doctypes = doctypes & DoctypeRange.parse(doctype_rangestr)
+                if len(doctypes) == 0:
+                    continue
+            sources.extend(backup_sources(client, str(doctypes)))
+        return sources
+    if isinstance(sfm, ShardedClient):
+        return [source for client in sfm.shards
+                for source in backup_sources(client, doctype_rangestr)]
+    if isinstance(sfm, LoadBalancedClient):
+        return backup_sources(sfm.least_loaded(), doctype_rangestr)
+    return [(getattr(sfm, 'url', repr(sfm)), sfm, doctype_rangestr)]
+
+
+def queue_servers(sfm):
+    """
+    The clients whose command queues hold the work posted through `sfm`:
+    `sfm` itself if it reports its queue, otherwise its shards or doctype
+    ranges.
+    """
+    if hasattr(sfm, 'queue'):
+        return [sfm]
+    return [client for (shard, client, rangestr) in backup_sources(sfm)]
+
+
+def _same_doctypes(a, b):
+    """Whether two doctype range strings, either of which may be None, describe the same doctypes."""
+    if a is None or b is None:
+        return a is None and b is None
+    return DoctypeRange.parse(a) == DoctypeRange.parse(b)
+
+
+def _deflated_member(name):
+    """Describes a member that is deflated whichever codec the archive uses."""
+    zinfo = ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.external_attr = 0600 << 16
+    return zinfo
+
+
+def _stored_member(name):
+    """Describes a member that is stored uncompressed so it can be read in place."""
+    zinfo = ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.compress_type = ZIP_STORED
+    zinfo.external_attr = 0600 << 16
+    return zinfo
+
+
+def backup(sfm, outpath, doctype_rangestr=None, chunksize=10000000, jobs=1,
+           base_path=None, digests_path=None, codec=DEFAULT_CODEC, telemetry=None,
+           metadata_digests=False):
+    """
+    Reusable routine for a backup tool.
+
+    Documents are pickled and stored in compressed `docsN` members of the
+    archive, a new member being started once `chunksize` bytes of pickled
+    documents have been written to the current one.
+
+    With the default of one job the documents are streamed straight into
+    the archive, so only a single document is held in memory at a time,
+    whatever the chunksize. With more jobs, whole chunks are compressed in
+    that many processes while the next chunk is fetched from the server,
+    which holds up to `jobs` + 1 chunks in memory.
 
-    chunked_docs = ChunkedIterator(docs,
-                                   chunksize=chunksize, # approx. 10 megabytes
-                                   key=lambda d: len(d.get('text')))
+    A digest of every document, covering its attributes and text, is
+    recorded in the archive, and also written to `digests_path` if given.
+    When `base_path` names an earlier archive or digests file, an incremental
+    backup is taken instead: only the documents whose digests differ from the
+    base are stored, and the documents missing since then are recorded as
+    tombstones. Restoring the base followed by its incrementals reproduces the
+    server as of the last incremental. Every text is still read from the
+    server to be digested, so an incremental saves archive space rather than
+    server reads.
+
+    With `metadata_digests` the digests cover only the attributes documents
+    are listed with, so an incremental backup fetches just the documents whose
+    attributes changed. Edits that keep a document's length and attributes
+    unchanged are then missed, and a chain of such backups may restore stale
+    texts. A base must have been taken with the same kind of digests.
+
+    The archive also holds an index of the member and offset of every
+    document, for superfastmatch.tools.archive.BackupReader.
+
+    `codec` selects the compression of the `docsN` members, e.g. 'stored',
+    'deflate:1' or 'bzip2'. See superfastmatch.tools.archive.parse_codec().
+
+    `sfm` may be a FederatedClient, ShardedClient or LoadBalancedClient, in
+    which case every server holding documents is backed up at once into the
+    one archive (see backup_sources()). Each server's chunks are collected in
+    memory and compressed in a pool of `jobs` threads. The calling program
+    should monkey patch with gevent for the servers to be read concurrently.
+
+    `telemetry` is a superfastmatch.tools.telemetry.Telemetry recording the
+    documents and bytes written and the time spent fetching ('fetch'),
+    compressing ('compress') and writing ('write') them. It polls the queues
+    of the servers backed up unless given other servers.
+    """
+
+    if doctype_rangestr is not None:
+        # Just ensure that it's valid.
+        DoctypeRange.parse(doctype_rangestr)
+    (compress_type, compresslevel) = parse_codec(codec)
+    sources = backup_sources(sfm, doctype_rangestr)
+    if len(sources) > 1:
+        print "Backing up {0} servers concurrently".format(len(sources))
+    telemetry = telemetry or Telemetry('backup')
+    if not telemetry.servers:
+        telemetry.servers = [client for (shard, client, rangestr) in sources]
+
+    digest_kind = 'metadata' if metadata_digests else 'content'
+    base_snapshot = None
+    base_digests = None
+    if base_path is not None:
+        (header, base_digests) = load_digests(base_path)
+        if not _same_doctypes(header['doctypes'], doctype_rangestr):
+            raise Exception('{0} is a backup of doctypes {1!r}, not {2!r}.'.format(
+                base_path, header['doctypes'], doctype_rangestr))
+        if header['digests'] != digest_kind:
+            raise Exception('{0} holds {1} digests, not {2} digests. Take a full backup to start a new chain.'.format(
+                base_path, header['digests'], digest_kind))
+        base_snapshot = header['snapshot']
+        print "Backing up changes to {0} documents since snapshot {1}".format(len(base_digests), base_snapshot)
 
     metadata = {
+        'version': ARCHIVE_VERSION,
+        'snapshot': uuid.uuid4().hex,
+        'base_snapshot': base_snapshot,
+        'codec': codec,
         'doctypes': set(),
         'doc_count': 0,
-        'file_count': 0
+        'file_count': 0,
+        'chunks': []
     }
 
-    with closing(ZipFile(outpath, 'w', compression=ZIP_DEFLATED, allowZip64=True)) as outfile:
-        with NamedTemporaryFile(mode='wb') as metafile:
-            for (file_number, docs_chunk) in enumerate(chunked_docs):
-                if len(docs_chunk) == 0:
-                    continue
+    stored = []
+    index = DocumentIndexWriter()
+    digestfile = open(digests_path, 'w+b') if digests_path is not None else TemporaryFile()
+    with ZipFile(outpath, 'w', compression=compress_type, allowZip64=True,
+                 compresslevel=compresslevel) as outfile, digestfile:
+        write_digests_header(digestfile, metadata['snapshot'], doctype_rangestr, digest_kind)
+        if len(sources) > 1:
+            _compress_sources(outfile, sources, chunksize, metadata, index, telemetry, jobs,
+                              digestfile, base_digests, stored, metadata_digests)
+        else:
+            for (shard, client, rangestr) in sources:
+                listed = _listed_documents(client, rangestr, digestfile, base_digests, stored,
+                                           metadata_digests)
+                documents = _pickled_documents(telemetry.timed('fetch', listed))
+                if jobs > 1:
+                    _compress_chunks(outfile, documents, chunksize, metadata, index, telemetry, jobs, shard)
+                else:
+                    _stream_chunks(outfile, documents, chunksize, metadata, index, telemetry, shard)
 
-                with NamedTemporaryFile(mode='wb') as docsfile:
-                    for docmeta in docs_chunk:
-                        if not docmeta:
-                            print >>sys.stderr, "Dropped empty document."
-                            continue
-                        try:
-                            doc = prune_document(docmeta)
-                            pickle.dump(doc, docsfile, pickle.HIGHEST_PROTOCOL)
-                            metadata['doctypes'].add(doc['doctype'])
-                            metadata['doc_count'] += 1
-                        except Exception as e:
-                            print >>sys.stderr, str(e)
-
-                    docsfile.flush()
-                    print "Compressing backup chunk #{num} containing {chunksize} documents...".format(num=file_number, chunksize=len(docs_chunk))
-                    outfile.write(docsfile.name, 'docs{num}'.format(num=file_number))
-                    metadata['file_count'] += 1
-
-            metadata['doctypes'] = list(metadata['doctypes'])
-            print "Dumped {doc_count} documents spanning doctypes {doctypes}".format(**metadata)
-            pickle.dump(metadata, metafile)
-            metafile.flush()
-            outfile.write(metafile.name, 'meta')
+        with closing(outfile.open(_stored_member('index'), 'w', force_zip64=True)) as indexmember:
+            index.write(indexmember, metadata['snapshot'])
+
+        digestfile.seek(0)
+        with closing(outfile.open(_deflated_member('digests'), 'w', force_zip64=True)) as digestmember:
+            shutil.copyfileobj(digestfile, digestmember)
+
+        if base_digests is not None:
+            tombstones = sorted(base_digests)
+            outfile.writestr(_deflated_member('changes'),
+                             pickle.dumps({'stored': stored, 'tombstones': tombstones},
+                                          pickle.HIGHEST_PROTOCOL))
+            print "Recorded {0} deleted documents".format(len(tombstones))
 
+        metadata['doctypes'] = list(metadata['doctypes'])
+        print "Dumped {doc_count} documents spanning doctypes {doctypes}".format(**metadata)
+        outfile.writestr(_deflated_member('meta'), pickle.dumps(metadata))
+
+    telemetry.finish()
     print "Done."
 
 
-def restore(sfm, inpath, docid_rangestr=None, doctype_mappingstr=None, dryrun=False):
+def parse_docid_filter(docids):
+    """
+    Returns the set of docids described by `docids`, which is either a docid
+    range string or the path of a file written by DocidBitmap.dump().
+    """
+    if os.path.isfile(docids):
+        with open(docids, 'rb') as infile:
+            return DocidBitmap.load(infile)
+    return parse_docid_range(docids)
+
+
+def archive_docids(inpath, doctype_rangestr=None):
+    """
+    Returns a DocidBitmap of the docids stored in a backup archive, limited to
+    those stored under the doctypes of `doctype_rangestr`. They are read from
+    the archive's document index, or its sidecar index, if it has one.
+    Otherwise the members that may hold those doctypes are read in full.
+    """
+    with closing(ZipFile(inpath, 'r')) as infile:
+        if 'index' not in infile.namelist() and not os.path.exists(inpath + '.index'):
+            metadata = read_metadata(infile)
+            doctypes = DoctypeRange.parse(doctype_rangestr) if doctype_rangestr is not None else None
+            return DocidBitmap(doc['docid'] for doc in iter_archive(infile, metadata, doctypes=doctypes)
+                               if 'docid' in doc and (doctypes is None or doc.get('doctype') in doctypes))
+    with closing(BackupReader(inpath)) as reader:
+        return reader.docids(doctype_rangestr)
+
+
+class RetryArchive(object):
+    """
+    Collects documents that failed to restore and writes them to `outpath` as a
+    backup archive, so they can be retried by restoring that archive. Nothing
+    is written if no documents were added.
+    """
+    def __init__(self, outpath):
+        self.outpath = outpath
+        self.outfile = None
+        self.docsfile = None
+        self.manifest = ChunkManifest(chunk_name(0))
+        self.metadata = {
+            'version': ARCHIVE_VERSION,
+            'doctypes': set(),
+            'doc_count': 0,
+            'file_count': 1
+        }
+
+    def add(self, doc):
+        data = pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+        if self.docsfile is None:
+            self.outfile = ZipFile(self.outpath, 'w', compression=ZIP_DEFLATED, allowZip64=True)
+            self.docsfile = self.outfile.open(self.manifest.name, 'w', force_zip64=True)
+        self.docsfile.write(data)
+        self.manifest.add(doc, data)
+        self.metadata['doctypes'].add(doc['doctype'])
+        self.metadata['doc_count'] += 1
+
+    def close(self):
+        if self.docsfile is None:
+            return
+        with closing(self.outfile):
+            self.docsfile.close()
+            self.metadata['doctypes'] = list(self.metadata['doctypes'])
+            self.metadata['chunks'] = [self.manifest.entry()]
+            self.outfile.writestr('meta', pickle.dumps(self.metadata))
+        print >>sys.stderr, "Wrote {0} failed documents to {1}".format(self.metadata['doc_count'], self.outpath)
+
+
+def _load_chunk(infile, chunk):
+    started = time.time()
+    docs = list(iter_chunk(infile, chunk))
+    return (docs, time.time() - started)
+
+
+def _read_ahead(infile, chunks, depth, telemetry):
+    """
+    Yields the documents of `chunks`, an iterable of manifest entries of an
+    open archive. A background thread decompresses and unpickles up to
+    `depth` members ahead of the one being yielded, so that greenlets doing
+    network I/O are not held up while it does. The time the thread spends
+    reading is recorded as `telemetry`'s 'read' stage, and the time spent
+    waiting for it as 'read_wait'.
+    """
+    chunks = iter(chunks)
+    threads = gevent.threadpool.ThreadPool(1)
+    loading = deque()
+    try:
+        for chunk in itertools.islice(chunks, depth):
+            loading.append(threads.spawn(_load_chunk, infile, chunk))
+        while loading:
+            with telemetry.timer('read_wait'):
+                (docs, seconds) = loading.popleft().get()
+            telemetry.add_time('read', seconds)
+            for chunk in itertools.islice(chunks, 1):
+                loading.append(threads.spawn(_load_chunk, infile, chunk))
+            for doc in docs:
+                yield doc
+    finally:
+        threads.kill()
+
+
+def restore(sfm, inpath, docid_rangestr=None, doctype_mappingstr=None, dryrun=False,
+            concurrency=1, window=None, retry_path=None, doctype_rangestr=None, read_ahead=2,
+            telemetry=None, throttle=None, batch_size=1, batch_bytes=None, batch_latency=1.0):
     """
     Reads documents from a backup archive and posts them to a superfastmatch server.
 
+    inpath may also be a list of paths: a backup archive followed by incremental
+    backups, each taken against the one before it. Only the latest version of
+    each document in the chain is posted, and documents deleted by an incremental
+    backup are deleted from the server.
+
     docid_rangestr is of the format 1-10,20,21 to import documents 1 through 10 and 20 and 21.
+    It may also be the path of a file written by DocidBitmap.dump().
 
     doctype_mappingstr isof the format 10:11,11:10 to swap doctypes 10 and 11.
 
-    TODO: The current implementation reads the entire archive regardless of the docid
-    range specified. This could be sped up dramatically by taking that information into
-    account but to do it right the archive format would need to be changed to include
-    the doctype range of each docs## file. Low priority since this should be a rare
-    task.
+    doctype_rangestr limits the restore to documents stored under those doctypes,
+    before any remapping.
+
+    Archive members whose manifest entries show that they cannot hold any of the
+    requested docids or doctypes are skipped without being read.
+
+    The archive members are decompressed and unpickled in a background thread,
+    up to `read_ahead` members ahead of the one being posted, while `concurrency`
+    greenlets post the documents. With a `read_ahead` of 0 the members are read
+    by the greenlet feeding the posting greenlets instead. At most `window`
+    documents (default: four per posting greenlet) are queued ahead of the
+    posting greenlets. The calling program should monkey patch with gevent for
+    the requests to overlap. Documents that fail to restore are written to a
+    backup archive at `retry_path`, if given.
+
+    The documents are handed to the posting greenlets in batches of up to
+    `batch_size` documents and `batch_bytes` characters of text, each of which
+    is posted by one greenlet. A batch is handed over at most `batch_latency`
+    seconds after its first document was read, even while the next member of
+    the archive is still being read, so the posting greenlets are not left idle
+    behind a slow read. Larger batches cost less to hand over and bound the
+    text held in the window by `batch_bytes` times the number of batches.
+
+    `telemetry` is a superfastmatch.tools.telemetry.Telemetry recording the
+    documents restored and the time spent reading the archive ('read'),
+    waiting for room in the window ('queue_wait') and posting ('post'). It
+    polls the queues of the servers restored to unless given other servers.
+
+    `throttle` is a superfastmatch.tools.throttle.QueueThrottle limiting the
+    rate at which documents are posted to keep the queues of the servers
+    restored to (unless given other servers) near its target depth. The time
+    spent waiting on it is recorded as the 'throttle_wait' stage.
     """
 
     doctype_mappings = {}
@@ -124,58 +617,710 @@ def restore(sfm, inpath, docid_rangestr=None, doctype_mappingstr=None, dryrun=Fa
         for (src, dst) in doctype_mappings.iteritems():
             print >>sys.stderr, "    {0} => {1}".format(src, dst)
 
+    window = window or 4 * concurrency
+    telemetry = telemetry or Telemetry('restore')
+    if not telemetry.servers:
+        telemetry.servers = queue_servers(sfm)
+    if throttle is not None and not throttle.servers:
+        throttle.servers = queue_servers(sfm)
     ignored_attributes = ['characters', 'id', 'defer']
-    with closing(ZipFile(inpath, 'r')) as infile:
-        with closing(infile.open('meta', 'r')) as metafile:
-            metadata = pickle.load(metafile)
-
-            docid_range = None
-            if docid_rangestr is not None:
-                docid_range = parse_docid_range(docid_rangestr)
-                print >>sys.stderr, "Limiting import to {0}".format(docid_rangestr)
-
-            progress = progressbar.ProgressBar(maxval=metadata['doc_count'],
-                                               widgets=[
-                                                   progressbar.widgets.AnimatedMarker(),
-                                                   '  ',
-                                                   progressbar.widgets.Counter(),
-                                                   '/{0}  '.format(metadata['doc_count']),
-                                                   progressbar.widgets.Percentage(),
-                                                   '  ',
-                                                   progressbar.widgets.ETA(),
-                                               ])
-            progress.start()
-            doccounter = 0
-
-            for file_number in range(0, metadata['file_count']):
-                docsfile_name = 'docs{num}'.format(num=file_number)
-                with closing(infile.open(docsfile_name, 'r')) as docsfile:
-                    docloader = pickle.Unpickler(docsfile)
-                    for doc in UnpicklerIterator(docloader):
-                        if 'text' in doc and 'doctype' in doc and 'docid' in doc:
-                            if docid_range is not None and doc['docid'] not in docid_range:
-                                if doc['docid'] > docid_range.max:
-                                    pass
-                            else:
-                                for attr in ignored_attributes:
-                                    if doc.has_key(attr):
-                                        del doc[attr]
-                                new_doctype = doctype_mappings.get(doc['doctype'])
-                                if new_doctype:
-                                    doc['doctype'] = new_doctype
-                                if dryrun == False:
-                                    add_result = sfm.add(defer=True, **doc)
-                                    if add_result['success'] == False:
-                                        print >>sys.stderr, "Failed to restore document ({doctype}, {docid})".format(**doc)
-                        elif 'doctype' in doc and 'docid' in doc:
-                            print >>sys.stderr, "Document ({doctype}, {docid}) cannot be restored because it is missing a text attribute.".format(**doc)
-
-                        elif 'text' in doc:
-                            print >>sys.stderr, "Document with text '{snippet}...' cannot be restored because it is missing a doctype and/or docid attribute.".format(snippet=doc['text'][:40])
-
-                        else:
-                            print >>sys.stderr, "Cannot restore empty document (missing all of text, doctype, and docid attributes)."
-
-                        doccounter += 1
-                        progress.update(doccounter)
-            progress.finish()
+    retries = RetryArchive(retry_path) if retry_path is not None else None
+    doctypes = None
+    if doctype_rangestr is not None:
+        doctypes = DoctypeRange.parse(doctype_rangestr)
+        print >>sys.stderr, "Limiting import to doctypes {0}".format(doctypes)
+
+    inpaths = [inpath] if isinstance(inpath, basestring) else list(inpath)
+    infiles = []
+    try:
+        for path in inpaths:
+            infiles.append(ZipFile(path, 'r'))
+        metadatas = [read_metadata(infile) for infile in infiles]
+        check_chain(inpaths, metadatas)
+
+        docid_range = None
+        if docid_rangestr is not None:
+            docid_range = parse_docid_filter(docid_rangestr)
+            print >>sys.stderr, "Limiting import to {0}".format(docid_rangestr)
+
+        # latest: the index of the last archive in the chain that stores or deletes each key
+        changes = [read_changes(infile, metadata) for (infile, metadata) in zip(infiles, metadatas)]
+        latest = {}
+        for (index, change) in enumerate(changes):
+            if change is not None:
+                for key in change['stored'] + change['tombstones']:
+                    latest[key] = index
+
+        def wanted(doc):
+            return ((docid_range is None or doc['docid'] in docid_range)
+                    and (doctypes is None or doc['doctype'] in doctypes))
+
+        tombstones = [[{'doctype': doctype, 'docid': docid}
+                       for (doctype, docid) in change['tombstones']
+                       if latest[(doctype, docid)] == index
+                       and wanted({'doctype': doctype, 'docid': docid})]
+                      if change is not None else []
+                      for (index, change) in enumerate(changes)]
+
+        expected_count = sum(len(deletes) for deletes in tombstones)
+        for (path, metadata) in zip(inpaths, metadatas):
+            chunks = matching_chunks(metadata, docid_range, doctypes)
+            if len(chunks) < len(metadata['chunks']):
+                print >>sys.stderr, "Skipping {0} of {1} members of {2}".format(
+                    len(metadata['chunks']) - len(chunks), len(metadata['chunks']), path)
+            if metadata['version'] >= 2:
+                expected_count += sum(chunk['doc_count'] for chunk in chunks)
+            else:
+                expected_count += metadata['doc_count']
+
+        progress = progressbar.ProgressBar(maxval=expected_count,
+                                           widgets=[
+                                               progressbar.widgets.AnimatedMarker(),
+                                               '  ',
+                                               progressbar.widgets.Counter(),
+                                               '/{0}  '.format(expected_count),
+                                               progressbar.widgets.Percentage(),
+                                               '  ',
+                                               progressbar.widgets.ETA(),
+                                           ])
+        progress.start()
+        counts = {'processed': 0, 'failed': 0}
+
+        def document_done():
+            counts['processed'] += 1
+            progress.update(counts['processed'])
+            telemetry.count('documents')
+
+        def queue(batch):
+            with telemetry.timer('queue_wait'):
+                pending.put(batch)
+
+        # The window is measured in documents, so it holds this many batches.
+        pending = gevent.queue.Queue(maxsize=max(1, window // batch_size))
+
+        def remap(doc):
+            new_doctype = doctype_mappings.get(doc['doctype'])
+            if new_doctype:
+                doc['doctype'] = new_doctype
+            return doc
+
+        def iter_chain():
+            for (index, (infile, metadata)) in enumerate(zip(infiles, metadatas)):
+                if read_ahead > 0:
+                    docs = _read_ahead(infile, matching_chunks(metadata, docid_range, doctypes), read_ahead,
+                                       telemetry)
+                else:
+                    docs = telemetry.timed('read', iter_archive(infile, metadata, docid_range, doctypes))
+                for doc in docs:
+                    if ('doctype' in doc and 'docid' in doc
+                        and latest.get((doc['doctype'], doc['docid']), index) != index):
+                        # A later archive in the chain stores or deletes this document.
+                        document_done()
+                        continue
+                    yield doc
+
+        def actions():
+            """Yields the ('add', document) and ('delete', document) pairs to post."""
+            for doc in iter_chain():
+                if 'text' in doc and 'doctype' in doc and 'docid' in doc:
+                    if wanted(doc):
+                        for attr in ignored_attributes:
+                            if doc.has_key(attr):
+                                del doc[attr]
+                        if dryrun == False:
+                            yield ('add', remap(doc))
+                            continue
+                elif 'doctype' in doc and 'docid' in doc:
+                    print >>sys.stderr, "Document ({doctype}, {docid}) cannot be restored because it is missing a text attribute.".format(**doc)
+
+                elif 'text' in doc:
+                    print >>sys.stderr, "Document with text '{snippet}...' cannot be restored because it is missing a doctype and/or docid attribute.".format(snippet=doc['text'][:40])
+
+                else:
+                    print >>sys.stderr, "Cannot restore empty document (missing all of text, doctype, and docid attributes)."
+
+                document_done()
+
+            for doc in itertools.chain.from_iterable(tombstones):
+                if dryrun == False:
+                    yield ('delete', remap(doc))
+                else:
+                    document_done()
+
+        def read_documents():
+            batches = BatchingIterator(actions(), max_items=batch_size, max_bytes=batch_bytes,
+                                       max_latency=batch_latency,
+                                       key=lambda (action, doc): len(doc.get('text') or ''))
+            try:
+                for batch in batches:
+                    queue(batch)
+            finally:
+                batches.close()
+                for _ in range(concurrency):
+                    pending.put(None)
+
+        def post_document(action, doc):
+            if throttle is not None:
+                with telemetry.timer('throttle_wait'):
+                    throttle.wait()
+            if action == 'delete':
+                try:
+                    # Deleting a document that is already gone is not a failure.
+                    with telemetry.timer('post'):
+                        sfm.delete(doc['doctype'], doc['docid'])
+                    telemetry.count('deleted')
+                except Exception as e:
+                    print >>sys.stderr, "Failed to delete document ({doctype}, {docid}): {e}".format(e=e, **doc)
+                    counts['failed'] += 1
+                    telemetry.count('failed')
+                document_done()
+                return
+            try:
+                with telemetry.timer('post'):
+                    add_result = sfm.add(defer=True, **doc)
+                succeeded = add_result['success'] != False
+            except Exception as e:
+                print >>sys.stderr, "Error while restoring document ({doctype}, {docid}): {e}".format(e=e, **doc)
+                succeeded = False
+            if not succeeded:
+                print >>sys.stderr, "Failed to restore document ({doctype}, {docid})".format(**doc)
+                counts['failed'] += 1
+                telemetry.count('failed')
+                if retries is not None:
+                    retries.add(doc)
+            else:
+                telemetry.count('added')
+                telemetry.count('characters', len(doc['text']))
+            document_done()
+
+        def post_documents():
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    return
+                for (action, doc) in batch:
+                    post_document(action, doc)
+
+        try:
+            if throttle is not None:
+                throttle.start()
+            reader = gevent.spawn(read_documents)
+            posters = [gevent.spawn(post_documents) for _ in range(concurrency)]
+            gevent.joinall([reader] + posters)
+            reader.get()
+        finally:
+            if throttle is not None:
+                throttle.stop()
+            if retries is not None:
+                retries.close()
+        progress.finish()
+        telemetry.finish()
+        return counts
+    finally:
+        for infile in infiles:
+            infile.close()
+
+
+def document_cursor(doc, order_by='docid'):
+    """Returns the listing cursor that begins at `doc`."""
+    return '{0}:{1}:{2}'.format(doc[order_by], doc['doctype'], doc['docid'])
+
+
+class MigrationProgress(object):
+    """
+    Tracks which documents of a migration have been copied. Documents are
+    numbered in listing order and may finish in any order. `cursor` is the
+    listing cursor of the newest document for which it and every document
+    before it have been copied, and `copied` counts the documents up to and
+    including it over all runs. Neither moves past a document that failed.
+
+    >>> docs = [{'doctype': 1, 'docid': docid} for docid in range(1, 6)]
+    >>> progress = MigrationProgress()
+    >>> for (number, succeeded) in [(1, True), (0, True), (3, True), (2, False), (4, True)]:
+    ...     progress.done(number, docs[number], succeeded)
+    >>> (progress.cursor, progress.copied)
+    ('2:1:2', 2)
+
+    A resumed listing starts at the cursor. The document there has already
+    been copied, so it is skipped:
+
+    >>> resumed = MigrationProgress(progress.cursor, progress.copied)
+    >>> numbered = list(resumed.numbered(docs[1:]))
+    >>> [(number, doc['docid']) for (number, doc) in numbered]
+    [(0, 3), (1, 4), (2, 5)]
+    >>> for (number, doc) in numbered:
+    ...     resumed.done(number, doc, True)
+    >>> (resumed.cursor, resumed.copied)
+    ('5:1:5', 5)
+    """
+
+    def __init__(self, cursor=None, copied=0):
+        self.cursor = cursor
+        self.resumed_copied = copied
+        self.watermark = -1
+        self.first_failure = None
+        # completed: the cursors of documents copied ahead of the watermark, by number
+        self.completed = {}
+
+    @property
+    def copied(self):
+        return self.resumed_copied + self.watermark + 1
+
+    def numbered(self, docs):
+        """Numbers the listed documents, leaving out the document at the resumed cursor."""
+        docs = iter(docs)
+        first = next(docs, None)
+        if first is not None and (self.cursor is None or document_cursor(first) != self.cursor):
+            docs = itertools.chain([first], docs)
+        return enumerate(docs)
+
+    def done(self, number, doc, succeeded):
+        """Records the outcome of copying the `number`th document, `doc`."""
+        if self.first_failure is None or number < self.first_failure:
+            if succeeded:
+                self.completed[number] = document_cursor(doc)
+            else:
+                self.first_failure = number
+                for later in [n for n in self.completed if n > number]:
+                    del self.completed[later]
+        while self.watermark + 1 in self.completed:
+            self.watermark += 1
+            self.cursor = self.completed.pop(self.watermark)
+
+
+def compare_listings(src, dst, doctype_rangestr=None):
+    """
+    Compares the documents in a doctype range on two servers by their keys,
+    returning the number on each and the numbers missing from `dst` and extra
+    on it. The servers are listed in docid order and merge joined, as by
+    _listed_by_docid(), so neither listing is held in memory.
+    """
+    counts = {'source_count': 0, 'destination_count': 0, 'missing': 0, 'extra': 0}
+    for (srcdoc, dstdoc) in _merge_docid_groups(_listed_by_docid(src, doctype_rangestr),
+                                                _listed_by_docid(dst, doctype_rangestr)):
+        if srcdoc is not None:
+            counts['source_count'] += 1
+        if dstdoc is not None:
+            counts['destination_count'] += 1
+        if dstdoc is None:
+            counts['missing'] += 1
+        elif srcdoc is None:
+            counts['extra'] += 1
+    return counts
+
+
+def load_checkpoint(checkpoint_path, doctype_rangestr):
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if not _same_doctypes(checkpoint.get('doctypes'), doctype_rangestr):
+        raise Exception('Checkpoint {0} was written for doctypes {1!r}, not {2!r}.'.format(
+            checkpoint_path, checkpoint.get('doctypes'), doctype_rangestr))
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    tmppath = checkpoint_path + '.tmp'
+    with open(tmppath, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(tmppath, checkpoint_path)
+
+
+def migrate(src, dst, doctype_rangestr, concurrency=10, chunksize=100,
+            checkpoint_path=None, checkpoint_interval=1000,
+            delete_source=False, dryrun=False, throttle=None):
+    """
+    Copies the documents in a doctype range from the `src` server directly to the
+    `dst` server without an intermediate archive.
+
+    Document texts are fetched from the source by a pool of `concurrency`
+    greenlets while another pool of the same size adds them to the destination.
+    The calling program should monkey patch with gevent for the HTTP requests
+    to overlap.
+
+    Documents are added with defer=True, so the destination indexes them in
+    the background.
+
+    Progress is recorded in `checkpoint_path` every `checkpoint_interval`
+    documents. The checkpoint holds the cursor of the newest document for which
+    it and every document before it has been copied, so an interrupted migration
+    resumes after it when run again with the same checkpoint file. Documents
+    that fail to copy hold the cursor back, so they are tried again on resume.
+    A dry run neither reads nor writes the checkpoint. See MigrationProgress.
+
+    `throttle` is a superfastmatch.tools.throttle.QueueThrottle limiting the
+    rate at which documents are added to keep the queues of the destination
+    (unless given other servers) near its target depth.
+
+    After copying, the documents in the range on both servers are compared by
+    key (see compare_listings()). The migration is verified if no copy failed
+    and every document on the source is also on the destination. Documents
+    that were already on the destination are reported as extra without
+    affecting verification. If `delete_source` is True and the migration is
+    verified, each source document is deleted once it has been confirmed to
+    exist on the destination.
+
+    Returns a dict of counts describing the migration.
+    """
+
+    # Just ensure that it's valid.
+    DoctypeRange.parse(doctype_rangestr)
+
+    if dryrun and checkpoint_path is not None:
+        print >>sys.stderr, "Ignoring the checkpoint file {0} during a dry run".format(checkpoint_path)
+        checkpoint_path = None
+
+    # checkpoint['copied'] counts the documents up to and including the one at the cursor.
+    checkpoint = load_checkpoint(checkpoint_path, doctype_rangestr) or {
+        'doctypes': doctype_rangestr,
+        'cursor': None,
+        'copied': 0
+    }
+    if checkpoint['cursor'] is not None:
+        print >>sys.stderr, "Resuming migration after {0}".format(checkpoint['cursor'])
+
+    fetch_pool = gevent.pool.Pool(concurrency)
+    add_pool = gevent.pool.Pool(concurrency)
+
+    progress = MigrationProgress(checkpoint['cursor'], checkpoint['copied'])
+    state = {'since_checkpoint': 0}
+    counts = {'copied': 0, 'failed': 0}
+
+    def record_checkpoint():
+        checkpoint['cursor'] = progress.cursor
+        checkpoint['copied'] = progress.copied
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    def fetch_text(numbered_docmeta):
+        (number, docmeta) = numbered_docmeta
+        try:
+            response = src.document(docmeta['doctype'], docmeta['docid'])
+        except Exception as e:
+            print >>sys.stderr, "Failed to fetch document ({doctype}, {docid}): {e}".format(e=e, **docmeta)
+            return (number, docmeta, None)
+        if not response or response.get('success') == False:
+            print >>sys.stderr, "Failed to fetch document ({doctype}, {docid}) from the source".format(**docmeta)
+            return (number, docmeta, None)
+        doc = prune_document(docmeta)
+        doc['text'] = response['text']
+        return (number, docmeta, doc)
+
+    def copy_document(number, docmeta, doc):
+        success = False
+        try:
+            if doc is None:
+                pass
+            elif dryrun:
+                success = True
+            else:
+                if throttle is not None:
+                    throttle.wait()
+                add_result = dst.add(defer=True, **doc)
+                success = add_result.get('success', False) != False
+                if not success:
+                    print >>sys.stderr, "Failed to copy document ({doctype}, {docid})".format(**docmeta)
+        except Exception as e:
+            print >>sys.stderr, "Failed to copy document ({doctype}, {docid}): {e}".format(e=e, **docmeta)
+
+        counts['copied' if success else 'failed'] += 1
+        progress.done(number, docmeta, success)
+        state['since_checkpoint'] += 1
+        if checkpoint_path is not None and state['since_checkpoint'] >= checkpoint_interval:
+            record_checkpoint()
+            state['since_checkpoint'] = 0
+
+    docs = DocumentIterator(src,
+                            order_by='docid',
+                            doctype=doctype_rangestr,
+                            chunksize=chunksize,
+                            start_at=checkpoint['cursor'])
+    if throttle is not None:
+        if not throttle.servers:
+            throttle.servers = queue_servers(dst)
+        throttle.start()
+    try:
+        for (number, docmeta, doc) in fetch_pool.imap(fetch_text, progress.numbered(docs)):
+            add_pool.spawn(copy_document, number, docmeta, doc)
+        add_pool.join()
+    finally:
+        if throttle is not None:
+            throttle.stop()
+
+    if checkpoint_path is not None:
+        record_checkpoint()
+    print >>sys.stderr, "Copied {copied} documents ({failed} failures)".format(**counts)
+
+    results = {
+        'copied': progress.resumed_copied + counts['copied'],
+        'failed': counts['failed'],
+        'deleted': 0
+    }
+    if dryrun:
+        return results
+
+    results.update(compare_listings(src, dst, doctype_rangestr))
+    results['verified'] = results['failed'] == 0 and results['missing'] == 0
+    print >>sys.stderr, ("Source has {source_count} documents, destination has {destination_count}: "
+                         + "{missing} missing from the destination, {extra} only on the destination").format(**results)
+
+    if delete_source:
+        if not results['verified']:
+            print >>sys.stderr, "Not deleting source documents because the migration could not be verified."
+            return results
+
+        def delete_document(docmeta):
+            response = dst.document(docmeta['doctype'], docmeta['docid'])
+            if not response or response.get('success') == False:
+                print >>sys.stderr, "Not deleting ({doctype}, {docid}) from the source because it is missing from the destination".format(**docmeta)
+                return False
+            src.delete(docmeta['doctype'], docmeta['docid'])
+            return True
+
+        docs = DocumentIterator(src, order_by='docid', doctype=doctype_rangestr, chunksize=chunksize)
+        results['deleted'] = sum(1 for deleted in add_pool.imap_unordered(delete_document, docs) if deleted)
+        print >>sys.stderr, "Deleted {deleted} documents from the source".format(**results)
+
+    return results
+
+
+def _docid_groups(docs):
+    """
+    Groups documents listed in docid order, yielding a (docid, documents by
+    doctype) pair for each docid.
+    """
+    for (docid, group) in itertools.groupby((doc for doc in docs if doc), key=lambda doc: doc['docid']):
+        yield (docid, dict((doc['doctype'], doc) for doc in group))
+
+
+def _listed_by_docid(sfm, doctype_rangestr=None):
+    """
+    Lists the documents of a server in docid order, grouped as by
+    _docid_groups(). A federated, sharded or load balanced client is listed
+    server by server, as by backup_sources(), and the listings merged.
+    """
+    doctypes = DoctypeRange.parse(doctype_rangestr) if doctype_rangestr is not None else None
+    servers = [DocumentIterator(client, order_by='docid', doctype=rangestr, chunksize=1000)
+               for (shard, client, rangestr) in backup_sources(sfm, doctype_rangestr)]
+    return _docid_groups(doc for doc in MergedDocumentIterator(servers, 'docid')
+                         if doc and (doctypes is None or doc['doctype'] in doctypes))
+
+
+def _merge_docid_groups(left, right):
+    """
+    Merge joins two iterators of docid groups, yielding a (left document,
+    right document) pair for each key, with None for a missing side.
+    """
+    (lgroup, rgroup) = (next(left, None), next(right, None))
+    while lgroup is not None or rgroup is not None:
+        if rgroup is None or (lgroup is not None and lgroup[0] < rgroup[0]):
+            (ldocs, rdocs) = (lgroup[1], {})
+        elif lgroup is None or rgroup[0] < lgroup[0]:
+            (ldocs, rdocs) = ({}, rgroup[1])
+        else:
+            (ldocs, rdocs) = (lgroup[1], rgroup[1])
+
+        for doctype in sorted(set(ldocs) | set(rdocs)):
+            yield (ldocs.get(doctype), rdocs.get(doctype))
+
+        if ldocs:
+            lgroup = next(left, None)
+        if rdocs:
+            rgroup = next(right, None)
+
+
+def _text_digest(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def verify(sfm, inpath, doctype_rangestr=None, concurrency=10, compare_text=True):
+    """
+    Compares the documents stored in a full backup archive with those on a
+    server, printing a line for each document that is missing from the
+    server, extra on the server, or differs between the two.
+
+    The archive is read in docid order through its document index while the
+    server's documents are listed in docid order, and the two are merge
+    joined, so neither is held in memory. A federated, sharded or load
+    balanced client is listed server by server, as by _listed_by_docid(). Documents on both have their
+    listed attributes compared. Unless `compare_text` is False, their texts
+    are also fetched from the server by a pool of `concurrency` greenlets and
+    compared by digest. The calling program should monkey patch with gevent
+    for the requests to overlap.
+
+    Only the doctypes in `doctype_rangestr` are compared, by default those
+    stored in the archive. Returns a dict of counts.
+    """
+    counts = {'matched': 0, 'missing': 0, 'extra': 0, 'differing': 0}
+
+    def report(kind, doc, detail=None):
+        counts[kind] += 1
+        print "{kind} ({doctype}, {docid}){detail}".format(
+            kind=kind, detail=': ' + detail if detail else '', **doc)
+
+    def compare(archived, listed):
+        expected = dict((k, v) for (k, v) in archived.iteritems() if k != 'text')
+        actual = prune_document(listed)
+        actual.pop('text', None)
+        differences = [key for key in sorted(set(expected) | set(actual))
+                       if expected.get(key) != actual.get(key)]
+        if compare_text:
+            try:
+                response = sfm.document(listed['doctype'], listed['docid'])
+            except Exception as e:
+                response = None
+                print >>sys.stderr, "Failed to fetch document ({doctype}, {docid}): {e}".format(e=e, **listed)
+            if not response or response.get('success') == False:
+                differences.append('text (unavailable)')
+            elif _text_digest(response['text']) != _text_digest(archived.get('text', u'')):
+                differences.append('text')
+        if differences:
+            report('differing', listed, ', '.join(differences))
+        else:
+            counts['matched'] += 1
+
+    compare_pool = gevent.pool.Pool(concurrency)
+    with closing(BackupReader(inpath)) as reader:
+        if reader.metadata['base_snapshot'] is not None:
+            raise Exception('{0} is an incremental backup. Verify against a full backup.'.format(inpath))
+        if doctype_rangestr is None and reader.metadata['doctypes']:
+            doctype_rangestr = str(DoctypeRange(reader.metadata['doctypes']))
+        doctypes = DoctypeRange.parse(doctype_rangestr) if doctype_rangestr is not None else None
+        # The members of each server in the backup are read side by side.
+        reader.cache_members = max(1, len(set(chunk['shard'] for chunk in reader.metadata['chunks'])))
+
+        archived = _docid_groups(reader.iter_by_docid(doctypes=doctypes))
+        listed = _listed_by_docid(sfm, doctype_rangestr)
+        for (archived_doc, listed_doc) in _merge_docid_groups(archived, listed):
+            if listed_doc is None:
+                report('missing', archived_doc)
+            elif archived_doc is None:
+                report('extra', listed_doc)
+            elif compare_text:
+                compare_pool.spawn(compare, archived_doc, listed_doc)
+            else:
+                compare(archived_doc, listed_doc)
+        compare_pool.join(raise_error=True)
+
+    print >>sys.stderr, "{matched} documents match, {missing} missing, {extra} extra, {differing} differing".format(**counts)
+    return counts
+
+
+def sync(src, dst, doctype_rangestr=None, concurrency=10, dryrun=False,
+         compare_text=False, delete_extra=True, throttle=None):
+    """
+    Makes the documents of a doctype range on the `dst` server match those on
+    the `src` server, copying only what differs.
+
+    Both servers are listed in docid order and merge joined, as by
+    _listed_by_docid(). A document is copied when it is missing from `dst` or
+    its listed attributes differ, as compared by document_digest(), and it is
+    deleted from `dst` when it is not on `src`, unless `delete_extra` is False.
+    Since only the listings are compared, the time taken follows the number of
+    changes rather than the number of documents. An edit that keeps a
+    document's length and attributes unchanged is only found with
+    `compare_text`, which fetches the text of every document on both servers
+    and compares their digests.
+
+    The changes are applied by a pool of `concurrency` greenlets fetching
+    texts from `src` and another of the same size writing to `dst`. With
+    `dryrun` the changes are printed rather than applied. The calling program
+    should monkey patch with gevent for the requests to overlap.
+
+    `throttle` is a superfastmatch.tools.throttle.QueueThrottle limiting the
+    rate at which changes are written to keep the queues of `dst` (unless
+    given other servers) near its target depth.
+
+    Returns a dict of counts.
+    """
+    counts = {'unchanged': 0, 'added': 0, 'deleted': 0, 'failed': 0}
+
+    def changes():
+        for (srcdoc, dstdoc) in _merge_docid_groups(_listed_by_docid(src, doctype_rangestr),
+                                                    _listed_by_docid(dst, doctype_rangestr)):
+            if dstdoc is None:
+                yield ('add', srcdoc)
+            elif srcdoc is None:
+                if delete_extra:
+                    yield ('delete', dstdoc)
+            elif document_digest(srcdoc) != document_digest(dstdoc):
+                yield ('add', srcdoc)
+            elif compare_text:
+                yield ('check', srcdoc)
+            else:
+                counts['unchanged'] += 1
+
+    def fetch_text(sfm, docmeta):
+        try:
+            response = sfm.document(docmeta['doctype'], docmeta['docid'])
+        except Exception as e:
+            print >>sys.stderr, "Failed to fetch document ({doctype}, {docid}): {e}".format(e=e, **docmeta)
+            return None
+        if not response or response.get('success') == False:
+            print >>sys.stderr, "Failed to fetch document ({doctype}, {docid})".format(**docmeta)
+            return None
+        return response['text']
+
+    def prepare(change):
+        """Fetches what is needed to apply a change, returning the change or None."""
+        (action, docmeta) = change
+        if action == 'delete' or (action == 'add' and dryrun):
+            return change
+        text = fetch_text(src, docmeta)
+        if text is None:
+            counts['failed'] += 1
+            return None
+        if action == 'check':
+            dsttext = fetch_text(dst, docmeta)
+            if dsttext is not None and _text_digest(dsttext) == _text_digest(text):
+                counts['unchanged'] += 1
+                return None
+            action = 'add'
+        doc = prune_document(docmeta)
+        doc['text'] = text
+        return (action, doc)
+
+    def apply_change(change):
+        (action, doc) = change
+        if dryrun:
+            print "{action} ({doctype}, {docid})".format(action=action, **doc)
+            counts['added' if action == 'add' else 'deleted'] += 1
+            return
+        if throttle is not None:
+            throttle.wait()
+        try:
+            if action == 'delete':
+                response = dst.delete(doc['doctype'], doc['docid'])
+            else:
+                response = dst.add(defer=True, **doc)
+            succeeded = not response or response.get('success') != False
+        except Exception as e:
+            print >>sys.stderr, "Failed to {action} document ({doctype}, {docid}): {e}".format(action=action, e=e, **doc)
+            succeeded = False
+        if succeeded:
+            counts['added' if action == 'add' else 'deleted'] += 1
+        else:
+            print >>sys.stderr, "Failed to {action} document ({doctype}, {docid})".format(action=action, **doc)
+            counts['failed'] += 1
+
+    fetch_pool = gevent.pool.Pool(concurrency)
+    apply_pool = gevent.pool.Pool(concurrency)
+    if throttle is not None:
+        if not throttle.servers:
+            throttle.servers = queue_servers(dst)
+        throttle.start()
+    try:
+        for change in fetch_pool.imap_unordered(prepare, changes()):
+            if change is not None:
+                apply_pool.spawn(apply_change, change)
+        apply_pool.join(raise_error=True)
+    finally:
+        if throttle is not None:
+            throttle.stop()
+
+    summary = ("Would add {added} and delete {deleted} documents ({unchanged} unchanged, {failed} failures)" if dryrun
+               else "Added {added} and deleted {deleted} documents ({unchanged} unchanged, {failed} failures)")
+    print >>sys.stderr, summary.format(**counts)
+    return counts
@@ -0,0 +1,53 @@
+"""
+Brings a range of doctypes on one Superfastmatch server up to date with
+another, e.g. a staging server with production. Both servers are listed
+in docid order and compared, and only the documents that differ are
+copied or deleted, so a sync takes time in proportion to the changes.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from argparse import ArgumentParser
+from superfastmatch.client import Client
+from superfastmatch.tools.routines import sync
+from superfastmatch.tools.throttle import add_throttle_arguments, throttle_from_args
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--concurrency', metavar='N', action='store', type=int, default=10,
+                        help='The number of simultaneous requests to make to each server. (default: 10)')
+    parser.add_argument('--compare-text', dest='compare_text', default=False, action='store_true',
+                        help=('Also fetch and compare the text of every document on both servers, to find edits '
+                              + 'that leave a document\'s length and attributes unchanged.'))
+    parser.add_argument('--keep-extra', dest='keep_extra', default=False, action='store_true',
+                        help='Don\'t delete documents from the destination that are not on the source.')
+    add_throttle_arguments(parser)
+    parser.add_argument('--dryrun', default=False, action='store_true',
+                        help='Don\'t change the destination. Just print the changes that would be made.')
+    parser.add_argument('doctypes', metavar='RANGE_STRING', action='store',
+                        help='Range string of doctypes to sync, e.g. 1:4-7:10')
+    parser.add_argument('source', metavar='SOURCE_URL', action='store',
+                        help='URL of the Superfastmatch server to copy changes from.')
+    parser.add_argument('destination', metavar='DESTINATION_URL', action='store',
+                        help='URL of the Superfastmatch server to bring up to date.')
+    args = parser.parse_args()
+
+    throttle = throttle_from_args(parser, args)
+
+    src = Client(args.source, parse_response=True)
+    dst = Client(args.destination, parse_response=True)
+    counts = sync(src, dst, args.doctypes,
+                  concurrency=args.concurrency,
+                  dryrun=args.dryrun,
+                  compare_text=args.compare_text,
+                  delete_extra=not args.keep_extra,
+                  throttle=throttle)
+    if counts['failed'] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
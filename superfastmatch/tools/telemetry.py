@@ -0,0 +1,111 @@
+"""
+Throughput telemetry for the backup and restore routines.
+
+A Telemetry object accumulates counters (documents, bytes, ...) and the
+time spent in each stage of a routine (fetching, compressing, posting,
+...). Every `interval` seconds it writes a JSON line describing the run
+so far, including the depth of the servers' command queues, and a final
+line with 'summary' set once the routine finishes. Stage times are summed
+over the greenlets and processes doing the work, so stages that run
+concurrently may add up to more than the elapsed time.
+"""
+
+import sys
+import json
+import time
+from contextlib import contextmanager
+from ..util import queue_depth
+
+
+class Telemetry(object):
+    def __init__(self, routine, outfile=None, interval=10.0, servers=()):
+        """
+        `outfile` is a file to write the JSON lines to; nothing is written
+        without one. `servers` lists the clients whose queues are polled as
+        each line is written.
+        """
+        self.routine = routine
+        self.outfile = outfile
+        self.interval = interval
+        self.servers = list(servers)
+        self.counters = {}
+        self.stages = {}
+        self.started = time.time()
+        self.last_emitted = self.started
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+        self.maybe_emit()
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - started)
+
+    def timed(self, stage, iterable):
+        """Yields the items of `iterable`, timing each step as `stage`."""
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def queue_depth(self):
+        """The number of unprocessed commands queued on the servers, or None if unknown."""
+        if not self.servers:
+            return None
+        depth = 0
+        for server in self.servers:
+            try:
+                depth += queue_depth(server.queue())
+            except Exception:
+                return None
+        return depth
+
+    def snapshot(self):
+        elapsed = time.time() - self.started
+        return {
+            'routine': self.routine,
+            'time': time.time(),
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'rates': dict((counter, value / max(elapsed, 1e-6))
+                          for (counter, value) in self.counters.iteritems()),
+            'stages': dict(self.stages),
+            'queue_depth': self.queue_depth()
+        }
+
+    def emit(self, summary=False):
+        if self.outfile is None:
+            return
+        line = self.snapshot()
+        line['summary'] = summary
+        self.outfile.write(json.dumps(line, sort_keys=True) + '\n')
+        self.outfile.flush()
+        self.last_emitted = time.time()
+
+    def maybe_emit(self):
+        if self.outfile is not None and time.time() - self.last_emitted >= self.interval:
+            self.emit()
+
+    def finish(self):
+        """Writes the summary line."""
+        self.emit(summary=True)
+
+
+def open_stats(path):
+    """Opens the --stats file of a tool, where '-' means standard error."""
+    if path is None:
+        return None
+    if path == '-':
+        return sys.stderr
+    return open(path, 'a')
@@ -0,0 +1,158 @@
+"""
+Backpressure for the routines that post documents to a server.
+
+Documents added with defer=True are queued on the server and indexed in
+the background, so a restore can post them far faster than the server
+indexes them. The queue then grows without bound and searches on that
+server wait behind it. A QueueThrottle limits the rate at which documents
+are posted and adjusts that rate to keep the servers' queues near a
+target depth.
+"""
+
+import sys
+import time
+from collections import deque
+import gevent
+from ..util import queue_depth
+
+
+class QueueThrottle(object):
+    def __init__(self, target_depth, min_rate=10.0, max_rate=1000.0, initial_rate=None,
+                 interval=2.0, increase=1.25, decrease=0.5, tolerance=0.1, servers=()):
+        """
+        Posts are limited to `rate` per second, starting at `initial_rate`
+        (default: `min_rate`). Every `interval` seconds the queues of
+        `servers` are polled and the rate is adjusted, within `min_rate` and
+        `max_rate`:
+
+        - When the queue is more than `tolerance` (a fraction of
+          `target_depth`) above the target, the rate is scaled down in
+          proportion to the excess, by at most a factor of `decrease`.
+        - When it is more than `tolerance` below the target, the rate is
+          raised by a factor of `increase`.
+
+        Increases start from the rate at which posts were actually made if
+        that is lower, so the rate does not climb while the posting greenlets
+        are held up by something else. Each adjustment is printed to
+        standard error and kept in `adjustments`. While the queues cannot be
+        read the rate is left alone.
+        """
+        if min_rate <= 0 or max_rate < min_rate:
+            raise ValueError('The rate bounds must satisfy 0 < min_rate <= max_rate, not {0} and {1}'.format(
+                min_rate, max_rate))
+        self.target_depth = target_depth
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.rate = min(self.max_rate, max(self.min_rate, float(initial_rate or min_rate)))
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.servers = list(servers)
+        self.adjustments = deque(maxlen=100)
+        self.next_slot = time.time()
+        self.posts = 0
+        self.poller = None
+
+    def start(self):
+        """Starts polling the servers' queues in a background greenlet."""
+        if self.poller is None:
+            self.poller = gevent.spawn(self._poll_loop)
+
+    def stop(self):
+        if self.poller is not None:
+            self.poller.kill(block=False)
+            self.poller = None
+
+    def wait(self):
+        """Blocks the calling greenlet until the next post is allowed."""
+        now = time.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + 1.0 / self.rate
+        self.posts += 1
+        if slot > now:
+            gevent.sleep(slot - now)
+
+    def queue_depth(self):
+        return sum(queue_depth(server.queue()) for server in self.servers)
+
+    def adjust(self, depth, observed_rate=None):
+        """
+        Adjusts the rate given the current queue `depth` and the rate at which
+        posts were made since the last adjustment. Returns the new rate.
+
+        >>> throttle = QueueThrottle(100, min_rate=10, max_rate=100, initial_rate=40)
+        >>> throttle.adjust(400)
+        20.0
+        >>> throttle.adjust(120)
+        16.666666666666668
+        >>> throttle.adjust(105)
+        16.666666666666668
+        >>> throttle.adjust(0, observed_rate=12.0)
+        16.666666666666668
+        >>> throttle.adjust(0, observed_rate=16.0)
+        20.0
+        >>> throttle.adjust(1000)
+        10.0
+        """
+        if depth > self.target_depth * (1 + self.tolerance):
+            rate = self.rate * max(self.decrease, float(self.target_depth) / depth)
+        elif depth < self.target_depth * (1 - self.tolerance):
+            base = self.rate if observed_rate is None else min(self.rate, observed_rate)
+            rate = max(self.rate, base * self.increase)
+        else:
+            return self.rate
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        if rate != self.rate:
+            self.adjustments.append({'time': time.time(), 'queue_depth': depth,
+                                     'old_rate': self.rate, 'rate': rate})
+            print >>sys.stderr, "Queue depth {0} (target {1}): posting rate {2:.1f} => {3:.1f} documents/s".format(
+                depth, self.target_depth, self.rate, rate)
+            self.rate = rate
+        return self.rate
+
+    def _poll_loop(self):
+        polled = time.time()
+        posts = self.posts
+        failing = False
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                depth = self.queue_depth()
+            except Exception as e:
+                if not failing:
+                    print >>sys.stderr, "Unable to read the queue depth, keeping the posting rate at {0:.1f} documents/s: {1}".format(
+                        self.rate, e)
+                failing = True
+                continue
+            failing = False
+            now = time.time()
+            observed_rate = (self.posts - posts) / max(now - polled, 1e-6)
+            (polled, posts) = (now, self.posts)
+            self.adjust(depth, observed_rate)
+
+
+def add_throttle_arguments(parser):
+    """Adds the options of throttle_from_args() to the ArgumentParser of a tool."""
+    parser.add_argument('--target-queue-depth', dest='target_queue_depth', metavar='N', action='store', type=int,
+                        help=('Limit the rate at which documents are posted, adjusting it to keep about N unprocessed '
+                              + 'commands in the server\'s queue. (default: no limit)'))
+    parser.add_argument('--min-rate', dest='min_rate', metavar='DOCS_PER_SECOND', action='store', type=float,
+                        default=10.0,
+                        help='The lowest posting rate --target-queue-depth may set. (default: 10)')
+    parser.add_argument('--max-rate', dest='max_rate', metavar='DOCS_PER_SECOND', action='store', type=float,
+                        default=1000.0,
+                        help='The highest posting rate --target-queue-depth may set. (default: 1000)')
+
+
+def throttle_from_args(parser, args):
+    """
+    Returns the QueueThrottle described by the options added by
+    add_throttle_arguments(), or None without --target-queue-depth.
+    """
+    if args.target_queue_depth is None:
+        return None
+    try:
+        return QueueThrottle(args.target_queue_depth, args.min_rate, args.max_rate)
+    except ValueError as e:
+        parser.error(str(e))
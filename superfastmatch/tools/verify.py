@@ -0,0 +1,45 @@
+"""
+Checks that a Superfastmatch server holds the documents of a backup
+archive, for instance after a restore or a migration. Each document
+that is missing from the server, extra on the server, or differs from
+the archived copy is printed as it is found.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import os
+from argparse import ArgumentParser
+from superfastmatch.client import Client
+from superfastmatch.tools.routines import verify
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--doctypes', metavar='RANGE_STRING', action='store',
+                        help='Range string of doctypes to compare, e.g. 1:4-7:10 (default: those in the archive)')
+    parser.add_argument('--concurrency', metavar='N', action='store', type=int, default=10,
+                        help='The number of documents to fetch from the server at once. (default: 10)')
+    parser.add_argument('--metadata-only', dest='metadata_only', default=False, action='store_true',
+                        help='Only compare the listed attributes of the documents, not their texts.')
+    parser.add_argument('--url', metavar='URL', type=str,
+                        default='http://127.0.0.1:8080', action='store',
+                        help='URL of the Superfastmatch server.')
+    parser.add_argument('inpath', metavar='INPATH', action='store',
+                        help='Backup file to compare with the server.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.inpath) == False:
+        print >>sys.stderr, "Unable to find {inpath}.".format(**vars(args))
+        sys.exit(1)
+
+    sfm = Client(args.url, parse_response=True)
+    counts = verify(sfm, args.inpath, doctype_rangestr=args.doctypes,
+                    concurrency=args.concurrency, compare_text=not args.metadata_only)
+    if counts['missing'] or counts['extra'] or counts['differing']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,461 @@
-import itertools
-import stream
-from copy import deepcopy
+import sys
+import time
+import zlib
+import bisect
+import struct
+import binascii
+from array import array
 from collections import defaultdict
+import gevent
+import gevent.queue
 
 def eliminate_overlap(ranges):
-    def merged(a, b):
-        (t, u) = a
-        (v, w) = b
-        return (min(t, v), max(u, w))
-
-    def compare_bounds(a, b):
-        (t, u) = a
-        (v, w) = b
-        if t == v:
-            return w - u
-        else:
-            return t - v
-
-    def subsumes(a, b):
-        (t, u) = a
-        (v, w) = b
-        return t <= v and w <= u
-
-    def overlaps(a, b):
-        (t, u) = a
-        (v, w) = b
-        return t <= v < u
-
-    old_ranges = deepcopy(ranges)
-    old_ranges.sort(cmp=compare_bounds)
-    new_ranges = []
-
-    while len(old_ranges) > 0:
-        a = old_ranges.pop(0)
-        if len(old_ranges) == 0:
-            new_ranges.append(a)
+    """
+    Sorts a list of inclusive (start, end) ranges and merges the ranges that
+    overlap or are adjacent. Empty ranges (start > end) are dropped.
+
+    >>> eliminate_overlap([(5, 7), (1, 3), (2, 4), (8, 8), (10, 12), (1, 2)])
+    [(1, 8), (10, 12)]
+    >>> eliminate_overlap([(3, 1)])
+    []
+    """
+    merged = []
+    for (a, b) in sorted(ranges):
+        if a > b:
+            continue
+        if merged and a <= merged[-1][1] + 1:
+            if b > merged[-1][1]:
+                merged[-1] = (merged[-1][0], b)
         else:
-            while len(old_ranges) > 0:
-                b = old_ranges.pop(0)
-
-                if subsumes(a, b):
-                    pass # ignore b
-                elif subsumes(b, a):
-                    a = deepcopy(b)
-                elif overlaps(a, b):
-                    a = merged(a, b)
-                else:
-                    old_ranges = [b] + old_ranges
-                    break
-            new_ranges.append(a)
-    return new_ranges
+            merged.append((a, b))
+    return merged
+
 
 class SparseRange(object):
-    def __init__(self, ranges):
+    """
+    A set of integers stored as a sorted list of disjoint inclusive ranges.
+    Membership is tested by bisection.
+
+    >>> r = SparseRange([(1, 10), (20, 20), (5, 12)])
+    >>> (len(r), r.min, r.max, 12 in r, 13 in r, 20 in r)
+    (13, 1, 20, True, False, True)
+    >>> str(r | SparseRange([(13, 15)]))
+    '1-15,20'
+    >>> str(r & SparseRange([(0, 3), (9, 20)]))
+    '1-3,9-12,20'
+    >>> str(r - SparseRange([(3, 4), (20, 30)]))
+    '1-2,5-12'
+    >>> r.contains_many([20, 0, 11, 13])
+    [True, False, True, False]
+    >>> (r.intersects(13, 19), r.intersects(13, 20))
+    (False, True)
+    >>> empty = SparseRange()
+    >>> (len(empty), empty.min, 0 in empty, empty.intersects(0, 100), str(r & empty), r - empty == r)
+    (0, None, False, False, '', True)
+    """
+
+    def __init__(self, ranges=()):
         self.ranges = eliminate_overlap(ranges)
+        self.starts = [a for (a, b) in self.ranges]
+        self.ends = [b for (a, b) in self.ranges]
         self.len = sum([b - a + 1 for (a, b) in self.ranges])
-        self.min = min((a for (a, b) in self.ranges))
-        self.max = max((b for (a, b) in self.ranges))
+        self.min = self.starts[0] if self.ranges else None
+        self.max = self.ends[-1] if self.ranges else None
 
     def __len__(self):
         return self.len
 
     def __contains__(self, x):
-        for (a, b) in self.ranges:
-            if a <= x <= b:
-                return True
-        return False
+        i = bisect.bisect_right(self.starts, x) - 1
+        return i >= 0 and x <= self.ends[i]
 
     def __iter__(self):
         return ((x for (a, b) in self.ranges for x in xrange(a, b + 1)))
 
+    def __eq__(self, other):
+        return isinstance(other, SparseRange) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __str__(self):
+        return ','.join(str(a) if a == b else '{0}-{1}'.format(a, b)
+                        for (a, b) in self.ranges)
+
+    def __repr__(self):
+        return "SparseRange({0!r})".format(self.ranges)
+
     def __unicode__(self):
         return "SparseRange({0.min}.../...{0.max})".format(self)
 
+    def union(self, other):
+        return SparseRange(self.ranges + other.ranges)
+
+    def intersection(self, other):
+        result = []
+        (i, j) = (0, 0)
+        while i < len(self.ranges) and j < len(other.ranges):
+            (a, b) = self.ranges[i]
+            (c, d) = other.ranges[j]
+            (lo, hi) = (max(a, c), min(b, d))
+            if lo <= hi:
+                result.append((lo, hi))
+            if b < d:
+                i += 1
+            else:
+                j += 1
+        return SparseRange(result)
+
+    def difference(self, other):
+        result = []
+        j = 0
+        for (a, b) in self.ranges:
+            while j < len(other.ranges) and other.ranges[j][1] < a:
+                j += 1
+            k = j
+            while a <= b and k < len(other.ranges) and other.ranges[k][0] <= b:
+                (c, d) = other.ranges[k]
+                if c > a:
+                    result.append((a, c - 1))
+                a = max(a, d + 1)
+                k += 1
+            if a <= b:
+                result.append((a, b))
+        return SparseRange(result)
+
+    def intersects(self, lo, hi):
+        """Returns True if any member falls within the inclusive range [lo, hi]."""
+        i = bisect.bisect_right(self.starts, hi) - 1
+        return i >= 0 and self.ends[i] >= lo
+
+    def contains_many(self, values):
+        """
+        Tests many values for membership at once. The values are sorted and
+        swept against the ranges in a single pass. Returns a list of booleans in
+        the order of `values`.
+        """
+        values = list(values)
+        results = [False] * len(values)
+        ranges = self.ranges
+        i = 0
+        for (position, x) in sorted(enumerate(values), key=lambda pair: pair[1]):
+            while i < len(ranges) and ranges[i][1] < x:
+                i += 1
+            if i == len(ranges):
+                break
+            results[position] = ranges[i][0] <= x
+        return results
+
+
+ARRAY_CONTAINER_LIMIT = 4096
+BITMAP_CONTAINER_BYTES = 8192
+
+
+def _array_to_bits(values):
+    bits = 0
+    for low in values:
+        bits |= 1 << low
+    return bits
+
+
+def _bits_to_array(bits):
+    """
+    >>> list(_bits_to_array(0b100101))
+    [0, 2, 5]
+    """
+    binary = bin(bits)[:1:-1]
+    return array('H', [low for (low, bit) in enumerate(binary) if bit == '1'])
+
+
+def _copy(container):
+    return array('H', container) if isinstance(container, array) else container
+
+
+def _cardinality(container):
+    if isinstance(container, array):
+        return len(container)
+    return bin(container).count('1')
+
+
+def _normalize(container):
+    """
+    Stores a container as a sorted array of its low 16 bits if it holds at most
+    ARRAY_CONTAINER_LIMIT values and as an integer used as a bitmap otherwise.
+    Returns None for an empty container.
+    """
+    if isinstance(container, array):
+        if len(container) > ARRAY_CONTAINER_LIMIT:
+            return _array_to_bits(container)
+        return container if len(container) > 0 else None
+    if container == 0:
+        return None
+    if _cardinality(container) <= ARRAY_CONTAINER_LIMIT:
+        return _bits_to_array(container)
+    return container
+
+
+class DocidBitmap(object):
+    """
+    A compressed set of non-negative integers, such as docids, in the style of
+    a roaring bitmap. Values are grouped by their high bits into containers of
+    65536 values. Sparse containers are sorted arrays of 16-bit values and
+    dense ones are bitmaps, so both scattered docids and long runs stay small.
+
+    >>> a = DocidBitmap.from_rangestr('1-10,70000,200000-300000')
+    >>> (len(a), 5 in a, 11 in a, 70000 in a, 250000 in a, a.min, a.max)
+    (100012, True, False, True, True, 1, 300000)
+    >>> b = DocidBitmap([3, 4, 70000, 70001, 299999])
+    >>> sorted(a & b)
+    [3, 4, 70000, 299999]
+    >>> len(a | b), len(a - b), len(b - a)
+    (100013, 100008, 1)
+    >>> import StringIO
+    >>> buf = StringIO.StringIO()
+    >>> a.dump(buf)
+    >>> _ = buf.seek(0)
+    >>> DocidBitmap.load(buf) == a
+    True
+
+    A container switches to a bitmap past ARRAY_CONTAINER_LIMIT values and
+    back to an array when set operations leave it sparse again:
+
+    >>> dense = DocidBitmap(xrange(0, 2 * ARRAY_CONTAINER_LIMIT, 2))
+    >>> (isinstance(dense.containers[0], array), len(dense))
+    (True, 4096)
+    >>> dense.add(1)
+    >>> (isinstance(dense.containers[0], array), len(dense), 1 in dense, 3 in dense)
+    (False, 4097, True, False)
+    >>> sparse = dense & DocidBitmap([1, 2, 3, 70000])
+    >>> (isinstance(sparse.containers[0], array), sorted(sparse))
+    (True, [1, 2])
+    >>> list(DocidBitmap([70000, 5, 65536, 4]))
+    [4, 5, 65536, 70000]
+    """
+
+    MAGIC = 'SFMBITMAP1\n'
+
+    def __init__(self, values=()):
+        self.containers = {}
+        self.update(values)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Builds a bitmap from inclusive (start, end) ranges."""
+        bitmap = cls()
+        for (a, b) in eliminate_overlap(ranges):
+            while a <= b:
+                (key, low) = (a >> 16, a & 0xffff)
+                high = min(b, (key << 16) | 0xffff) & 0xffff
+                container = bitmap.containers.get(key)
+                bits = ((1 << (high + 1)) - (1 << low))
+                if container is not None:
+                    bits |= container if not isinstance(container, array) else _array_to_bits(container)
+                bitmap.containers[key] = _normalize(bits)
+                a = ((key + 1) << 16)
+        return bitmap
+
+    @classmethod
+    def from_rangestr(cls, rangestr):
+        """Builds a bitmap from a docid range string such as 1-10,20,30-31."""
+        return cls.from_ranges(parse_docid_range(rangestr).ranges)
+
+    @classmethod
+    def from_documents(cls, documents):
+        """
+        Builds a bitmap of the docids of an iterable of documents, e.g. a
+        DocumentIterator.
+        """
+        return cls(doc['docid'] for doc in documents)
+
+    @classmethod
+    def load(cls, infile):
+        """Reads a bitmap written by dump() from a file object."""
+        if infile.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError('Not a serialized DocidBitmap.')
+        bitmap = cls()
+        (count, ) = struct.unpack('<I', infile.read(4))
+        for _ in xrange(count):
+            (key, is_bitmap, length) = struct.unpack('<IBI', infile.read(9))
+            data = infile.read(length)
+            if is_bitmap:
+                bitmap.containers[key] = long(binascii.hexlify(data), 16)
+            else:
+                values = array('H')
+                values.fromstring(data)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                bitmap.containers[key] = values
+        return bitmap
+
+    def dump(self, outfile):
+        """Writes the bitmap to a file object."""
+        outfile.write(self.MAGIC)
+        outfile.write(struct.pack('<I', len(self.containers)))
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if isinstance(container, array):
+                values = array('H', container)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                data = values.tostring()
+            else:
+                data = binascii.unhexlify('%0*x' % (BITMAP_CONTAINER_BYTES * 2, container))
+            outfile.write(struct.pack('<IBI', key, 0 if isinstance(container, array) else 1, len(data)))
+            outfile.write(data)
+
+    def add(self, x):
+        (key, low) = (x >> 16, x & 0xffff)
+        container = self.containers.get(key)
+        if container is None:
+            self.containers[key] = array('H', [low])
+        elif isinstance(container, array):
+            i = bisect.bisect_left(container, low)
+            if i == len(container) or container[i] != low:
+                container.insert(i, low)
+                if len(container) > ARRAY_CONTAINER_LIMIT:
+                    self.containers[key] = _array_to_bits(container)
+        else:
+            self.containers[key] = container | (1 << low)
+
+    def update(self, values):
+        """Adds many values, grouping them by container before merging."""
+        grouped = {}
+        for x in values:
+            grouped.setdefault(x >> 16, []).append(x & 0xffff)
+        for (key, lows) in grouped.iteritems():
+            container = self.containers.get(key)
+            if container is None or isinstance(container, array):
+                merged = array('H', sorted(set(lows).union(container or ())))
+            else:
+                merged = container | _array_to_bits(lows)
+            self.containers[key] = _normalize(merged)
+
+    def __contains__(self, x):
+        container = self.containers.get(x >> 16)
+        if container is None:
+            return False
+        low = x & 0xffff
+        if isinstance(container, array):
+            i = bisect.bisect_left(container, low)
+            return i < len(container) and container[i] == low
+        return (container >> low) & 1 == 1
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.itervalues())
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if not isinstance(container, array):
+                container = _bits_to_array(container)
+            base = key << 16
+            for low in container:
+                yield base | low
+
+    def __eq__(self, other):
+        return isinstance(other, DocidBitmap) and self.containers == other.containers
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def min(self):
+        return next(iter(self), None)
+
+    def intersects(self, lo, hi):
+        """
+        Returns True if any member falls within the inclusive range [lo, hi].
+
+        >>> b = DocidBitmap([10, 70000])
+        >>> (b.intersects(11, 69999), b.intersects(0, 10), b.intersects(69000, 80000))
+        (False, True, True)
+        """
+        for key in xrange(lo >> 16, (hi >> 16) + 1):
+            container = self.containers.get(key)
+            if container is None:
+                continue
+            base = key << 16
+            (low, high) = (max(lo - base, 0), min(hi - base, 0xffff))
+            if isinstance(container, array):
+                i = bisect.bisect_left(container, low)
+                if i < len(container) and container[i] <= high:
+                    return True
+            elif (container >> low) & ((1 << (high - low + 1)) - 1):
+                return True
+        return False
+
+    @property
+    def max(self):
+        if not self.containers:
+            return None
+        key = max(self.containers)
+        container = self.containers[key]
+        if isinstance(container, array):
+            return (key << 16) | container[-1]
+        return (key << 16) | (container.bit_length() - 1)
+
+    def _combine(self, other, keys, combine_arrays, combine_bits):
+        result = DocidBitmap()
+        for key in keys:
+            (a, b) = (self.containers.get(key), other.containers.get(key))
+            if a is None or b is None:
+                combined = _copy(a if b is None else b)
+            elif isinstance(a, array) and isinstance(b, array):
+                combined = array('H', sorted(combine_arrays(set(a), set(b))))
+            else:
+                a = _array_to_bits(a) if isinstance(a, array) else a
+                b = _array_to_bits(b) if isinstance(b, array) else b
+                combined = combine_bits(a, b)
+            combined = _normalize(combined)
+            if combined is not None:
+                result.containers[key] = combined
+        return result
+
+    def __and__(self, other):
+        keys = set(self.containers).intersection(other.containers)
+        return self._combine(other, keys, set.intersection, lambda a, b: a & b)
+
+    def __or__(self, other):
+        keys = set(self.containers).union(other.containers)
+        return self._combine(other, keys, set.union, lambda a, b: a | b)
+
+    def __xor__(self, other):
+        keys = set(self.containers).union(other.containers)
+        return self._combine(other, keys, set.symmetric_difference, lambda a, b: a ^ b)
+
+    def __sub__(self, other):
+        result = DocidBitmap()
+        for (key, a) in self.containers.iteritems():
+            b = other.containers.get(key)
+            if b is None:
+                result.containers[key] = _copy(a)
+                continue
+            if isinstance(a, array) and isinstance(b, array):
+                combined = array('H', sorted(set(a).difference(b)))
+            else:
+                a = _array_to_bits(a) if isinstance(a, array) else a
+                b = _array_to_bits(b) if isinstance(b, array) else b
+                combined = a & ~b
+            combined = _normalize(combined)
+            if combined is not None:
+                result.containers[key] = combined
+        return result
+
+    intersection = __and__
+    union = __or__
+    difference = __sub__
+    symmetric_difference = __xor__
+
+
 def parse_docid_range(rangestr):
     """
     Converts a string of the form n-m,i,j,x-y to a function that determines
@@ -95,6 +478,8 @@ def parse_docid_range(rangestr):
             ranges.append((int(rng_str), int(rng_str)))
         elif '-' in rng_str:
             (a, b) = rng_str.split('-')
+            if int(a) > int(b):
+                raise Exception('Empty docid range: {0}'.format(rng_str))
             ranges.append((int(a), int(b)))
         else:
             raise Exception('Unrecognized docid range data type: {0}'.format(rng_str))
@@ -102,6 +487,111 @@ def parse_docid_range(rangestr):
     return SparseRange(ranges)
 
 
+class DoctypeRange(object):
+    """
+    An immutable set of doctypes, written as a range string such as 1-3:5:7-9.
+    Parsed ranges are cached, so parsing the same string again is a dict
+    lookup. The canonical string form is sorted and compacted.
+
+    >>> DoctypeRange.parse('9:1-3:7-8:2') is DoctypeRange.parse('9:1-3:7-8:2')
+    True
+    >>> str(DoctypeRange.parse('9:1-3:7-8:2'))
+    '1-3:7-9'
+    >>> str(DoctypeRange([1, 3, 4]))
+    '1:3-4'
+    >>> (2 in DoctypeRange.parse('1-3'), '4' in DoctypeRange.parse('1-3'))
+    (True, False)
+    >>> list(DoctypeRange.parse('5:1-2'))
+    [1, 2, 5]
+    >>> str(DoctypeRange.parse('1-5') - DoctypeRange.parse('2:4'))
+    '1:3:5'
+    >>> DoctypeRange.parse('1:2:3') == DoctypeRange.parse('3:1-2'), DoctypeRange.parse('1-2') == '1-2'
+    (True, False)
+    >>> str(DoctypeRange.parse('1-5') & '4-9'), str(DoctypeRange.parse('1-2') | '3:7')
+    ('4-5', '1-3:7')
+    """
+
+    _cache = {}
+    _cache_limit = 1024
+
+    __slots__ = ('doctypes', 'ordered', 'rangestr')
+
+    def __init__(self, doctypes):
+        self.doctypes = frozenset(int(doctype) for doctype in doctypes)
+        self.ordered = tuple(sorted(self.doctypes))
+        pieces = []
+        for (a, b) in eliminate_overlap([(d, d) for d in self.ordered]):
+            pieces.append(str(a) if a == b else '{0}-{1}'.format(a, b))
+        self.rangestr = ':'.join(pieces)
+
+    @classmethod
+    def parse(cls, rangestr):
+        """
+        Returns the DoctypeRange described by `rangestr`, which may also be a
+        single doctype or an existing DoctypeRange.
+        """
+        if isinstance(rangestr, DoctypeRange):
+            return rangestr
+        rangestr = str(rangestr)
+        cached = cls._cache.get(rangestr)
+        if cached is not None:
+            return cached
+        if not rangestr:
+            raise Exception('Invalid doctype range ({0})'.format(rangestr))
+
+        doctypes = []
+        for rng in rangestr.split(':'):
+            bounds = rng.split('-')
+            if len(bounds) == 1:
+                doctypes.append(int(bounds[0]))
+            elif len(bounds) == 2:
+                doctypes.extend(xrange(int(bounds[0]), int(bounds[1]) + 1))
+            else:
+                raise Exception('Unrecognized range data type')
+
+        parsed = cls(doctypes)
+        if len(cls._cache) >= cls._cache_limit:
+            cls._cache.clear()
+        cls._cache[rangestr] = parsed
+        return parsed
+
+    def __contains__(self, doctype):
+        try:
+            return int(doctype) in self.doctypes
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def __str__(self):
+        return self.rangestr
+
+    def __repr__(self):
+        return "DoctypeRange({0!r})".format(self.rangestr)
+
+    def __eq__(self, other):
+        return isinstance(other, DoctypeRange) and self.doctypes == other.doctypes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.doctypes)
+
+    def __and__(self, other):
+        return DoctypeRange(self.doctypes & DoctypeRange.parse(other).doctypes)
+
+    def __or__(self, other):
+        return DoctypeRange(self.doctypes | DoctypeRange.parse(other).doctypes)
+
+    def __sub__(self, other):
+        return DoctypeRange(self.doctypes - DoctypeRange.parse(other).doctypes)
+
+
 def parse_doctype_range(rangestr):
     """Return a list of the doctypes in the range specified expanded as a list 
     of integers. This is used to validate arguments. The actual range strings
@@ -110,29 +600,15 @@ def parse_doctype_range(rangestr):
     >>> parse_doctype_range('1-2:5:7-9')
     [1, 2, 5, 7, 8, 9]
     >>> parse_doctype_range('')
+    Traceback (most recent call last):
+    ...
+    Exception: Invalid doctype range ()
     >>> parse_doctype_range('1')
     [1]
     >>> parse_doctype_range('7-7')
     [7]
     """
-    if not rangestr:
-        raise Exception('Invalid doctype range ({0})'.format(rangestr))
-
-    split_on_hyphen = lambda s: s.split('-')
-
-    def expand(rng):
-        if len(rng) == 1:
-            return int(rng[0])
-        elif len(rng) == 2:
-            return range(int(rng[0]), int(rng[1]) + 1)
-        else:
-            raise Exception('Unrecognized range data type')
-
-    return (stream.Stream(rangestr.split(':'))
-            >> stream.map(split_on_hyphen)
-            >> stream.map(expand)
-            >> stream.flatten
-            >> list)
+    return list(DoctypeRange.parse(rangestr))
 
 
 def merge_doctype_mappings(mapping):
@@ -141,32 +617,288 @@ def merge_doctype_mappings(mapping):
     [('1:3', 'a'), ('2', 'b')]
     >>> sorted(merge_doctype_mappings({10: 'z', 11: 'y'}))
     [('10', 'z'), ('11', 'y')]
+    >>> sorted(merge_doctype_mappings({1: 'a', 2: 'a', 3: 'a', 5: 'b'}))
+    [('1-3', 'a'), ('5', 'b')]
     """
     inverse_mapping = defaultdict(list)
     for (doctype, client) in mapping.iteritems():
-        inverse_mapping[client].append(doctype)
+        inverse_mapping[client].extend(DoctypeRange.parse(doctype))
 
-    merged_mapping = [(':'.join([str(d) for d in doctypes]), client)
+    merged_mapping = [(str(DoctypeRange(doctypes)), client)
                       for (client, doctypes) in inverse_mapping.iteritems()]
 
     return merged_mapping
 
 
+def stable_hash(value):
+    """
+    Returns a non-negative integer hash of the string form of `value`. Unlike the
+    builtin hash() the result is the same across processes, platforms and
+    interpreter versions, so it is suitable for deciding where data lives.
+
+    >>> stable_hash(12345) == stable_hash('12345')
+    True
+    >>> stable_hash(12345)
+    3421846044
+    """
+    return zlib.crc32(str(value)) & 0xffffffff
+
+
+class ConsistentHashRing(object):
+    """
+    Maps keys onto a set of nodes. Each node is placed at `points` positions on a
+    ring of hash values and a key belongs to the first node found clockwise from
+    the key's own hash, so removing a node only moves the keys it owned.
+
+    >>> ring = ConsistentHashRing(['a', 'b', 'c'])
+    >>> ring.node(7) == ring.node('7')
+    True
+    >>> sorted(ring.preference(7))
+    ['a', 'b', 'c']
+    >>> ring.preference(7)[0] == ring.node(7)
+    True
+    >>> smaller = ConsistentHashRing(['a', 'b'])
+    >>> moved = [key for key in range(1000) if smaller.node(key) != ring.node(key)]
+    >>> all(ring.node(key) == 'c' for key in moved), len(moved) > 0
+    (True, True)
+    >>> all(smaller.node(key) == ring.preference(key)[1] for key in moved)
+    True
+    """
+
+    def __init__(self, nodes, points=100):
+        self.nodes = list(nodes)
+        ring = sorted((stable_hash('{0}#{1}'.format(node, n)), node)
+                      for node in self.nodes
+                      for n in range(points))
+        self.hashes = [h for (h, node) in ring]
+        self.ring_nodes = [node for (h, node) in ring]
+
+    def node(self, key):
+        return self.ring_nodes[bisect.bisect(self.hashes, stable_hash(key)) % len(self.hashes)]
+
+    def preference(self, key):
+        """
+        Returns every node in the order they are encountered walking the ring
+        from `key`. The first is the node that owns the key and the rest are the
+        fallbacks that would own it if the nodes before them were removed.
+        """
+        start = bisect.bisect(self.hashes, stable_hash(key))
+        nodes = []
+        for offset in xrange(len(self.ring_nodes)):
+            node = self.ring_nodes[(start + offset) % len(self.ring_nodes)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+
+def queue_depth(queue_response):
+    """
+    Counts the commands in a `GET /queue/` response that have not been
+    processed yet.
+
+    >>> queue_depth({'rows': [{'status': 'Queued'}, {'status': 'Finished'}, {'status': 'Active'}]})
+    2
+    >>> queue_depth({'success': True})
+    0
+    """
+    return len([row for row in queue_response.get('rows', [])
+                if row.get('status') not in ('Finished', 'Failed')])
+
+
 class PushBackIterator(object):
+    """
+    >>> it = PushBackIterator([2, 3])
+    >>> it.pushback(1)
+    >>> it.pushback(0)
+    >>> list(it)
+    [0, 1, 2, 3]
+    """
     def __init__(self, subiter):
         self.subiter = iter(subiter)
+        self.pushed = []
 
     def __iter__(self):
         return self
 
     def next(self):
+        if self.pushed:
+            return self.pushed.pop()
         return self.subiter.next()
 
     def pushback(self, obj):
-        self.subiter = itertools.chain([obj], self.subiter)
+        self.pushed.append(obj)
+
+
+# Marks the end of the source of a BatchingIterator.
+_END_OF_BATCHES = object()
 
 
-class ChunkedIterator(object):
+class BatchingIterator(object):
+    """
+    Groups the items of an iterator into lists. A batch ends once it holds
+    `max_items` items, once the sizes of its items (as measured by `key`) add up
+    to `max_bytes`, or `max_latency` seconds after its first item arrived,
+    whichever comes first. An item that would take a batch over `max_bytes` is
+    held back for the next batch, and an item larger than `max_bytes` forms a
+    batch on its own. Any of the limits may be None. Only one item is ever held
+    back, so each next() costs the same however long the iteration runs.
+
+    With a `max_latency` the source is read by a separate greenlet that hands
+    its items over through a queue, so a batch is ended on time even while the
+    source is blocked. The source must then let other greenlets run while it
+    blocks, as gevent's monkey patched sockets do. At most two items are read
+    ahead of the batch being filled. close() stops the reading greenlet.
+
+    >>> list(BatchingIterator(range(0, 7), max_bytes=5, key=lambda obj: obj))
+    [[0, 1, 2], [3], [4], [5], [6]]
+    >>> list(BatchingIterator(range(0, 7), max_items=3))
+    [[0, 1, 2], [3, 4, 5], [6]]
+    >>> list(BatchingIterator(['ab', 'cd', 'e', 'fgh'], max_bytes=3, max_items=2))
+    [['ab'], ['cd', 'e'], ['fgh']]
+    >>> list(BatchingIterator([], max_items=2, max_latency=1))
+    []
+
+    A batch is handed on once `max_latency` has passed, even while the source
+    is still waiting for its next item:
+
+    >>> def trickle():
+    ...     yield 1
+    ...     yield 2
+    ...     gevent.sleep(0.5)
+    ...     yield 3
+    >>> batches = BatchingIterator(trickle(), max_items=10, max_latency=0.05)
+    >>> started = time.time()
+    >>> (batches.next(), time.time() - started < 0.4)
+    ([1, 2], True)
+    >>> list(batches)
+    [[3]]
+
+    An error raised by the source is raised by next() once the items read
+    before it have been returned:
+
+    >>> def failing():
+    ...     yield 1
+    ...     raise IOError('gone')
+    >>> batches = BatchingIterator(failing(), max_items=5, max_latency=1)
+    >>> batches.next()
+    [1]
+    >>> batches.next()
+    Traceback (most recent call last):
+    ...
+    IOError: gone
+    """
+
+    def __init__(self, subiter, max_bytes=None, max_items=None, max_latency=None, key=len):
+        self.subiter = iter(subiter)
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.max_latency = max_latency
+        self.key = key
+        self.held = None
+        self.finished = False
+        self.queue = None
+        self.reader = None
+        self.error = None
+        # batch_bytes: the total size of the most recently returned batch
+        self.batch_bytes = 0
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        """Stops reading the source. Items read ahead of the last batch are dropped."""
+        self.finished = True
+        if self.reader is not None:
+            self.reader.kill(block=False)
+            self.reader = None
+
+    def _read(self):
+        try:
+            for obj in self.subiter:
+                self.queue.put(obj)
+        except gevent.GreenletExit:
+            # Let a generator source clean up after itself.
+            getattr(self.subiter, 'close', lambda: None)()
+            return
+        except Exception:
+            self.error = sys.exc_info()
+        self.queue.put(_END_OF_BATCHES)
+
+    def _take(self, timeout=None):
+        """
+        Returns the next item and its size. Raises StopIteration at the end of
+        the source, or if the source failed, and gevent.queue.Empty if no item
+        arrives within `timeout` seconds.
+        """
+        if self.held is not None:
+            (obj, obj_size) = self.held
+            self.held = None
+            return (obj, obj_size)
+        if self.finished:
+            raise StopIteration
+
+        if self.max_latency is None:
+            try:
+                obj = self.subiter.next()
+            except StopIteration:
+                self.finished = True
+                raise
+            except Exception:
+                self.error = sys.exc_info()
+                self.finished = True
+                raise StopIteration
+        else:
+            if self.reader is None:
+                self.queue = gevent.queue.Queue(maxsize=1)
+                self.reader = gevent.spawn(self._read)
+            obj = self.queue.get(timeout=timeout)
+            if obj is _END_OF_BATCHES:
+                self.finished = True
+                self.reader = None
+                raise StopIteration
+        return (obj, self.key(obj) if self.max_bytes is not None else 0)
+
+    def next(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            timeout = max(deadline - time.time(), 0) if deadline is not None else None
+            try:
+                (obj, obj_size) = self._take(timeout)
+            except gevent.queue.Empty:
+                break
+            except StopIteration:
+                if len(batch) > 0:
+                    break
+                if self.error is not None:
+                    # The source failed after the items already returned.
+                    (error, self.error) = (self.error, None)
+                    raise error[0], error[1], error[2]
+                raise
+
+            if self.max_bytes is not None and size + obj_size > self.max_bytes and len(batch) > 0:
+                self.held = (obj, obj_size)
+                break
+            batch.append(obj)
+            size += obj_size
+            if deadline is None and self.max_latency is not None:
+                deadline = time.time() + self.max_latency
+
+            if self.max_items is not None and len(batch) >= self.max_items:
+                break
+            if self.max_bytes is not None and size >= self.max_bytes:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        self.batch_bytes = size
+        return batch
+
+
+class ChunkedIterator(BatchingIterator):
     """
     >>> it = ChunkedIterator(range(0, 6), chunksize=2, key=lambda obj: 1)
     >>> [list(chunk) for chunk in it]
@@ -182,31 +914,8 @@ class ChunkedIterator(object):
     []
     """
     def __init__(self, subiter, chunksize, key):
-        self.subiter = PushBackIterator(iter(subiter))
+        super(ChunkedIterator, self).__init__(subiter, max_bytes=chunksize, key=key)
         self.chunksize = chunksize
-        self.key = key
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        chunk = []
-        current_size = 0
-        try:
-            while current_size < self.chunksize:
-                obj = self.subiter.next()
-                obj_size = self.key(obj)
-                new_size = current_size + obj_size
-                if new_size > self.chunksize and len(chunk) > 0:
-                    self.subiter.pushback(obj)
-                    return chunk
-                chunk.append(obj)
-                current_size = new_size
-        except StopIteration:
-            if len(chunk) == 0:
-                raise
-
-        return chunk
 
 
 class UnpicklerIterator(object):
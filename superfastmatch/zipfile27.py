@@ -2,7 +2,7 @@
 Read and write ZIP files.
 """
 import struct, os, time, sys, shutil
-import binascii, cStringIO, stat
+import binascii, cStringIO, stat, mmap
 import io
 import re
 
@@ -13,8 +13,25 @@ except ImportError:
     zlib = None
     crc32 = binascii.crc32
 
-__all__ = ["BadZipfile", "error", "ZIP_STORED", "ZIP_DEFLATED", "is_zipfile",
-           "ZipInfo", "ZipFile", "PyZipFile", "LargeZipFile" ]
+try:
+    import bz2 # We may need its compression method
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma # We may need its compression method
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+if lzma is not None and not hasattr(lzma, '_encode_filter_properties'):
+    # An unrelated module of the same name, such as pyliblzma
+    lzma = None
+
+__all__ = ["BadZipfile", "error", "ZIP_STORED", "ZIP_DEFLATED", "ZIP_BZIP2",
+           "ZIP_LZMA", "is_zipfile", "compression_supported", "ZipInfo",
+           "ZipFile", "PyZipFile", "LargeZipFile" ]
 
 class BadZipfile(Exception):
     pass
@@ -35,8 +52,15 @@ ZIP_MAX_COMMENT = (1 << 16) - 1
 # constants for Zip file compression methods
 ZIP_STORED = 0
 ZIP_DEFLATED = 8
+ZIP_BZIP2 = 12
+ZIP_LZMA = 14
 # Other ZIP compression methods not supported
 
+DEFAULT_VERSION = 20
+ZIP64_VERSION = 45
+BZIP2_VERSION = 46
+LZMA_VERSION = 63
+
 # Below are some formats and associated data for reading/writing headers using
 # the struct module.  The names and structures of headers/records are those used
 # in the PKWARE description of the ZIP file format:
@@ -272,6 +296,7 @@ class ZipInfo (object):
             'compress_size',
             'file_size',
             '_raw_time',
+            '_compresslevel',
         )
 
     def __init__(self, filename="NoName", date_time=(1980,1,1,0,0,0)):
@@ -296,6 +321,7 @@ class ZipInfo (object):
 
         # Standard values:
         self.compress_type = ZIP_STORED # Type of compression for the file
+        self._compresslevel = None      # Level for the compressor
         self.comment = ""               # Comment for each file
         self.extra = ""                 # ZIP extra data
         if sys.platform == 'win32':
@@ -316,7 +342,7 @@ class ZipInfo (object):
         # compress_size         Size of the compressed file
         # file_size             Size of the uncompressed file
 
-    def FileHeader(self):
+    def FileHeader(self, zip64=None):
         """Return the per-file header as a string."""
         dt = self.date_time
         dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
@@ -331,7 +357,9 @@ class ZipInfo (object):
 
         extra = self.extra
 
-        if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+        if zip64 is None:
+            zip64 = file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
+        if zip64:
             # File is larger than what fits into a 4 byte integer,
             # fall back to the ZIP64 extension
             fmt = '<HHQQ'
@@ -342,6 +370,11 @@ class ZipInfo (object):
             self.extract_version = max(45, self.extract_version)
             self.create_version = max(45, self.extract_version)
 
+        if self.compress_type == ZIP_BZIP2:
+            self.extract_version = max(BZIP2_VERSION, self.extract_version)
+        elif self.compress_type == ZIP_LZMA:
+            self.extract_version = max(LZMA_VERSION, self.extract_version)
+
         filename, flag_bits = self._encodeFilenameFlags()
         header = struct.pack(structFileHeader, stringFileHeader,
                  self.extract_version, self.reserved, flag_bits,
@@ -461,6 +494,121 @@ class _ZipDecrypter:
         self._UpdateKeys(c)
         return c
 
+class LZMACompressor:
+
+    def __init__(self, preset=None):
+        self._preset = preset
+        self._comp = None
+
+    def _init(self):
+        filter = {'id': lzma.FILTER_LZMA1}
+        if self._preset is not None:
+            filter['preset'] = self._preset
+        props = lzma._encode_filter_properties(filter)
+        self._comp = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+            lzma._decode_filter_properties(lzma.FILTER_LZMA1, props)
+        ])
+        return struct.pack('<BBH', 9, 4, len(props)) + props
+
+    def compress(self, data):
+        if self._comp is None:
+            return self._init() + self._comp.compress(data)
+        return self._comp.compress(data)
+
+    def flush(self):
+        if self._comp is None:
+            return self._init() + self._comp.flush()
+        return self._comp.flush()
+
+
+class LZMADecompressor:
+
+    def __init__(self):
+        self._decomp = None
+        self._unconsumed = ''
+        self.eof = False
+
+    def decompress(self, data):
+        if self._decomp is None:
+            self._unconsumed += data
+            if len(self._unconsumed) <= 4:
+                return ''
+            psize, = struct.unpack('<H', self._unconsumed[2:4])
+            if len(self._unconsumed) <= 4 + psize:
+                return ''
+
+            self._decomp = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[
+                lzma._decode_filter_properties(lzma.FILTER_LZMA1,
+                                               self._unconsumed[4:4 + psize])
+            ])
+            data = self._unconsumed[4 + psize:]
+            del self._unconsumed
+
+        result = self._decomp.decompress(data)
+        self.eof = self._decomp.eof
+        return result
+
+
+def compression_supported(compress_type):
+    """Return True if this interpreter can read and write members
+    compressed with 'compress_type'."""
+    if compress_type == ZIP_STORED:
+        return True
+    elif compress_type == ZIP_DEFLATED:
+        return zlib is not None
+    elif compress_type == ZIP_BZIP2:
+        return bz2 is not None
+    elif compress_type == ZIP_LZMA:
+        return lzma is not None
+    return False
+
+
+def _check_compression(compress_type):
+    if compress_type == ZIP_DEFLATED and not zlib:
+        raise RuntimeError, \
+              "Compression requires the (missing) zlib module"
+    if compress_type == ZIP_BZIP2 and not bz2:
+        raise RuntimeError, \
+              "Compression requires the (missing) bz2 module"
+    if compress_type == ZIP_LZMA and not lzma:
+        raise RuntimeError, \
+              "Compression requires the (missing) lzma module"
+    if compress_type not in (ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA):
+        raise RuntimeError, \
+              "That compression method is not supported"
+
+
+def get_compressor(compress_type, compresslevel=None):
+    """Return a compressor for members of 'compress_type', or None for
+    ZIP_STORED. 'compresslevel' is the deflate or bzip2 level, or the
+    LZMA preset; None selects the default."""
+    if compress_type == ZIP_DEFLATED:
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    elif compress_type == ZIP_BZIP2:
+        if compresslevel is None:
+            return bz2.BZ2Compressor()
+        return bz2.BZ2Compressor(compresslevel)
+    elif compress_type == ZIP_LZMA:
+        return LZMACompressor(compresslevel)
+    else:
+        return None
+
+
+def get_decompressor(compress_type):
+    """Return a decompressor for members of 'compress_type', or None for
+    ZIP_STORED."""
+    if compress_type == ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    elif compress_type == ZIP_BZIP2:
+        return bz2.BZ2Decompressor()
+    elif compress_type == ZIP_LZMA:
+        return LZMADecompressor()
+    else:
+        return None
+
+
 class ZipExtFile(io.BufferedIOBase):
     """File-like object for reading an archive member.
        Is returned by ZipFile.open().
@@ -483,8 +631,7 @@ class ZipExtFile(io.BufferedIOBase):
         self._compress_size = zipinfo.compress_size
         self._compress_left = zipinfo.compress_size
 
-        if self._compress_type == ZIP_DEFLATED:
-            self._decompressor = zlib.decompressobj(-15)
+        self._decompressor = get_decompressor(self._compress_type)
         self._unconsumed = ''
 
         self._readbuffer = ''
@@ -644,6 +791,25 @@ class ZipExtFile(io.BufferedIOBase):
             self._readbuffer = self._readbuffer[self._offset:] + data
             self._offset = 0
 
+        elif (len(self._unconsumed) > 0 and n > len_readbuffer and
+            self._compress_type != ZIP_STORED):
+            # bz2 and lzma decompressors take no output limit and may hold
+            # back output until a whole block has been read, so keep
+            # feeding them until they produce some or the member ends.
+            data = self._decompressor.decompress(self._unconsumed)
+            self._unconsumed = ''
+            while not data and self._compress_left > 0:
+                more = self._fileobj.read(min(self.MIN_READ_SIZE,
+                                              self._compress_left))
+                self._compress_left -= len(more)
+                if more and self._decrypter is not None:
+                    more = ''.join(map(self._decrypter, more))
+                data = self._decompressor.decompress(more)
+
+            self._update_crc(data, eof=(self._compress_left==0))
+            self._readbuffer = self._readbuffer[self._offset:] + data
+            self._offset = 0
+
         # Read from buffer.
         data = self._readbuffer[self._offset: self._offset + n]
         self._offset += len(data)
@@ -651,46 +817,112 @@ class ZipExtFile(io.BufferedIOBase):
 
 
 
+class _ZipWriteFile(io.BufferedIOBase):
+    """File-like object for writing an archive member.
+       Is returned by ZipFile.open() with mode "w".
+    """
+
+    def __init__(self, zf, zinfo, zip64):
+        self._zinfo = zinfo
+        self._zip64 = zip64
+        self._zipfile = zf
+        self._fileobj = zf.fp
+        self._compressor = get_compressor(zinfo.compress_type,
+                                          zinfo._compresslevel)
+        self._file_size = 0
+        self._compress_size = 0
+        self._crc = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        nbytes = len(data)
+        self._file_size += nbytes
+        self._crc = crc32(data, self._crc) & 0xffffffff
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._compress_size += len(data)
+        self._fileobj.write(data)
+        return nbytes
+
+    def close(self):
+        if self.closed:
+            return
+        super(_ZipWriteFile, self).close()
+        try:
+            if self._compressor:
+                buf = self._compressor.flush()
+                self._compress_size += len(buf)
+                self._fileobj.write(buf)
+            zinfo = self._zinfo
+            zinfo.compress_size = self._compress_size
+            zinfo.CRC = self._crc
+            zinfo.file_size = self._file_size
+
+            if not self._zip64:
+                if zinfo.file_size > ZIP64_LIMIT \
+                        or zinfo.compress_size > ZIP64_LIMIT:
+                    raise LargeZipFile("File size unexpectedly exceeded "
+                                       "ZIP64 limit")
+
+            # Seek backwards and rewrite the header with the CRC and file
+            # sizes, keeping its length so the data that follows is intact
+            position = self._fileobj.tell()
+            self._fileobj.seek(zinfo.header_offset, 0)
+            self._fileobj.write(zinfo.FileHeader(self._zip64))
+            self._fileobj.seek(position, 0)
+            self._zipfile.filelist.append(zinfo)
+            self._zipfile.NameToInfo[zinfo.filename] = zinfo
+        finally:
+            self._zipfile._writing = False
+            self._zipfile._write_handle = None
+
+
 class ZipFile:
     """ Class with methods to open, read, write, close, list zip files.
 
-    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False)
+    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                compresslevel=None)
 
     file: Either the path to the file, or a file-like object.
           If it is a path, the file will be opened and closed by ZipFile.
     mode: The mode can be either read "r", write "w" or append "a".
-    compression: ZIP_STORED (no compression) or ZIP_DEFLATED (requires zlib).
+    compression: ZIP_STORED (no compression), ZIP_DEFLATED (requires zlib),
+                 ZIP_BZIP2 (requires bz2) or ZIP_LZMA (requires lzma).
     allowZip64: if True ZipFile will create files with ZIP64 extensions when
                 needed, otherwise it will raise an exception when this would
                 be necessary.
+    compresslevel: The deflate or bzip2 level, or the LZMA preset, used
+                   when writing files. None selects the default.
 
     """
 
     fp = None                   # Set here since __del__ checks it
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                 compresslevel=None):
         """Open the ZIP file with mode read "r", write "w" or append "a"."""
         if mode not in ("r", "w", "a"):
             raise RuntimeError('ZipFile() requires mode "r", "w", or "a"')
 
-        if compression == ZIP_STORED:
-            pass
-        elif compression == ZIP_DEFLATED:
-            if not zlib:
-                raise RuntimeError,\
-                      "Compression requires the (missing) zlib module"
-        else:
-            raise RuntimeError, "That compression method is not supported"
+        _check_compression(compression)
 
         self._allowZip64 = allowZip64
         self._didModify = False
+        self._writing = False   # True while a member is open for writing
+        self._write_handle = None
         self.debug = 0  # Level of printing: 0 through 3
         self.NameToInfo = {}    # Find file info given name
         self.filelist = []      # List of ZipInfo instances for archive
         self.compression = compression  # Method of compression
+        self.compresslevel = compresslevel  # Level of compression
         self.mode = key = mode.replace('b', '')[0]
         self.pwd = None
         self.comment = ''
+        self._mmap = None       # Map of the archive file for mapped()
 
         # Check if we were passed a file-like object
         if isinstance(file, basestring):
@@ -739,8 +971,27 @@ class ZipFile:
         return self
 
     def __exit__(self, type, value, traceback):
+        if type is not None and self._writing:
+            # An error interrupted the writing of a member. Drop the member
+            # and close quietly, so that the original error is reported.
+            self._abort_write()
+            try:
+                self.close()
+            except Exception:
+                if not self._filePassed and self.fp is not None:
+                    self.fp.close()
+                self.fp = None
+            return
         self.close()
 
+    def _abort_write(self):
+        """Closes the open writing handle without adding its member to the archive."""
+        handle = self._write_handle
+        self._write_handle = None
+        self._writing = False
+        if handle is not None:
+            io.BufferedIOBase.close(handle)
+
     def _GetContents(self):
         """Read the directory, making sure we close the file if the format
         is bad."""
@@ -868,10 +1119,62 @@ class ZipFile:
         """Return file bytes (as a string) for name."""
         return self.open(name, "r", pwd).read()
 
-    def open(self, name, mode="r", pwd=None):
-        """Return file-like object for 'name'."""
-        if mode not in ("r", "U", "rU"):
-            raise RuntimeError, 'open() requires mode "r", "U", or "rU"'
+    def data_offset(self, name):
+        """Return the offset within the archive file of the data of member
+        'name', just past its local file header. For a ZIP_STORED member
+        the data is the file's contents, so it can be read in place."""
+        zinfo = name if isinstance(name, ZipInfo) else self.getinfo(name)
+        if self._filePassed:
+            zef_file = self.fp
+        else:
+            zef_file = open(self.filename, 'rb')
+        try:
+            zef_file.seek(zinfo.header_offset, 0)
+            fheader = zef_file.read(sizeFileHeader)
+            if fheader[0:4] != stringFileHeader:
+                raise BadZipfile, "Bad magic number for file header"
+            fheader = struct.unpack(structFileHeader, fheader)
+        finally:
+            if not self._filePassed:
+                zef_file.close()
+        return (zinfo.header_offset + sizeFileHeader
+                + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+
+    def mapped(self, name):
+        """Return a read-only buffer over the contents of the ZIP_STORED
+        member 'name'. The archive file is memory mapped, so the data is
+        neither read up front nor copied; wrap the buffer in a
+        cStringIO.StringIO to read it as a file. The CRC is not checked.
+        The buffer remains valid after the archive is closed.
+
+        Python 2's mmap only supports the old buffer interface, so this is
+        a buffer object rather than a memoryview."""
+        if self.mode != "r":
+            raise RuntimeError, 'mapped() requires mode "r"'
+        if not self.fp:
+            raise RuntimeError, \
+                  "Attempt to read ZIP archive that was already closed"
+        zinfo = name if isinstance(name, ZipInfo) else self.getinfo(name)
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x1:
+            raise RuntimeError, \
+                  "mapped() requires an unencrypted ZIP_STORED member"
+        if zinfo.file_size == 0:
+            return buffer('')
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return buffer(self._mmap, self.data_offset(zinfo), zinfo.file_size)
+
+    def open(self, name, mode="r", pwd=None, force_zip64=False):
+        """Return file-like object for 'name'.
+
+        With mode "w" the member is written incrementally through the
+        returned object and added to the archive when it is closed. Its
+        size need not be known up front, but 'force_zip64' must be given
+        if it may exceed the ZIP64 limit."""
+        if mode not in ("r", "U", "rU", "w"):
+            raise RuntimeError, 'open() requires mode "r", "U", "rU" or "w"'
+        if mode == "w":
+            return self._open_to_write(name, force_zip64)
         if not self.fp:
             raise RuntimeError, \
                   "Attempt to read ZIP archive that was already closed"
@@ -937,6 +1240,37 @@ class ZipFile:
 
         return  ZipExtFile(zef_file, mode, zinfo, zd)
 
+    def _open_to_write(self, zinfo_or_arcname, force_zip64=False):
+        if not isinstance(zinfo_or_arcname, ZipInfo):
+            zinfo = ZipInfo(filename=zinfo_or_arcname,
+                            date_time=time.localtime(time.time())[:6])
+
+            zinfo.compress_type = self.compression
+            zinfo._compresslevel = self.compresslevel
+            zinfo.external_attr = 0600 << 16
+        else:
+            zinfo = zinfo_or_arcname
+
+        if force_zip64 and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+
+        # Sizes and CRC are overwritten with correct data after processing
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zinfo.file_size = 0
+        zinfo.flag_bits = 0x00
+        if zinfo.compress_type == ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(force_zip64))
+        self._writing = True
+        self._write_handle = _ZipWriteFile(self, zinfo, force_zip64)
+        return self._write_handle
+
     def extract(self, member, path=None, pwd=None):
         """Extract a member from the archive to the current working directory,
            using its full name. Its file information is extracted as accurately
@@ -1007,15 +1341,14 @@ class ZipFile:
                 print "Duplicate name:", zinfo.filename
         if self.mode not in ("w", "a"):
             raise RuntimeError, 'write() requires mode "w" or "a"'
+        if self._writing:
+            raise RuntimeError, \
+                  "Can't write to the ZIP file while there is an open " \
+                  "writing handle on it"
         if not self.fp:
             raise RuntimeError, \
                   "Attempt to write ZIP archive that was already closed"
-        if zinfo.compress_type == ZIP_DEFLATED and not zlib:
-            raise RuntimeError, \
-                  "Compression requires the (missing) zlib module"
-        if zinfo.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
-            raise RuntimeError, \
-                  "That compression method is not supported"
+        _check_compression(zinfo.compress_type)
         if zinfo.file_size > ZIP64_LIMIT:
             if not self._allowZip64:
                 raise LargeZipFile("Filesize would require ZIP64 extensions")
@@ -1048,9 +1381,13 @@ class ZipFile:
             zinfo.compress_type = self.compression
         else:
             zinfo.compress_type = compress_type
+        zinfo._compresslevel = self.compresslevel
 
         zinfo.file_size = st.st_size
         zinfo.flag_bits = 0x00
+        if zinfo.compress_type == ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
 
         self._writecheck(zinfo)
@@ -1071,11 +1408,7 @@ class ZipFile:
             zinfo.compress_size = compress_size = 0
             zinfo.file_size = file_size = 0
             self.fp.write(zinfo.FileHeader())
-            if zinfo.compress_type == ZIP_DEFLATED:
-                cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                     zlib.DEFLATED, -15)
-            else:
-                cmpr = None
+            cmpr = get_compressor(zinfo.compress_type, zinfo._compresslevel)
             while 1:
                 buf = fp.read(1024 * 8)
                 if not buf:
@@ -1113,6 +1446,7 @@ class ZipFile:
                             date_time=time.localtime(time.time())[:6])
 
             zinfo.compress_type = self.compression
+            zinfo._compresslevel = self.compresslevel
             zinfo.external_attr = 0600 << 16
         else:
             zinfo = zinfo_or_arcname
@@ -1123,15 +1457,17 @@ class ZipFile:
 
         if compress_type is not None:
             zinfo.compress_type = compress_type
+        if zinfo.compress_type == ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
 
         zinfo.file_size = len(bytes)            # Uncompressed size
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
         self._writecheck(zinfo)
         self._didModify = True
         zinfo.CRC = crc32(bytes) & 0xffffffff       # CRC-32 checksum
-        if zinfo.compress_type == ZIP_DEFLATED:
-            co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                 zlib.DEFLATED, -15)
+        co = get_compressor(zinfo.compress_type, zinfo._compresslevel)
+        if co:
             bytes = co.compress(bytes) + co.flush()
             zinfo.compress_size = len(bytes)    # Compressed size
         else:
@@ -1147,6 +1483,48 @@ class ZipFile:
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def writestr_compressed(self, zinfo_or_arcname, bytes, file_size, CRC,
+                            compress_type=None):
+        """Write a file whose contents were already compressed into the
+        archive. 'bytes' holds the compressed data, as produced by the
+        compressor from get_compressor(), and 'file_size' and 'CRC' describe the
+        uncompressed data. 'zinfo_or_arcname' is either a ZipInfo instance
+        or the name of the file in the archive."""
+        if not isinstance(zinfo_or_arcname, ZipInfo):
+            zinfo = ZipInfo(filename=zinfo_or_arcname,
+                            date_time=time.localtime(time.time())[:6])
+
+            zinfo.compress_type = self.compression
+            zinfo._compresslevel = self.compresslevel
+            zinfo.external_attr = 0600 << 16
+        else:
+            zinfo = zinfo_or_arcname
+
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        if compress_type is not None:
+            zinfo.compress_type = compress_type
+
+        zinfo.file_size = file_size             # Uncompressed size
+        zinfo.compress_size = len(bytes)        # Compressed size
+        zinfo.CRC = CRC & 0xffffffff            # CRC-32 checksum
+        zinfo.flag_bits = 0x00
+        if zinfo.compress_type == ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        self._writecheck(zinfo)
+        if zinfo.compress_size > ZIP64_LIMIT and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        self.fp.write(bytes)
+        self.fp.flush()
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
     def __del__(self):
         """Call the "close()" method in case the user forgot."""
         self.close()
@@ -1157,6 +1535,11 @@ class ZipFile:
         if self.fp is None:
             return
 
+        if self._writing:
+            raise RuntimeError("Can't close the ZIP file while there is "
+                               "an open writing handle on it. "
+                               "Close the writing handle before closing the zip.")
+
         if self.mode in ("w", "a") and self._didModify: # write ending records
             count = 0
             pos1 = self.fp.tell()
@@ -1260,6 +1643,9 @@ class ZipFile:
         if not self._filePassed:
             self.fp.close()
         self.fp = None
+        # Buffers handed out by mapped() keep the map alive until they are
+        # released, so it must not be closed here.
+        self._mmap = None
 
 
 class PyZipFile(ZipFile):